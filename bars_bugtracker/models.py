@@ -5,10 +5,10 @@ import os
 
 from django.db import models
 from django.conf import settings
-from rest_framework import serializers, viewsets
+from rest_framework import serializers, viewsets, filters
 
 from bars_django.utils import VirtualField, permission_logic, CurrentBarCreateOnlyDefault, CurrentUserCreateOnlyDefault
-from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLogic
+from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLogic, PermissionFilterBackend
 from bars_core.models.bar import Bar
 from bars_core.models.user import User
 
@@ -80,6 +80,7 @@ class BugReportViewSet(viewsets.ModelViewSet):
     queryset = BugReport.objects.all()
     serializer_class = BugReportSerializer
     permission_classes = (PerBarPermissionsOrAnonReadOnly,)
+    filter_backends = (PermissionFilterBackend, filters.DjangoFilterBackend, filters.SearchFilter)
     filter_fields = {
         'bar': ['exact'],
         'author': ['exact']}
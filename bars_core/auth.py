@@ -17,25 +17,196 @@ class AuthenticationBackend(object):
         except User.DoesNotExist:
             return None
 
-from rest_framework_jwt.views import ObtainJSONWebToken
-from bars_django.utils import get_client_ip
+import atexit
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import transaction
+from django.db.models import Case, When, Value, DateTimeField
+from django.dispatch import receiver
+from django.utils.timezone import utc
+from rest_framework import exceptions, status
+from rest_framework.response import Response
+from rest_framework_jwt.views import ObtainJSONWebToken, jwt_response_payload_handler
+from bars_django.utils import get_client_ip, is_private_ip
+from bars_core.authentication import jwt_user_cache
 from bars_core.models.loginattempt import LoginAttempt
+
+
+class LoginBuffer(object):
+    """
+    Write-behind buffer for login bookkeeping: login attempts and users' login timestamps are kept in memory,
+    and written in batches (one bulk insert, one select and one update) when the buffer holds LOGIN_BUFFER_SIZE attempts
+    or its oldest attempt is older than LOGIN_BUFFER_MAX_AGE seconds. The check is made at the end of each request.
+    LoginAttempt timestamps are set when the batch is written.
+    Failed attempts are also fed to the login throttle.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.attempts = []
+        self.logins = {}  # user id -> [login timestamps]
+        self.since = None
+
+    def add(self, user, success, ip, sent_username):
+        now = timezone.now()
+        with self.lock:
+            if self.since is None:
+                self.since = time.time()
+            self.attempts.append(LoginAttempt(user=user, success=success, ip=ip, sent_username=sent_username, timestamp=now))
+            if success:
+                self.logins.setdefault(user.id, []).append(now)
+        if not success:
+            login_throttle.add_failure(ip, sent_username, _epoch(now))
+
+    def get_failures(self):
+        """
+        Return [(ip, username, timestamp)] for the failed attempts not written yet.
+        """
+        with self.lock:
+            return [(a.ip, a.sent_username, _epoch(a.timestamp)) for a in self.attempts if not a.success]
+
+    def is_due(self):
+        return self.since is not None and \
+            (len(self.attempts) >= settings.LOGIN_BUFFER_SIZE or time.time() - self.since >= settings.LOGIN_BUFFER_MAX_AGE)
+
+    def flush(self):
+        with self.lock:
+            attempts, logins = self.attempts, self.logins
+            self.attempts, self.logins, self.since = [], {}, None
+        if not attempts:
+            return
+
+        # Failed attempts are linked to the user they targeted, if any
+        usernames = set(a.sent_username for a in attempts if a.user_id is None)
+        user_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id')) if usernames else {}
+        for a in attempts:
+            if a.user_id is None:
+                a.user_id = user_ids.get(a.sent_username)
+
+        with transaction.atomic():
+            LoginAttempt.objects.bulk_create(attempts)
+            if logins:
+                # Both columns are written as values: backends differ on whether F('current_login') would be read
+                # before or after current_login is assigned in the same UPDATE
+                old_logins = dict(User.objects.select_for_update().filter(pk__in=logins.keys()).values_list('id', 'current_login'))
+                previous_login, current_login = [], []
+                for (user_id, timestamps) in logins.items():
+                    previous = timestamps[-2] if len(timestamps) > 1 else old_logins.get(user_id)
+                    previous_login.append(When(pk=user_id, then=Value(previous)))
+                    current_login.append(When(pk=user_id, then=Value(timestamps[-1])))
+                User.objects.filter(pk__in=logins.keys()).update(
+                    previous_login=Case(*previous_login, output_field=DateTimeField()),
+                    current_login=Case(*current_login, output_field=DateTimeField()))
+
+        for user_id in logins:
+            jwt_user_cache.delete(user_id)
+
+login_buffer = LoginBuffer()
+
+
+@receiver(request_finished)
+def flush_login_buffer(sender, **kwargs):
+    if login_buffer.is_due():
+        login_buffer.flush()
+
+atexit.register(login_buffer.flush)
+
+
+
+_epoch_start = datetime(1970, 1, 1, tzinfo=utc)
+def _epoch(dt):
+    return (dt - _epoch_start).total_seconds()
+
+class LoginThrottle(object):
+    """
+    Sliding-window counters of failed login attempts per IP and per username, kept in memory.
+    The counters are rebuilt every LOGIN_THROTTLE_SYNC_INTERVAL seconds from the failed LoginAttempts
+    in the database (to account for other processes) plus those still in the login buffer.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.failures = {}  # (kind, value) -> deque of timestamps
+            self.last_sync = None
+
+    @staticmethod
+    def _add(failures, ip, username, t):
+        failures.setdefault(('ip', ip), deque()).append(t)
+        failures.setdefault(('username', username), deque()).append(t)
+
+    def add_failure(self, ip, username, t):
+        with self.lock:
+            self._add(self.failures, ip, username, t)
+
+    def sync(self):
+        now = time.time()
+        since = datetime.fromtimestamp(now - settings.LOGIN_THROTTLE_WINDOW, utc)
+        failures = {}
+        rows = LoginAttempt.objects.filter(success=False, timestamp__gte=since).order_by('timestamp').values_list('ip', 'sent_username', 'timestamp')
+        for (ip, username, timestamp) in rows:
+            self._add(failures, ip, username, _epoch(timestamp))
+        for (ip, username, t) in login_buffer.get_failures():
+            self._add(failures, ip, username, t)
+
+        with self.lock:
+            self.failures = failures
+            self.last_sync = now
+
+    def get_wait(self, ip, username):
+        """
+        Return the number of seconds before a new attempt from this IP for this username is allowed (0 if it is).
+        The per-IP limit is not applied to private addresses when no TRUSTED_PROXIES are configured: they are most likely
+        a reverse proxy, through which all users would share a single counter.
+        """
+        now = time.time()
+        if self.last_sync is None or now - self.last_sync >= settings.LOGIN_THROTTLE_SYNC_INTERVAL:
+            self.sync()
+
+        window = settings.LOGIN_THROTTLE_WINDOW
+        limits = [(('username', username), settings.LOGIN_THROTTLE_MAX_PER_USERNAME)]
+        if settings.TRUSTED_PROXIES or not is_private_ip(ip):
+            limits.append((('ip', ip), settings.LOGIN_THROTTLE_MAX_PER_IP))
+        wait = 0
+        with self.lock:
+            for (key, limit) in limits:
+                q = self.failures.get(key)
+                if not q:
+                    continue
+                while q and q[0] < now - window:
+                    q.popleft()
+                if len(q) >= limit:
+                    wait = max(wait, q[-limit] + window - now)
+        return wait
+
+login_throttle = LoginThrottle()
+
+
 class ObtainJSONWebTokenWrapper(ObtainJSONWebToken):
     def post(self, request):
-        response = super(ObtainJSONWebTokenWrapper, self).post(request)
-
         ip = get_client_ip(request)
-        success = response.status_code != 400
-        sent_username = request.data.get('username')
-        try:
-            user = User.objects.get(username=sent_username)
-            user.previous_login = user.current_login
-            user.current_login = timezone.now()
-            user.save()
-        except User.DoesNotExist:
+        sent_username = request.data.get('username') or ''
+
+        # Checked before the serializer hashes the password; rejected attempts are not recorded
+        wait = login_throttle.get_wait(ip, sent_username)
+        if wait > 0:
+            raise exceptions.Throttled(wait)
+
+        serializer = self.get_serializer(data=request.data)
+        success = serializer.is_valid()
+        if success:
+            user = serializer.object.get('user')
+            response = Response(jwt_response_payload_handler(serializer.object.get('token'), user, request))
+        else:
             user = None
-        LoginAttempt.objects.create(user=user, success=success, ip=ip, sent_username=sent_username)
+            response = Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+        login_buffer.add(user, success, ip, sent_username)
         return response
 
 obtain_jwt_token = ObtainJSONWebTokenWrapper.as_view()
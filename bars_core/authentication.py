@@ -0,0 +1,76 @@
+import copy
+import time
+import jwt
+from django.conf import settings
+from django.utils.translation import ugettext as _
+from rest_framework import exceptions
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+from rest_framework_jwt.settings import api_settings
+
+from bars_django.utils import LRUCache
+
+# This module is imported by DRF settings: it must not import models at load time.
+
+jwt_payload_cache = LRUCache(settings.JWT_CACHE_SIZE, settings.JWT_CACHE_TTL)
+# user id -> (version, user), see get_user_version
+jwt_user_cache = LRUCache(settings.JWT_CACHE_SIZE, settings.JWT_CACHE_TTL)
+
+
+def get_user_version(user_id):
+    """
+    Return a version of a user and their roles, which changes when the user or their roles are saved, or roles deleted,
+    by any process (None if the user doesn't exist). Read with one query.
+    """
+    from django.db.models import Count, Max
+    from bars_core.models.user import User
+    versions = User.objects.filter(pk=user_id).annotate(roles_modified=Max('role__last_modified'), roles=Count('role')).\
+        values_list('last_modified', 'is_active', 'roles_modified', 'roles')
+    return versions[0] if versions else None
+
+
+class CachedJSONWebTokenAuthentication(JSONWebTokenAuthentication):
+    """
+    Same as JSONWebTokenAuthentication, with in-process caches of decoded tokens and of users with their roles,
+    so that authenticating a recently seen token costs a single query, checking the cached user's version.
+    Users are also dropped from the cache when they or their roles are saved or deleted in this process
+    (see signals in bars_core.models.user and bars_core.models.role).
+    """
+    def authenticate(self, request):
+        jwt_value = self.get_jwt_value(request)
+        if jwt_value is None:
+            return None
+
+        payload = jwt_payload_cache.get(jwt_value)
+        if payload is not None and api_settings.JWT_VERIFY_EXPIRATION and payload['exp'] < time.time():
+            jwt_payload_cache.delete(jwt_value)
+            payload = None
+
+        if payload is None:
+            try:
+                payload = api_settings.JWT_DECODE_HANDLER(jwt_value)
+            except jwt.ExpiredSignature:
+                raise exceptions.AuthenticationFailed(_('Signature has expired.'))
+            except jwt.DecodeError:
+                raise exceptions.AuthenticationFailed(_('Error decoding signature.'))
+            except jwt.InvalidTokenError:
+                raise exceptions.AuthenticationFailed()
+            jwt_payload_cache.set(jwt_value, payload)
+
+        return (self.authenticate_credentials(payload), jwt_value)
+
+    def authenticate_credentials(self, payload):
+        from bars_core.perms import get_perm_index
+
+        # Read before the user, so that changes made in between are seen by the next request
+        version = get_user_version(payload.get('user_id'))
+        (cached_version, user) = jwt_user_cache.get(payload.get('user_id'), (None, None))
+        if user is None or version is None or cached_version != version or user.username != payload.get('username'):
+            user = super(CachedJSONWebTokenAuthentication, self).authenticate_credentials(payload)
+            get_perm_index(user)  # Computed once for all the requests using the cached user
+            jwt_user_cache.set(user.id, (version, user))
+
+        # Requests get their own copy, sharing the prefetched roles
+        user = copy.copy(user)
+        if hasattr(user, '_prefetched_objects_cache'):
+            user._prefetched_objects_cache = dict(user._prefetched_objects_cache)
+        return user
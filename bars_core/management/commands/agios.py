@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from bars_transactions.agios import apply_agios
+
+
+class Command(BaseCommand):
+    help = "Charge agios to overdrawn accounts. Can be run again safely: an unfinished run is resumed with its day, " \
+           "skipping the bars it already charged."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bar', action='append', dest='bars', help="Only process the given bars")
+        parser.add_argument('--processes', type=int, default=1, help="Number of bars processed in parallel")
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', help="Report the charges without applying them")
+        parser.add_argument('--day', default=None, help="Charge the agios of the given day (YYYY-MM-DD) only")
+        parser.add_argument('--output', default=None, help="JSON report file")
+
+    def handle(self, *args, **options):
+        day = None
+        if options['day']:
+            day = parse_date(options['day'])
+            if day is None:
+                raise CommandError("Wrong day format: %s" % options['day'])
+        reports = apply_agios(options['bars'], dry_run=options['dry_run'], processes=options['processes'], day=day)
+
+        for r in reports:
+            if 'error' in r:
+                self.stdout.write("%s %s: failed (%s)" % (r['day'], r['bar'], r['error']))
+            elif r.get('already_charged'):
+                self.stdout.write("%s %s: already charged (%d accounts)" % (r['day'], r['bar'], r['skipped']))
+            else:
+                self.stdout.write("%s %s: %d accounts, %f euros" % (r['day'], r['bar'], len(r['charged']), r['total']))
+        self.stdout.write("%s (%s %f euros)" % ("Dry run" if options['dry_run'] else "Done",
+                                                 "would take" if options['dry_run'] else "took",
+                                                 sum(r['total'] for r in reports)))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(reports, f, indent=2)
+
+        failed = [r['bar'] for r in reports if 'error' in r]
+        if failed:
+            raise CommandError("Agios failed in bars %s; run the command again to resume" % ", ".join(failed))
@@ -0,0 +1,212 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+from rest_framework_jwt.settings import api_settings
+
+from bars_core.models.bar import Bar
+from bars_core.models.user import get_default_user
+from bars_core.models.account import Account
+from bars_items.models.buyitem import BuyItem
+from bars_items.models.sellitem import SellItem
+from bars_items.models.stockitem import StockItem
+from bars_transactions.models import Transaction
+
+
+# (name, method, url, data, who, query budget)
+# url and data are formatted with the benchmark context; who is the user sending the request.
+benchmark_routes = [
+    ('transaction_list', 'get', '/transaction/?bar={bar}&page=1&page_size=30', None, 'customer', 20),
+    ('transaction_buy', 'post', '/transaction/?bar={bar}', {'type': 'buy', 'sellitem': '{sellitem}', 'qty': 2}, 'customer', 25),
+    ('transaction_meal', 'post', '/transaction/?bar={bar}', {'type': 'meal', 'name': 'Bench',
+        'items': [{'sellitem': '{sellitem}', 'qty': 2}, {'stockitem': '{stockitem}', 'qty': 1}],
+        'accounts': [{'account': '{account}', 'ratio': 1}, {'account': '{staff_account}', 'ratio': 2}]}, 'customer', 40),
+    ('transaction_appro', 'post', '/transaction/?bar={bar}', {'type': 'appro',
+        'items': [{'buyitem': '{buyitem}', 'qty': 3}]}, 'staff', 25),
+    ('transaction_cancel', 'put', '/transaction/{transaction}/cancel/?bar={bar}', {}, 'staff', 25),
+
+    ('account_ranking', 'get', '/account/ranking/?bar={bar}', None, 'customer', 6),
+    ('account_coheze_ranking', 'get', '/account/coheze_ranking/?bar={bar}', None, 'customer', 6),
+    ('account_sellitem_ranking', 'get', '/account/{account}/sellitem_ranking/?bar={bar}', None, 'customer', 6),
+    ('account_magicbar_ranking', 'get', '/account/{account}/magicbar_ranking/?bar={bar}', None, 'customer', 8),
+    ('account_items_ranking', 'get', '/account/items_ranking/?bar={bar}&item={itemdetails}', None, 'customer', 6),
+    ('bar_sellitem_ranking', 'get', '/bar/{bar}/sellitem_ranking/?bar={bar}', None, 'customer', 6),
+    ('bar_nazi_ranking', 'get', '/bar/nazi_ranking/', None, 'customer', 6),
+    ('bar_items_ranking', 'get', '/bar/items_ranking/?item={itemdetails}', None, 'customer', 6),
+    ('sellitem_ranking', 'get', '/sellitem/{sellitem}/ranking/?bar={bar}', None, 'customer', 6),
+
+    ('account_stats', 'get', '/account/{account}/stats/?bar={bar}', None, 'customer', 6),
+    ('account_total_spent', 'get', '/account/{account}/total_spent/?bar={bar}&type=buy&type=meal', None, 'customer', 6),
+    ('user_stats', 'get', '/user/{user}/stats/?bar={bar}', None, 'customer', 6),
+    ('sellitem_stats', 'get', '/sellitem/{sellitem}/stats/?bar={bar}', None, 'customer', 6),
+    ('stockitem_stats', 'get', '/stockitem/{stockitem}/stats/?bar={bar}', None, 'customer', 6),
+    ('itemdetails_stats', 'get', '/itemdetails/{itemdetails}/stats/?bar={bar}', None, 'customer', 6),
+    ('stats_batch', 'post', '/stats/batch/?bar={bar}', {'series': [
+        {'entity': 'account', 'id': '{account}'},
+        {'entity': 'account', 'id': '{account}', 'aggregate': 'total_spent'},
+        {'entity': 'sellitem', 'id': '{sellitem}', 'interval': 'months'}]}, 'customer', 8),
+
+    ('sellitem_list', 'get', '/sellitem/?bar={bar}', None, 'customer', 8),
+    ('itemdetails_list', 'get', '/itemdetails/?bar={bar}', None, 'customer', 8),
+    ('item_search', 'get', '/item/search/?bar={bar}&q={search_query}', None, 'customer', 3),
+]
+
+# Routes with a wall time budget (median, in seconds), besides their query budget
+time_budgets = {
+    'item_search': 0.005,
+}
+
+
+def format_data(data, context):
+    """
+    Recursively format the strings of data with context; strings that are exactly a context key are replaced by its value.
+    """
+    if isinstance(data, dict):
+        return dict((k, format_data(v, context)) for (k, v) in data.items())
+    if isinstance(data, list):
+        return [format_data(x, context) for x in data]
+    if isinstance(data, basestring) and data.startswith('{') and data.endswith('}') and data[1:-1] in context:
+        return context[data[1:-1]]
+    return data
+
+
+def get_benchmark_context(bar=None):
+    """
+    Pick a bar and representative objects in it to run benchmarks on.
+    """
+    if bar is None:
+        bar = Transaction.objects.values_list('bar', flat=True).order_by('-id')[0]
+    bar = Bar.objects.get(pk=bar)
+    default_user = get_default_user()
+
+    accounts = Account.objects.filter(bar=bar, deleted=False).exclude(owner=default_user).select_related('owner')
+    staff = next(a for a in accounts if any(r.name in ('staff', 'admin') and r.bar_id == bar.id for r in a.owner.role_set.all()))
+    account = accounts.exclude(pk=staff.pk).order_by('-money')[0]
+
+    stockitem = StockItem.objects.filter(bar=bar, deleted=False).order_by('-qty')[0]
+    sellitem = SellItem.objects.filter(bar=bar, deleted=False, stockitems__deleted=False).order_by('id')[0]
+    buyitem = BuyItem.objects.filter(details__stockitem__bar=bar, details__stockitem__deleted=False).order_by('id')[0]
+    t = Transaction.objects.filter(bar=bar, type='buy', canceled=False).order_by('-timestamp', '-id')[0]
+
+    return {
+        'bar': bar.id,
+        'account': account.id,
+        'user': account.owner_id,
+        'staff_account': staff.id,
+        'sellitem': sellitem.id,
+        'stockitem': stockitem.id,
+        'itemdetails': stockitem.details_id,
+        'buyitem': buyitem.id,
+        'transaction': t.id,
+        'search_query': stockitem.details.name.split()[0][:4],
+        '_users': {'customer': account.owner, 'staff': staff.owner},
+    }
+
+
+def jwt_auth_header(user):
+    payload = api_settings.JWT_PAYLOAD_HANDLER(user)
+    return 'JWT %s' % api_settings.JWT_ENCODE_HANDLER(payload)
+
+
+def run_benchmarks(context, routes=None, repeat=5, names=None):
+    """
+    Call each route `repeat` times with a DRF test client, authenticated through JWT like real clients,
+    after a first untimed call that warms up the process-level caches.
+    Writes are rolled back after each call. Return a dict {name: result}.
+    """
+    client = APIClient()
+    auth = dict((who, jwt_auth_header(u)) for (who, u) in context['_users'].items())
+    results = {}
+
+    for (name, method, url, data, who, budget) in (routes or benchmark_routes):
+        if names and name not in names:
+            continue
+        url = url.format(**context)
+        data = format_data(data, context)
+
+        times = []
+        for i in range(repeat + 1):
+            with transaction.atomic():
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.time()
+                    response = getattr(client, method)(url, data, format='json', HTTP_AUTHORIZATION=auth[who])
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                    if i > 0:
+                        times.append(time.time() - start)
+                transaction.set_rollback(True)
+
+        times.sort()
+        results[name] = {
+            'method': method.upper(),
+            'url': url,
+            'status': response.status_code,
+            'queries': len(queries),
+            'query_budget': budget,
+            'time_min': times[0],
+            'time_median': times[len(times) // 2],
+        }
+    return results
+
+
+def measure_metrics_overhead(context, repeat=5, names=None):
+    """
+    Run the benchmarks with and without MetricsMiddleware, alternately to spread out the noise.
+    Return (overhead, per-route minimum times with, without), the overhead being the relative difference
+    of the sums of the routes' minimum times.
+    """
+    without_metrics = [m for m in settings.MIDDLEWARE_CLASSES if m != 'bars_django.metrics.MetricsMiddleware']
+    with_times, without_times = {}, {}
+    for i in range(repeat):
+        for (times, middleware) in [(with_times, settings.MIDDLEWARE_CLASSES), (without_times, without_metrics)]:
+            with override_settings(MIDDLEWARE_CLASSES=middleware):
+                results = run_benchmarks(context, repeat=1, names=names)
+            for (name, r) in results.items():
+                times[name] = min(times.get(name, r['time_min']), r['time_min'])
+    overhead = sum(with_times.values()) / sum(without_times.values()) - 1
+    return overhead, with_times, without_times
+
+
+class Command(BaseCommand):
+    help = "Benchmark the main API routes (wall time and SQL query count) on the current database, " \
+           "eg. filled with generate_load_data. Fails if a route exceeds its query budget."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bar', default=None, help="Bar to run benchmarks in (default: the most recently active one)")
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--output', default='bench_results.json', help="JSON results file")
+        parser.add_argument('--route', action='append', dest='routes', help="Only run the given routes")
+        parser.add_argument('--metrics-overhead', action='store_true', help="Also measure the time overhead of MetricsMiddleware")
+
+    def handle(self, *args, **options):
+        context = get_benchmark_context(options['bar'])
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            results = run_benchmarks(context, repeat=options['repeat'], names=options['routes'])
+            output = {'database': connection.vendor, 'bar': context['bar'], 'routes': results}
+            if options['metrics_overhead']:
+                overhead, with_times, without_times = measure_metrics_overhead(context, repeat=options['repeat'], names=options['routes'])
+                output['metrics_overhead'] = {'overhead': overhead, 'with': with_times, 'without': without_times}
+
+        with open(options['output'], 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+        failures = []
+        for name in sorted(results):
+            r = results[name]
+            self.stdout.write("%-28s %3d  %4d queries (budget %3d)  %8.1f ms" % (name, r['status'], r['queries'], r['query_budget'], r['time_median'] * 1000))
+            if r['queries'] > r['query_budget']:
+                failures.append("%s: %d queries (budget %d)" % (name, r['queries'], r['query_budget']))
+            if name in time_budgets and r['time_median'] > time_budgets[name]:
+                failures.append("%s: %.1f ms (budget %.1f ms)" % (name, r['time_median'] * 1000, time_budgets[name] * 1000))
+            if r['status'] >= 400:
+                failures.append("%s: status %d" % (name, r['status']))
+
+        if options['metrics_overhead']:
+            self.stdout.write("MetricsMiddleware overhead: %+.1f%%" % (output['metrics_overhead']['overhead'] * 100))
+
+        if failures:
+            raise CommandError("Benchmark failed:\n" + "\n".join(failures))
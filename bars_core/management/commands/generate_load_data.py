@@ -0,0 +1,292 @@
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from bars_core.models.bar import Bar, BarSettings
+from bars_core.models.user import User, get_default_user
+from bars_core.models.role import Role
+from bars_core.models.account import Account
+from bars_items.models.itemdetails import ItemDetails
+from bars_items.models.buyitem import BuyItem, BuyItemPrice
+from bars_items.models.sellitem import SellItem, refresh_fuzzy_values
+from bars_items.models.stockitem import StockItem
+from bars_items.models.pricehistory import StockItemPriceHistory, BuyItemPriceHistory
+from bars_transactions.models import Transaction, TransactionData, AccountOperation, ItemOperation
+
+
+# Relative frequencies of generated transaction types
+transaction_types = [('buy', 60), ('meal', 15), ('deposit', 15), ('appro', 7), ('inventory', 3)]
+
+
+@contextmanager
+def disabled_auto_now(*models):
+    """
+    Allow to set auto_now and auto_now_add fields by hand, eg. to insert past transactions with bulk_create.
+    """
+    saved = []
+    for model in models:
+        for f in model._meta.local_fields:
+            if getattr(f, 'auto_now', False) or getattr(f, 'auto_now_add', False):
+                saved.append((f, f.auto_now, f.auto_now_add))
+                f.auto_now = f.auto_now_add = False
+    try:
+        yield
+    finally:
+        for (f, auto_now, auto_now_add) in saved:
+            f.auto_now, f.auto_now_add = auto_now, auto_now_add
+
+
+def next_id(model):
+    return (model.objects.aggregate(m=Max('id'))['m'] or 0) + 1
+
+
+class LoadDataGenerator(object):
+    """
+    Fill the database with a realistic dataset, through bulk inserts.
+    Operations are generated in chronological order, so that prev_value/next_value chains are consistent
+    and final Account.money and StockItem.qty match the last operation of each chain.
+    """
+    def __init__(self, bars, accounts, transactions, items=40, days=365, seed=None, batch_size=5000, log=None):
+        self.n_bars = bars
+        self.n_accounts = accounts
+        self.n_transactions = transactions
+        self.n_items = items
+        self.days = days
+        self.batch_size = batch_size
+        self.random = random.Random(seed)
+        self.log = log or (lambda msg: None)
+
+    def run(self):
+        self.create_catalog_and_users()
+        with disabled_auto_now(Transaction):
+            self.create_transactions()
+        self.save_final_values()
+
+    def create_catalog_and_users(self):
+        rnd = self.random
+        prefix = 'load%d' % Bar.objects.filter(id__startswith='load').count()
+        now = timezone.now()
+
+        self.bars = [Bar(id='%s_%d' % (prefix, i), name='Load bar %d' % i) for i in range(self.n_bars)]
+        Bar.objects.bulk_create(self.bars)
+        BarSettings.objects.bulk_create([BarSettings(bar=bar) for bar in self.bars])
+
+        password = User()
+        password.set_password('load')
+        users = [User(username='%s_user%d' % (prefix, i), firstname='User', lastname=str(i), password=password.password)
+                 for i in range(self.n_accounts)]
+        users += [User(username='%s_staff%d' % (prefix, i), firstname='Staff', lastname=str(i), password=password.password)
+                  for i in range(self.n_bars)]
+        User.objects.bulk_create(users)
+        users = list(User.objects.filter(username__startswith=prefix + '_').order_by('id'))
+        customers, staff = users[:self.n_accounts], users[self.n_accounts:]
+        default_user = get_default_user()
+
+        roles = []
+        accounts = []
+        for (bar, staff_user) in zip(self.bars, staff):
+            roles.append(Role(name='staff', bar=bar, user=staff_user))
+            for user in customers + [staff_user, default_user]:
+                roles.append(Role(name='customer', bar=bar, user=user))
+                accounts.append(Account(bar=bar, owner=user))
+        Role.objects.bulk_create(roles)
+        Account.objects.bulk_create(accounts)
+        self.log("Created %d bars, %d users and %d accounts" % (len(self.bars), len(users), len(accounts)))
+
+        details = [ItemDetails(name='%s item %d' % (prefix, i), keywords=prefix) for i in range(self.n_items)]
+        ItemDetails.objects.bulk_create(details)
+        details = list(ItemDetails.objects.filter(keywords=prefix).order_by('id'))
+        buyitems = [BuyItem(details=d, itemqty=rnd.choice([1, 1, 6, 12, 24]), barcode='%013d' % rnd.randint(0, 10 ** 13))
+                    for d in details]
+        BuyItem.objects.bulk_create(buyitems)
+        buyitems = list(BuyItem.objects.filter(details__keywords=prefix).select_related('details'))
+
+        sellitems = []
+        for bar in self.bars:
+            for d in details:
+                sellitems.append(SellItem(bar=bar, name=d.name, tax=0.2, sell_fraction=rnd.random() < 0.3))
+        SellItem.objects.bulk_create(sellitems)
+        sellitems = dict(((si.bar_id, si.name), si) for si in SellItem.objects.filter(bar__in=self.bars))
+
+        stockitems = []
+        buyitemprices = []
+        for bar in self.bars:
+            for b in buyitems:
+                price = round(rnd.uniform(0.2, 5), 2)
+                stockitems.append(StockItem(bar=bar, details=b.details, sellitem=sellitems[(bar.id, b.details.name)],
+                                            price=price, unit_factor=rnd.choice([1, 1, 1, 10]),
+                                            qty=rnd.randint(0, 50), last_inventory=now))
+                buyitemprices.append(BuyItemPrice(bar=bar, buyitem=b, price=price * b.itemqty))
+        StockItem.objects.bulk_create(stockitems)
+        BuyItemPrice.objects.bulk_create(buyitemprices)
+        # bulk_create sends no signals
+        StockItemPriceHistory.record(StockItem.objects.filter(bar__in=self.bars).values_list('id', 'price'), now)
+        BuyItemPriceHistory.record(BuyItemPrice.objects.filter(bar__in=self.bars).values_list('id', 'price'), now)
+        self.log("Created %d itemdetails, %d buyitems and %d stockitems" % (len(details), len(buyitems), len(stockitems)))
+
+        # In-memory state, used to chain operations
+        staff_ids = dict((bar.id, u.id) for (bar, u) in zip(self.bars, staff))
+        self.state = {}
+        for bar in self.bars:
+            bar_accounts = list(Account.objects.filter(bar=bar).select_related('owner'))
+            self.state[bar.id] = {
+                'staff': staff_ids[bar.id],
+                'accounts': [a for a in bar_accounts if a.owner_id != default_user.id],
+                'default_account': next(a for a in bar_accounts if a.owner_id == default_user.id),
+                'stockitems': list(StockItem.objects.filter(bar=bar).select_related('sellitem', 'details')),
+            }
+        self.buyitems = dict((b.details_id, b) for b in buyitems)
+
+    def create_transactions(self):
+        rnd = self.random
+        self.ids = {
+            'transaction': next_id(Transaction),
+            'aop': next_id(AccountOperation),
+            'iop': next_id(ItemOperation),
+            'data': next_id(TransactionData),
+        }
+        self.pending = {'transaction': [], 'aop': [], 'iop': [], 'data': []}
+
+        types = [t for (t, weight) in transaction_types for _ in range(weight)]
+        end = timezone.now()
+        step = timedelta(days=self.days) // max(self.n_transactions, 1)
+        timestamp = end - timedelta(days=self.days)
+
+        for i in range(self.n_transactions):
+            timestamp += step
+            bar = rnd.choice(self.bars)
+            getattr(self, 'make_' + rnd.choice(types))(self.state[bar.id], bar, timestamp)
+
+            if len(self.pending['transaction']) >= self.batch_size:
+                self.flush()
+                self.log("%d/%d transactions" % (i + 1, self.n_transactions))
+        self.flush()
+
+    def flush(self):
+        with transaction.atomic():
+            Transaction.objects.bulk_create(self.pending['transaction'])
+            AccountOperation.objects.bulk_create(self.pending['aop'])
+            ItemOperation.objects.bulk_create(self.pending['iop'])
+            TransactionData.objects.bulk_create(self.pending['data'])
+        for l in self.pending.values():
+            del l[:]
+
+    def save_final_values(self):
+        with transaction.atomic():
+            for state in self.state.values():
+                for a in state['accounts'] + [state['default_account']]:
+                    overdrawn_since = timezone.now().date() if a.money < 0 else None
+                    Account.objects.filter(pk=a.pk).update(money=a.money, overdrawn_since=overdrawn_since)
+                for s in state['stockitems']:
+                    StockItem.objects.filter(pk=s.pk).update(qty=s.qty, last_modified=timezone.now())
+            refresh_fuzzy_values(SellItem.objects.filter(bar__in=self.bars).values_list('id', flat=True))
+
+
+    ## Transaction builders
+    def _new_id(self, kind):
+        x = self.ids[kind]
+        self.ids[kind] += 1
+        return x
+
+    def add_transaction(self, bar, author, type, timestamp, moneyflow):
+        t = Transaction(id=self._new_id('transaction'), bar=bar, author_id=author, type=type,
+                        timestamp=timestamp, last_modified=timestamp, moneyflow=moneyflow)
+        self.pending['transaction'].append(t)
+        return t
+
+    def add_aop(self, t, account, delta):
+        self.pending['aop'].append(AccountOperation(id=self._new_id('aop'), transaction=t, target_id=account.id,
+                                                    prev_value=account.money, delta=delta, next_value=account.money + delta))
+        account.money += delta
+
+    def add_iop(self, t, stockitem, delta, fixed=False, fuzzy=False):
+        self.pending['iop'].append(ItemOperation(id=self._new_id('iop'), transaction=t, target_id=stockitem.id, fixed=fixed,
+                                                 fuzzy=fuzzy, prev_value=stockitem.qty, delta=delta, next_value=stockitem.qty + delta))
+        stockitem.qty += delta
+
+    def add_data(self, t, label, data):
+        self.pending['data'].append(TransactionData(id=self._new_id('data'), transaction=t, label=label, data=data))
+
+    def make_buy(self, state, bar, timestamp):
+        account = self.random.choice(state['accounts'])
+        stockitem = self.random.choice(state['stockitems'])
+        qty = self.random.randint(1, 3)
+        price = qty * stockitem.get_price(unit='sell')
+
+        t = self.add_transaction(bar, account.owner_id, 'buy', timestamp, price)
+        self.add_iop(t, stockitem, -qty / stockitem.get_unit('sell'), fuzzy=True)
+        self.add_aop(t, account, -price)
+
+    def make_meal(self, state, bar, timestamp):
+        accounts = self.random.sample(state['accounts'], min(len(state['accounts']), self.random.randint(2, 4)))
+        stockitems = self.random.sample(state['stockitems'], min(len(state['stockitems']), self.random.randint(1, 4)))
+
+        t = self.add_transaction(bar, accounts[0].owner_id, 'meal', timestamp, 0)
+        total = 0
+        for stockitem in stockitems:
+            qty = self.random.randint(1, 4)
+            total += qty * stockitem.get_price(unit='sell')
+            self.add_iop(t, stockitem, -qty / stockitem.get_unit('sell'), fuzzy=True)
+        for account in accounts:
+            self.add_aop(t, account, -total / len(accounts))
+        self.add_data(t, 'name', 'Meal')
+        t.moneyflow = total
+
+    def make_deposit(self, state, bar, timestamp):
+        account = self.random.choice(state['accounts'])
+        amount = float(self.random.choice([10, 20, 20, 50]))
+
+        t = self.add_transaction(bar, state['staff'], 'deposit', timestamp, amount)
+        self.add_aop(t, account, amount)
+        self.add_aop(t, state['default_account'], amount)
+
+    def make_appro(self, state, bar, timestamp):
+        stockitems = self.random.sample(state['stockitems'], min(len(state['stockitems']), self.random.randint(3, 10)))
+
+        t = self.add_transaction(bar, state['staff'], 'appro', timestamp, 0)
+        total = 0
+        for stockitem in stockitems:
+            buyitem = self.buyitems[stockitem.details_id]
+            qty = self.random.randint(1, 5)
+            total += qty * buyitem.itemqty * stockitem.price
+            self.add_iop(t, stockitem, float(qty * buyitem.itemqty))
+        self.add_aop(t, state['default_account'], -total)
+        t.moneyflow = total
+
+    def make_inventory(self, state, bar, timestamp):
+        stockitems = self.random.sample(state['stockitems'], min(len(state['stockitems']), self.random.randint(1, 5)))
+
+        t = self.add_transaction(bar, state['staff'], 'inventory', timestamp, 0)
+        total = 0
+        for stockitem in stockitems:
+            next_value = float(max(0, round(stockitem.qty + self.random.randint(-2, 1))))
+            delta = next_value - stockitem.qty
+            total += delta * stockitem.get_price()
+            self.add_iop(t, stockitem, delta, fixed=True)
+        t.moneyflow = total
+
+
+class Command(BaseCommand):
+    help = "Fill the database with a large, realistic dataset for benchmarking (do not run this in production!)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bars', type=int, default=3)
+        parser.add_argument('--accounts', type=int, default=100, help="Number of accounts per bar")
+        parser.add_argument('--transactions', type=int, default=10000, help="Total number of transactions")
+        parser.add_argument('--items', type=int, default=40, help="Number of items in the catalog")
+        parser.add_argument('--days', type=int, default=365, help="Transactions are spread over this number of days")
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--batch-size', type=int, default=5000, dest='batch_size')
+
+    def handle(self, *args, **options):
+        log = lambda msg: self.stdout.write(msg)
+        generator = LoadDataGenerator(options['bars'], options['accounts'], options['transactions'],
+                                      items=options['items'], days=options['days'], seed=options['seed'],
+                                      batch_size=options['batch_size'], log=log)
+        generator.run()
+        log("Done")
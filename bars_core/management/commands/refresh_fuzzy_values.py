@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from bars_items.models.sellitem import SellItem, refresh_fuzzy_values
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized fuzzy_qty and fuzzy_price of sellitems"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bar', action='append', dest='bars', help="Only process the given bars")
+        parser.add_argument('--batch-size', type=int, default=500, dest='batch_size')
+
+    def handle(self, *args, **options):
+        qs = SellItem.objects.order_by('id')
+        if options['bars']:
+            qs = qs.filter(bar__in=options['bars'])
+        ids = list(qs.values_list('id', flat=True))
+
+        for i in range(0, len(ids), options['batch_size']):
+            refresh_fuzzy_values(ids[i:i + options['batch_size']])
+        self.stdout.write("Refreshed %d sellitems" % len(ids))
@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bars_items.buyitemprices import reset_buyitemprices
+
+
+class Command(BaseCommand):
+    help = "Reset buy prices to the price of the bar's stockitem times the buyitem's quantity, and report orphaned prices."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bar', action='append', dest='bars', help="Only process the given bars")
+        parser.add_argument('--processes', type=int, default=1, help="Number of bars processed in parallel")
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', help="Report the changes without applying them")
+        parser.add_argument('--output', default=None, help="JSON report file")
+
+    def handle(self, *args, **options):
+        reports = reset_buyitemprices(options['bars'], dry_run=options['dry_run'], processes=options['processes'])
+
+        for r in reports:
+            if 'error' in r:
+                self.stdout.write("%s: failed (%s)" % (r['bar'], r['error']))
+                continue
+            self.stdout.write("%s: %d updated, %d unchanged, %d orphans" % (r['bar'], len(r['updated']), r['unchanged'], len(r['orphans'])))
+            if options['verbosity'] > 1:
+                for o in r['orphans']:
+                    self.stdout.write("  orphan: buyitemprice %d (buyitem %d, details %d: %s)" % (o['buyitemprice'], o['buyitem'], o['details'], o['name']))
+        self.stdout.write("%s (%d prices %s)" % ("Dry run" if options['dry_run'] else "Done",
+                                               sum(len(r['updated']) for r in reports),
+                                               "to update" if options['dry_run'] else "updated"))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(reports, f, indent=2)
+
+        failed = [r['bar'] for r in reports if 'error' in r]
+        if failed:
+            raise CommandError("Reset failed in bars %s" % ", ".join(failed))
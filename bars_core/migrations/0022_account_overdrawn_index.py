@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import date
+
+from django.db import models, migrations
+
+
+def fix_overdrawn_since(apps, schema_editor):
+    Account = apps.get_model("bars_core", "Account")
+    Account.objects.filter(money__gte=0).exclude(overdrawn_since=None).update(overdrawn_since=None)
+    Account.objects.filter(money__lt=0, overdrawn_since=None).update(overdrawn_since=date.today())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bars_core', '0021_auto_20160117_2034'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='account',
+            index_together=set([('bar', 'owner'), ('deleted', 'overdrawn_since')]),
+        ),
+        migrations.RunPython(fix_overdrawn_since, migrations.RunPython.noop),
+    ]
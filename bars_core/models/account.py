@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 from django.db import models
 from django.http import HttpResponseBadRequest
@@ -18,13 +18,14 @@ from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLo
 class Account(models.Model):
     class Meta:
         unique_together = ("bar", "owner")
-        index_together = ["bar", "owner"] # Redundant ?
+        index_together = [["bar", "owner"], # Redundant ?
+                          ["deleted", "overdrawn_since"]]
         app_label = 'bars_core'
     bar = models.ForeignKey(Bar)
     owner = models.ForeignKey(User)
     money = models.FloatField(default=0)
 
-    overdrawn_since = models.DateField(null=True) # set to date value when money becomes negative
+    overdrawn_since = models.DateField(null=True) # set to date value when money becomes negative, maintained by AccountOperation
     deleted = models.BooleanField(default=False)
     last_modified = models.DateTimeField(auto_now=True)
 
@@ -34,6 +35,10 @@ class Account(models.Model):
     def save(self, *args, **kwargs):
         if not self.pk:
             Role.objects.get_or_create(name='customer', bar=self.bar, user=self.owner)
+        if self.money >= 0:
+            self.overdrawn_since = None
+        elif self.overdrawn_since is None:
+            self.overdrawn_since = date.today()
         super(Account, self).save(*args, **kwargs)
 
 
@@ -1,11 +1,17 @@
-from datetime import date, timedelta
-from mock import Mock
+import hashlib
 from django.db import models
 from django.db.models import Count, F, Sum, Prefetch
-from rest_framework import viewsets, serializers, decorators
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import Http404, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_date
+from django.utils.decorators import method_decorator
+from django.views.decorators.gzip import gzip_page
+from rest_framework import viewsets, serializers, decorators, exceptions
 from rest_framework.response import Response
 
-from bars_django.utils import VirtualField, permission_logic
+from bars_django.utils import VirtualField, permission_logic, invalidate_cached_bar, CSVRenderer, JSONLinesRenderer
 from bars_core.perms import RootBarRolePermissionLogic
 
 
@@ -24,27 +30,6 @@ class Bar(models.Model):
         from bars_core.models.bar import BarSettings
         BarSettings.objects.get_or_create(bar=self)
 
-    def apply_agios(self, account):
-        """
-        Create an AgiosTransaction for each account in the bar whose money is not positive, according to BarSettings values.
-        This method is called by `scripts/agios.py`.
-        """
-        if account.money >= 0 and account.overdrawn_since is not None:
-            account.overdrawn_since = None
-            account.save()
-
-        elif account.money < 0:
-            if account.overdrawn_since is None:
-                account.overdrawn_since = date.today()
-                account.save()
-
-            if self.settings.agios_enabled and date.today() - account.overdrawn_since >= timedelta(self.settings.agios_threshold):
-                delta = abs(account.money) * self.settings.agios_factor
-                makeAgiosTransaction(self, account, delta)
-                return delta
-
-        return 0
-
     def count_accounts(self):
         """
         Return the count of active (ie non-deleted) accounts in the bar.
@@ -52,22 +37,6 @@ class Bar(models.Model):
         return self.account_set.filter(deleted=False).count()
 
 
-def makeAgiosTransaction(bar, account, amount):
-    """
-    Create and save an AgiosTransaction.
-    """
-    from bars_transactions.serializers import AgiosTransactionSerializer
-    from bars_core.models.user import get_default_user
-    user = get_default_user()
-    user.has_perm = Mock(return_value=True)
-    data = {'type': 'agios', 'account': account.id, 'amount': amount}
-    context = {'request': Mock(bar=bar, user=user)}
-
-    s = AgiosTransactionSerializer(data=data, context=context)
-    s.is_valid(raise_exception=True)
-    s.save()
-
-
 class BarSerializer(serializers.ModelSerializer):
     class Meta:
         model = Bar
@@ -114,6 +83,101 @@ class BarViewSet(viewsets.ModelViewSet):
             ranking = ranking.annotate(total=Sum(F('stockitems__itemoperation__delta') * F('stockitems__itemoperation__target__unit_factor')))
             return Response(ranking, 200)
 
+    @decorators.detail_route(methods=['get'], renderer_classes=[CSVRenderer, JSONLinesRenderer])
+    def export(self, request, pk):
+        """
+        Stream the ledger of all account and item operations of the bar, in chronological order.
+        running_total is the sum of the non-canceled deltas on the same target since `from`.
+        Response format: CSV or JSON lines with columns timestamp, transaction, type, author, canceled,
+        operation (account or item), target, delta, prev_value, next_value, running_total
+        ---
+        omit_serializer: true
+        parameters:
+            - name: format
+              required: false
+              type: string
+              description: csv (default) or jsonl
+              paramType: query
+            - name: from
+              required: false
+              type: datetime
+              paramType: query
+            - name: to
+              required: false
+              type: datetime
+              paramType: query
+        """
+        from bars_transactions.export import iter_ledger, stream_csv, stream_jsonl
+
+        try:
+            bar = Bar.objects.get(pk=pk)
+        except Bar.DoesNotExist:
+            raise Http404()
+
+        if not request.user.has_perm('bars_core.change_barsettings', bar):
+            raise exceptions.PermissionDenied()
+
+        dates = {}
+        for param in ('from', 'to'):
+            value = request.query_params.get(param)
+            if value is not None:
+                dates[param] = parse_datetime(value) or parse_date(value)
+                if dates[param] is None:
+                    return Response("Non-valid %s date format" % param, 400)
+
+        rows = iter_ledger(bar, dates.get('from'), dates.get('to'))
+        fmt = request.accepted_renderer.format
+        if fmt == 'jsonl':
+            response = StreamingHttpResponse(stream_jsonl(rows), content_type=JSONLinesRenderer.media_type)
+        else:
+            response = StreamingHttpResponse(stream_csv(rows), content_type=CSVRenderer.media_type)
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (bar.id, fmt)
+        return response
+
+    @decorators.detail_route(methods=['get'])
+    @method_decorator(gzip_page)
+    def catalog(self, request, pk):
+        """
+        Return a snapshot of the whole catalog of the bar (sellitems, stockitems, buyitemprices, and the itemdetails and
+        buyitems they use), each as {fields: [...], rows: [[...], ...]}, with its version, also given as ETag (answered by 304 Not Modified).
+        With `since` (typically the last_modified of a previous snapshot), only the rows modified since then are returned,
+        along with the ids of all the rows.
+        Response format: `{version: "...", last_modified: "*date*", since: "*date*", sellitems: {fields: [...], rows: [...], ids: [...]}, ...}`
+        ---
+        omit_serializer: true
+        parameters:
+            - name: since
+              required: false
+              type: datetime
+              paramType: query
+        """
+        from bars_items.catalog import get_catalog_version, get_catalog
+
+        try:
+            bar = Bar.objects.get(pk=pk)
+        except Bar.DoesNotExist:
+            raise Http404()
+
+        since = request.query_params.get('since')
+        if since is not None:
+            since = parse_datetime(since)
+            if since is None:
+                return Response("Non-valid since date format", 400)
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since, timezone.utc)
+
+        version, last_modified = get_catalog_version(bar)
+        etag = version if since is None else hashlib.sha1("%s %s" % (version, since.isoformat())).hexdigest()[:20]
+        etag = '"%s"' % etag
+        # GZipMiddleware marks the ETags of compressed responses
+        if_none_match = [t.strip().replace(';gzip"', '"') for t in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]
+        if etag in if_none_match or 'W/' + etag in if_none_match:
+            return Response(status=304, headers={'ETag': etag})
+
+        data = {'version': version, 'last_modified': last_modified, 'since': since}
+        data.update(get_catalog(bar, since))
+        return Response(data, 200, headers={'ETag': etag})
+
     @decorators.list_route(methods=['get'])
     def nazi_ranking(self, request):
         """
@@ -200,6 +264,14 @@ class BarSettings(models.Model):
         return self.bar.id
 
 
+@receiver(post_save, sender=Bar)
+@receiver(post_delete, sender=Bar)
+@receiver(post_save, sender=BarSettings)
+@receiver(post_delete, sender=BarSettings)
+def bar_changed(sender, instance, **kwargs):
+    invalidate_cached_bar(instance.pk)
+
+
 class BarSettingsSerializer(serializers.ModelSerializer):
     class Meta:
         model = BarSettings
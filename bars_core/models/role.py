@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from bars_django.utils import VirtualField, permission_logic, get_root_bar, CurrentBarCreateOnlyDefault
 
 from rest_framework import viewsets
@@ -7,8 +9,9 @@ from rest_framework.response import Response
 
 from bars_core.models.bar import Bar
 from bars_core.models.user import User
-from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLogic
-from bars_core.roles import roles_map, root_roles_map, roles_list
+from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLogic, invalidate_perm_indexes
+from bars_core.authentication import jwt_user_cache
+from bars_core.roles import roles_perms, root_roles_perms, roles_list
 
 
 class RoleManager(models.Manager):
@@ -27,23 +30,33 @@ class Role(models.Model):
 
     objects = RoleManager()
 
+    def _get_compiled_permissions(self):
+        rmap = root_roles_perms if self.bar_id == get_root_bar().id else roles_perms
+        return rmap.get(self.name, ((), 0))
+
     def get_permissions(self):
-        if self.bar == get_root_bar():
-            rmap = root_roles_map
-        else:
-            rmap = roles_map
-        return sorted(set(rmap[self.name])) if self.name in rmap else []
+        return self._get_compiled_permissions()[0]
+
+    def get_permissions_mask(self):
+        return self._get_compiled_permissions()[1]
 
     def __unicode__(self):
         return self.user.username + " : " + self.name + " (" + self.bar.id + ")"
 
 
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def role_changed(sender, instance, **kwargs):
+    invalidate_perm_indexes()
+    jwt_user_cache.delete(instance.user_id)
+
+
 class RoleSerializer(serializers.ModelSerializer):
     class Meta:
         model = Role
     _type = VirtualField("Role")
     bar = serializers.PrimaryKeyRelatedField(read_only=True, default=CurrentBarCreateOnlyDefault())
-    perms = serializers.ListField(child=serializers.CharField(max_length=127), read_only=True, source='get_permissions')
+    perms = serializers.ReadOnlyField(source='get_permissions')
 
 
 class RoleViewSet(viewsets.ModelViewSet):
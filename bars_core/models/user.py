@@ -4,6 +4,8 @@ import random
 import string
 from django.db import models
 from django.db.models import Prefetch
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.core.mail import send_mail
 from django.contrib.auth.models import BaseUserManager, AbstractBaseUser, _user_has_module_perms, _user_has_perm
 from rest_framework import viewsets, serializers, decorators, exceptions, permissions
@@ -14,6 +16,7 @@ from permission.logics import OneselfPermissionLogic
 from bars_django.utils import VirtualField, permission_logic
 from bars_core.perms import RootBarRolePermissionLogic
 from bars_core.models.loginattempt import LoginAttempt
+from bars_core.authentication import jwt_user_cache
 
 
 class UserManager(BaseUserManager):
@@ -86,6 +89,12 @@ class User(AbstractBaseUser):
         return "%s %s" % (self.lastname, self.firstname)
 
 
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    jwt_user_cache.delete(instance.pk)
+
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -2,6 +2,7 @@ from rest_framework.permissions import DjangoObjectPermissions
 from restfw_composed_permissions.base import BasePermissionComponent, BaseComposedPermision, And, Or
 from restfw_composed_permissions.generic.components import AllowAll, AllowOnlyAuthenticated, AllowOnlySafeHttpMethod
 from bars_django.utils import get_root_bar
+from bars_core.roles import perm_bits
 
 # Debug utils
 DEBUG = False
@@ -22,19 +23,62 @@ def debug_end(name, perm, obj, res):
 
 def debug_perm(name):
     """
-    Decorators for permissions debug.
+    Decorators for permissions debug and profiling.
     Usage: set DEBUG to True to enable debugging, and in runserver console you will see debug log for each request.
+    Evaluations are also counted in the current permission profile, if any (see start_perm_profile).
     """
     def wrapper(f):
         def f_(self, user, perm, obj=None):
             debug_begin(name, perm, obj)
-            ret = f(self, user, perm, obj)
+            profile = getattr(_profile, 'data', None)
+            if profile is None:
+                ret = f(self, user, perm, obj)
+            else:
+                start = time.time()
+                profile['depth'] += 1
+                try:
+                    ret = f(self, user, perm, obj)
+                finally:
+                    profile['depth'] -= 1
+                duration = time.time() - start
+                entry = profile['checks'].setdefault((self.__class__.__name__, perm), [0, 0.0])
+                entry[0] += 1
+                entry[1] += duration
+                if profile['depth'] == 0:
+                    profile['time'] += duration
             debug_end(name, perm, obj, ret)
             return ret
         return f_
     return wrapper
 
 
+# Profiling utils
+import threading
+import time
+_profile = threading.local()
+
+def start_perm_profile():
+    """
+    Start counting permission evaluations in the current thread (typically for a request).
+    """
+    _profile.data = {'checks': {}, 'time': 0.0, 'depth': 0, 'cache_hits': 0, 'cache_misses': 0}
+
+def stop_perm_profile():
+    """
+    Stop profiling and return the profile: {'checks': {(logic class, perm): [count, time]}, 'time': total time,
+    'cache_hits': n, 'cache_misses': n}. Times per check include nested evaluations (eg. a logic calling the backend),
+    the total time doesn't; the cache is the users' permission index. Return None if no profile was started.
+    """
+    data = getattr(_profile, 'data', None)
+    _profile.data = None
+    return data
+
+def _count_cache(hit):
+    profile = getattr(_profile, 'data', None)
+    if profile is not None:
+        profile['cache_hits' if hit else 'cache_misses'] += 1
+
+
 # Utils classes for permissions set definitions
 class BaseComposedPermission(BaseComposedPermision): # typo in original package...
     def global_permission_set(self):
@@ -126,6 +170,23 @@ class BarRolePermissionLogic(PermissionLogic):
             bar = field_lookup(obj, self.field_name)
             return user.has_perm(perm, bar)
 
+    def filter_queryset(self, user, perm, queryset):
+        """
+        Queryset form of has_perm: return the objects of queryset on which user has perm.
+        """
+        if not user.is_authenticated() or not user.is_active:
+            return queryset.none()
+
+        if user.is_superuser:
+            return queryset
+        # Permissions on bars are only granted in the root bar, whatever the bar of the object (see PermissionBackend)
+        bar_perm = "bar" == perm.split(".")[1].split("_")[1]
+        if bar_perm:
+            return queryset if _has_perm_in_bar(user, perm, get_root_bar()) else queryset.none()
+        bit = perm_bits.get(perm, 0)
+        bars = [bar_id for (bar_id, mask) in get_perm_index(user).items() if mask & bit]
+        return queryset.filter(**{self.field_name + '__in': bars})
+
 
 
 class RootBarRolePermissionLogic(PermissionLogic):
@@ -140,17 +201,47 @@ class RootBarRolePermissionLogic(PermissionLogic):
         bar = get_root_bar()
         return user.has_perm(perm, bar)
 
+    def filter_queryset(self, user, perm, queryset):
+        return queryset if self.has_perm(user, perm) else queryset.none()
+
 
 
 ## Bar-related permissions
 from permission.backends import PermissionBackend as PermissionBackend_
 from bars_core.models.bar import Bar
 
-def _has_perm_in_bar(user, perm, bar):
+_perm_index_version = 0
+
+def invalidate_perm_indexes():
+    """
+    Invalidate the permission indexes of all users; called when a Role is saved or deleted.
+    """
+    global _perm_index_version
+    _perm_index_version += 1
+
+def get_perm_index(user):
+    """
+    Return a dict {bar_id: permissions mask} of the permissions granted to the user by their roles
+    (see bars_core.roles.perm_bits). The index is computed once and kept on the user instance until a Role changes.
+    """
+    cached = getattr(user, '_perm_index', None)
+    if cached is not None:
+        if cached[0] == _perm_index_version:
+            _count_cache(True)
+            return cached[1]
+        # Roles changed: the prefetched role_set may be stale too
+        cache_name = user.__class__.role_set.related.field.related_query_name()
+        getattr(user, '_prefetched_objects_cache', {}).pop(cache_name, None)
+
+    _count_cache(False)
+    index = {}
     for r in user.role_set.all():
-        if r.bar_id == bar.id and perm in r.get_permissions():
-            return True
-    return False
+        index[r.bar_id] = index.get(r.bar_id, 0) | r.get_permissions_mask()
+    user._perm_index = (_perm_index_version, index)
+    return index
+
+def _has_perm_in_bar(user, perm, bar):
+    return bool(get_perm_index(user).get(bar.id, 0) & perm_bits.get(perm, 0))
 
 class PermissionBackend(PermissionBackend_):
     def authenticate(self, *args, **kwargs):
@@ -166,3 +257,37 @@ class PermissionBackend(PermissionBackend_):
             return _has_perm_in_bar(user, perm, obj)
         else:
             return super(PermissionBackend, self).has_perm(user, perm, obj)
+
+
+
+## Queryset filtering
+from rest_framework import filters
+
+def filter_queryset_by_perm(user, perm, queryset):
+    """
+    Return the objects of queryset on which user has perm, filtering in SQL with the `filter_queryset` form
+    of the permission logics of the model (objects are allowed if any logic allows them).
+    Logics without such a form are checked object by object.
+    """
+    if user.is_active and user.is_superuser:
+        return queryset
+
+    result = queryset.none()
+    for logic in getattr(queryset.model, '_permission_logics', ()):
+        if hasattr(logic, 'filter_queryset'):
+            result = result | logic.filter_queryset(user, perm, queryset)
+        else:
+            result = result | queryset.filter(pk__in=[obj.pk for obj in queryset if logic.has_perm(user, perm, obj)])
+    return result
+
+class PermissionFilterBackend(filters.BaseFilterBackend):
+    """
+    Opt-in filter: `?perm=change` (or any other action) returns only the objects the user has the permission on.
+    """
+    def filter_queryset(self, request, queryset, view):
+        action = request.query_params.get('perm')
+        if action is None:
+            return queryset
+        opts = queryset.model._meta
+        perm = "%s.%s_%s" % (opts.app_label, action, opts.model_name)
+        return filter_queryset_by_perm(request.user, perm, queryset)
@@ -124,3 +124,21 @@ root_roles_map['admin'] = \
 
 
 roles_list = list(set(roles_map.keys()) | set(root_roles_map.keys()))
+
+
+# Compiled tables, computed once at import
+all_perms = tuple(sorted(set(intern(p) for rmap in (roles_map, root_roles_map) for perms in rmap.values() for p in perms)))
+perm_bits = dict((p, 1 << i) for (i, p) in enumerate(all_perms))
+
+def _compile(rmap):
+    """
+    Return {role name: (sorted tuple of perms, bitmask of perms)} for the given roles map.
+    """
+    compiled = {}
+    for (name, perms) in rmap.items():
+        perms = tuple(sorted(set(intern(p) for p in perms)))
+        compiled[name] = (perms, reduce(lambda mask, p: mask | perm_bits[p], perms, 0))
+    return compiled
+
+roles_perms = _compile(roles_map)
+root_roles_perms = _compile(root_roles_map)
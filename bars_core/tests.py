@@ -1,5 +1,6 @@
 from rest_framework.test import APITestCase
-from bars_django.utils import get_root_bar
+from django.test.utils import override_settings
+from bars_django.utils import get_root_bar, get_cached_bar, invalidate_cached_bar
 from bars_core.models.bar import Bar, BarSerializer, BarSettingsSerializer
 from bars_core.models.user import User, UserSerializer
 from bars_core.models.role import Role
@@ -16,6 +17,9 @@ class BackendTests(APITestCase):
         super(BackendTests, self).setUpTestData()
         User.objects.create_user("test", "test")
 
+    def setUp(self):
+        from bars_core.auth import login_throttle
+        login_throttle.reset()
 
     def test_login(self):
         data = {'username': 'test', 'password': 'test'}
@@ -30,6 +34,152 @@ class BackendTests(APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['username'], "test")
 
+    def test_cached_authentication(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from bars_core.authentication import jwt_payload_cache, jwt_user_cache
+
+        data = {'username': 'test', 'password': 'test'}
+        auth = 'JWT {0}'.format(self.client.post('/api-token-auth/', data, format='json').data["token"])
+
+        jwt_payload_cache.ttl = jwt_user_cache.ttl = 60
+        try:
+            with CaptureQueriesContext(connection) as uncached:
+                self.client.get('/user/me/', HTTP_AUTHORIZATION=auth)
+            with CaptureQueriesContext(connection) as cached:
+                response = self.client.get('/user/me/', HTTP_AUTHORIZATION=auth)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(cached), len(uncached) - 2)
+
+            u = User.objects.get(username='test')
+            u.firstname = 'Bob'
+            u.save()
+            response = self.client.get('/user/me/', HTTP_AUTHORIZATION=auth)
+            self.assertEqual(response.data['firstname'], 'Bob')
+        finally:
+            jwt_payload_cache.ttl = jwt_user_cache.ttl = 0
+            jwt_payload_cache.clear()
+            jwt_user_cache.clear()
+
+    def test_cached_authentication_other_process(self):
+        from django.db.models.signals import post_save, post_delete
+        from bars_core.authentication import jwt_payload_cache, jwt_user_cache
+        from bars_core.models.user import user_changed
+        from bars_core.models.role import role_changed
+
+        data = {'username': 'test', 'password': 'test'}
+        auth = 'JWT {0}'.format(self.client.post('/api-token-auth/', data, format='json').data["token"])
+        bar, _ = Bar.objects.get_or_create(id='barjone')
+        role = Role.objects.create(bar=bar, user=User.objects.get(username='test'), name='admin')
+
+        jwt_payload_cache.ttl = jwt_user_cache.ttl = 60
+        # Changes made by another process: this one's caches are not invalidated
+        post_save.disconnect(user_changed, sender=User)
+        post_delete.disconnect(role_changed, sender=Role)
+        try:
+            response = self.client.get('/user/me/', HTTP_AUTHORIZATION=auth)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(role.id, [r.id for r in jwt_user_cache.get(role.user_id)[1].role_set.all()])
+
+            role.delete()
+            response = self.client.get('/user/me/', HTTP_AUTHORIZATION=auth)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(list(jwt_user_cache.get(role.user_id)[1].role_set.all()), [])
+
+            u = User.objects.get(username='test')
+            u.is_active = False
+            u.save()
+            response = self.client.get('/user/me/', HTTP_AUTHORIZATION=auth)
+            self.assertEqual(response.status_code, 401)
+        finally:
+            post_save.connect(user_changed, sender=User)
+            post_delete.connect(role_changed, sender=Role)
+            jwt_payload_cache.ttl = jwt_user_cache.ttl = 0
+            jwt_payload_cache.clear()
+            jwt_user_cache.clear()
+
+    @override_settings(LOGIN_BUFFER_SIZE=3)
+    def test_login_buffer(self):
+        from bars_core.models.loginattempt import LoginAttempt
+        user = User.objects.get(username='test')
+
+        self.client.post('/api-token-auth/', {'username': 'test', 'password': 'test'}, format='json')
+        self.client.post('/api-token-auth/', {'username': 'test', 'password': 'wrong'}, format='json')
+        self.assertEqual(LoginAttempt.objects.count(), 0)
+
+        self.client.post('/api-token-auth/', {'username': 'test', 'password': 'test'}, format='json')
+        attempts = LoginAttempt.objects.order_by('id')
+        self.assertEqual([a.success for a in attempts], [True, False, True])
+        self.assertTrue(all(a.user_id == user.id for a in attempts))
+
+        u = reload(user)
+        self.assertGreater(u.current_login, user.current_login)
+        self.assertGreater(u.previous_login, user.current_login)
+        self.assertLess(u.previous_login, u.current_login)
+
+    @override_settings(LOGIN_BUFFER_SIZE=1)
+    def test_login_buffer_single_login(self):
+        user = User.objects.get(username='test')
+
+        self.client.post('/api-token-auth/', {'username': 'test', 'password': 'test'}, format='json')
+        u = reload(user)
+        self.assertGreater(u.current_login, user.current_login)
+        self.assertEqual(u.previous_login, user.current_login)
+
+    @override_settings(LOGIN_THROTTLE_MAX_PER_USERNAME=2)
+    def test_login_throttle(self):
+        from mock import patch
+        from bars_core.auth import login_throttle
+
+        for _ in range(2):
+            response = self.client.post('/api-token-auth/', {'username': 'test', 'password': 'wrong'}, format='json')
+            self.assertEqual(response.status_code, 400)
+
+        with patch.object(User, 'check_password') as check_password:
+            response = self.client.post('/api-token-auth/', {'username': 'test', 'password': 'test'}, format='json')
+            self.assertEqual(response.status_code, 429)
+            self.assertFalse(check_password.called)
+
+        # Counters survive a resync from the database
+        login_throttle.sync()
+        response = self.client.post('/api-token-auth/', {'username': 'test', 'password': 'test'}, format='json')
+        self.assertEqual(response.status_code, 429)
+
+        # Other usernames are not affected
+        response = self.client.post('/api-token-auth/', {'username': 'other', 'password': 'test'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(LOGIN_THROTTLE_MAX_PER_IP=2)
+    def test_login_throttle_ip(self):
+        def login(username, forwarded_for, remote_addr='203.0.113.1'):
+            return self.client.post('/api-token-auth/', {'username': username, 'password': 'wrong'}, format='json',
+                                    REMOTE_ADDR=remote_addr, HTTP_X_FORWARDED_FOR=forwarded_for).status_code
+
+        # X-Forwarded-For is ignored from untrusted peers
+        self.assertEqual(login('a', '1.1.1.1'), 400)
+        self.assertEqual(login('b', '2.2.2.2'), 400)
+        self.assertEqual(login('c', '3.3.3.3'), 429)
+
+        # And read from trusted proxies, whatever the client prepended
+        with self.settings(TRUSTED_PROXIES=('203.0.113.1',)):
+            self.assertEqual(login('d', '4.4.4.4'), 400)
+            self.assertEqual(login('e', '6.6.6.6, 4.4.4.4'), 400)
+            self.assertEqual(login('f', '7.7.7.7, 4.4.4.4'), 429)
+            self.assertEqual(login('g', '5.5.5.5'), 400)
+
+    @override_settings(LOGIN_THROTTLE_MAX_PER_IP=2)
+    def test_login_throttle_unconfigured_proxy(self):
+        # Behind a proxy missing from TRUSTED_PROXIES, all users share its private address: it is not limited
+        for username in ['a', 'b', 'c', 'd']:
+            response = self.client.post('/api-token-auth/', {'username': username, 'password': 'wrong'}, format='json',
+                                        REMOTE_ADDR='10.0.0.1')
+            self.assertEqual(response.status_code, 400)
+
+        with self.settings(TRUSTED_PROXIES=('10.0.0.2',)):
+            response = self.client.post('/api-token-auth/', {'username': 'e', 'password': 'wrong'}, format='json',
+                                        REMOTE_ADDR='10.0.0.1')
+            self.assertEqual(response.status_code, 429)
+
     def test_login_wrong_password(self):
         data = {'username': 'test', 'password': 'sdgez'}
         response = self.client.post('/api-token-auth/', data, format='json')
@@ -99,6 +249,41 @@ class BarTests(APITestCase):
 
         self.assertEqual(reload(self.bar).name, self.data['name'])
 
+    @override_settings(BAR_CACHE_TTL=60)
+    def test_cached_bar_requests(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        def bar_queries(url):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            return [q for q in queries if 'FROM "bars_core_bar"' in q['sql']]
+
+        invalidate_cached_bar()
+        try:
+            url = '/account/?bar=%s' % self.bar.id
+            uncached = len(bar_queries(url))
+            # Reused by the next requests (the list is still filtered by bar)
+            self.assertEqual(len(bar_queries(url)), uncached - 1)
+
+            # Renamed through the API
+            self.client.force_authenticate(user=self.manager)
+            self.assertEqual(self.client.put(self.bar_url, self.data).status_code, 200)
+            self.assertEqual(len(bar_queries(url)), uncached)
+            self.assertEqual(get_cached_bar(self.bar.id).name, self.data['name'])
+
+            # Altering a returned copy doesn't alter the cache
+            get_cached_bar(self.bar.id).name = "other"
+            self.assertEqual(get_cached_bar(self.bar.id).name, self.data['name'])
+
+            # Deleted
+            Bar.objects.get(pk=self.bar.pk).delete()
+            with self.assertRaises(Bar.DoesNotExist):
+                get_cached_bar(self.bar.id)
+            self.assertEqual(self.client.get(url).status_code, 404)
+        finally:
+            invalidate_cached_bar()
+
 
 class BarSettingsTests(APITestCase):
     @classmethod
@@ -150,6 +335,21 @@ class BarSettingsTests(APITestCase):
 
         self.assertEqual(reload(self.barsettings).agios_enabled, self.data['agios_enabled'])
 
+    @override_settings(BAR_CACHE_TTL=60)
+    def test_cached_bar(self):
+        invalidate_cached_bar()
+        bar = get_cached_bar(self.bar.id)
+        with self.assertNumQueries(0):
+            bar2 = get_cached_bar(self.bar.id)
+            self.assertFalse(bar2.settings.agios_enabled)
+        self.assertIsNot(bar, bar2)
+        self.assertIsNot(bar.settings, bar2.settings)
+
+        self.barsettings.agios_enabled = True
+        self.barsettings.save()
+        self.assertTrue(get_cached_bar(self.bar.id).settings.agios_enabled)
+        invalidate_cached_bar()
+
 
 class UserTests(APITestCase):
     @classmethod
@@ -389,3 +589,127 @@ class RoleTests(APITestCase):
         self.client.force_authenticate(user=self.root)
         response = self.client.post('/role/?bar=root', self.create_data_root)
         self.assertEqual(response.status_code, 201)
+
+    def test_perm_index_invalidation(self):
+        user = reload(self.user)
+        self.assertFalse(user.has_perm('bars_core.add_account', self.bar))
+
+        role = Role.objects.create(name='accountmanager', bar=self.bar, user=self.user)
+        self.assertTrue(user.has_perm('bars_core.add_account', self.bar))
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm('bars_core.change_account', self.bar))
+
+        role.delete()
+        self.assertFalse(user.has_perm('bars_core.add_account', self.bar))
+
+
+class GenerateLoadDataTests(APITestCase):
+    def test_generate_load_data(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from bars_transactions.models import Transaction, AccountOperation
+
+        call_command('generate_load_data', bars=2, accounts=5, transactions=200, items=5, seed=1, batch_size=50, stdout=StringIO())
+        self.assertEqual(Transaction.objects.count(), 200)
+
+        for a in Account.objects.filter(bar__id__startswith='load'):
+            ops = list(AccountOperation.objects.filter(target=a).order_by('transaction__timestamp', 'pk'))
+            for (op, next_op) in zip(ops, ops[1:]):
+                self.assertAlmostEqual(op.next_value, next_op.prev_value)
+            if ops:
+                self.assertAlmostEqual(ops[-1].next_value, a.money)
+
+    @override_settings(BAR_CACHE_TTL=60, ITEM_SEARCH_INDEX_TTL=60)
+    def test_benchmark_api(self):
+        import json
+        import tempfile
+        from mock import patch
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from bars_core.management.commands.benchmark_api import benchmark_routes
+        from bars_items.search import index
+
+        call_command('generate_load_data', bars=1, accounts=5, transactions=100, items=5, seed=1, stdout=StringIO())
+        invalidate_cached_bar()
+        index.reset()
+        # Wall times depend on the machine running the tests
+        with tempfile.NamedTemporaryFile(suffix='.json') as f, \
+                patch.dict('bars_core.management.commands.benchmark_api.time_budgets', clear=True):
+            call_command('benchmark_api', repeat=1, output=f.name, stdout=StringIO())
+            results = json.load(open(f.name))
+        invalidate_cached_bar()
+        index.reset()
+
+        self.assertEqual(len(results['routes']), len(benchmark_routes))
+        for r in results['routes'].values():
+            self.assertLess(r['status'], 400)
+            self.assertLessEqual(r['queries'], r['query_budget'])
+
+
+class PermissionFilterTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(PermissionFilterTests, self).setUpTestData()
+        from bars_items.models.sellitem import SellItem
+        from bars_news.models import News
+        from bars_menus.models import Menu
+        from bars_transactions.models import Transaction
+        get_root_bar._cache = None  # Workaround
+        root_bar = get_root_bar()
+        self.bar, _ = Bar.objects.get_or_create(id='natationjone')
+        self.bar2, _ = Bar.objects.get_or_create(id='avironjone')
+        bars = [root_bar, self.bar, self.bar2]
+
+        users = dict((name, User.objects.create_user(name, name)) for name in ['user', 'staff', 'newsmanager', 'baradmin', 'rootadmin', 'inactive'])
+        Role.objects.create(name='staff', bar=self.bar, user=users['staff'])
+        Role.objects.create(name='admin', bar=self.bar, user=users['baradmin'])
+        Role.objects.create(name='newsmanager', bar=self.bar, user=users['newsmanager'])
+        Role.objects.create(name='admin', bar=root_bar, user=users['rootadmin'])
+        Role.objects.create(name='admin', bar=self.bar, user=users['inactive'])
+        User.objects.filter(pk=users['inactive'].pk).update(is_active=False)
+        User.objects.create_superuser('superuser', 'superuser')
+
+        for bar in bars:
+            for u in users.values():
+                Account.objects.get_or_create(bar=bar, owner=u)
+                Menu.objects.create(bar=bar, user=u, name='menu')
+            SellItem.objects.create(bar=bar, name='sellitem')
+            News.objects.create(bar=bar, author=users['user'], name='news', text='')
+            Transaction.objects.create(bar=bar, author=users['staff'], type='deposit')
+
+    def test_filter_matches_has_perm(self):
+        from django.contrib.auth.models import AnonymousUser
+        from bars_core.perms import filter_queryset_by_perm
+        from bars_items.models.sellitem import SellItem
+        from bars_news.models import News
+        from bars_menus.models import Menu
+        from bars_transactions.models import Transaction
+        from bars_core.models.bar import BarSettings
+
+        from bars_core import perms as perms_module
+        from bars_core.roles import perm_bits
+
+        models = [Bar, BarSettings, User, Account, Role, SellItem, News, Menu, Transaction]
+        users = list(User.objects.all()) + [AnonymousUser()]
+        # All permissions in a bar, including those on bars that roles only grant in the root bar
+        local_admin = User.objects.get(username='user')
+        local_admin._perm_index = (perms_module._perm_index_version, {self.bar.id: sum(perm_bits.values())})
+        users.append(local_admin)
+        for model in models:
+            opts = model._meta
+            objects = list(model.objects.all())
+            perms = ["%s.%s_%s" % (opts.app_label, action, opts.model_name) for action in ['add', 'change', 'delete']]
+            # Permissions on bars, checked against the objects' bars
+            perms += ['bars_core.change_bar', 'bars_core.delete_bar']
+            for perm in perms:
+                for user in users:
+                    # Each logic, then all of them
+                    for logic in getattr(model, '_permission_logics', ()):
+                        if hasattr(logic, 'filter_queryset'):
+                            expected = sorted(o.pk for o in objects if logic.has_perm(user, perm, o))
+                            filtered = sorted(logic.filter_queryset(user, perm, model.objects.all()).values_list('pk', flat=True))
+                            self.assertEqual(filtered, expected, "%s: %s for %s" % (logic.__class__.__name__, perm, user))
+                    if perm.startswith(opts.app_label + '.') and perm.endswith('_' + opts.model_name):
+                        expected = sorted(o.pk for o in objects if user.has_perm(perm, o))
+                        filtered = sorted(filter_queryset_by_perm(user, perm, model.objects.all()).values_list('pk', flat=True))
+                        self.assertEqual(filtered, expected, "%s for %s" % (perm, user))
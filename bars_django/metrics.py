@@ -0,0 +1,346 @@
+"""
+Per-request performance metrics.
+
+MetricsMiddleware records, for each view, the wall time, the time spent in the database, the number of
+SQL queries, the time spent building serializers' data and the response size, into in-process histograms. They are exposed at /metrics in Prometheus
+text format, to the addresses of METRICS_ALLOWED_IPS or with the METRICS_TOKEN bearer token.
+Serializers are only timed when they come from a generic view's get_serializer (that is, for the API's
+viewsets); queries are counted by a thin cursor wrapper; their SQL is only captured for a sample of the requests
+(METRICS_SLOW_REQUESTS_SAMPLE_RATE), and kept in a ring buffer readable by root bar admins at /metrics/slow/
+when these requests are slow.
+
+Permission evaluations are profiled too (see bars_core.perms.debug_perm): counted per view in the histograms,
+per logic class and permission in counters, and summed up in an X-Perm-Profile header when METRICS_PERM_PROFILE_HEADER is on (as in dev).
+
+Metrics are per process: with several workers, each one exposes its own histograms.
+"""
+import collections
+import json
+import random
+import threading
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection, connections, DEFAULT_DB_ALIAS
+from django.db.backends.utils import CursorWrapper, CursorDebugWrapper
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
+from rest_framework import exceptions, generics, permissions
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from bars_django.utils import get_root_bar
+from bars_core.perms import start_perm_profile, stop_perm_profile
+
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+metrics_definitions = [
+    # (name, help, buckets)
+    ('bars_request_duration_seconds', "Wall time of requests", TIME_BUCKETS),
+    ('bars_request_db_duration_seconds', "Time spent in SQL queries", TIME_BUCKETS),
+    ('bars_request_db_queries', "Number of SQL queries", QUERIES_BUCKETS),
+    ('bars_request_serializer_duration_seconds', "Time spent building the views' serializers' data (includes lazy queries)", TIME_BUCKETS),
+    ('bars_response_size_bytes', "Size of non-streamed responses", SIZE_BUCKETS),
+    ('bars_request_perm_checks', "Number of permission evaluations", QUERIES_BUCKETS),
+    ('bars_request_perm_duration_seconds', "Time spent evaluating permissions", TIME_BUCKETS),
+]
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        for b in self.buckets:
+            if value <= b:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsCollector(object):
+    """
+    Hold the histograms, labelled by view and method, and the ring buffer of slow requests.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = dict((name, {}) for (name, _, _) in metrics_definitions)
+            self.requests = {}
+            self.perm_checks = {}
+            self.perm_cache = {'hit': 0, 'miss': 0}
+            self.slow_requests = collections.deque(maxlen=settings.METRICS_SLOW_REQUESTS_BUFFER_SIZE)
+
+    def observe(self, labels, values, status):
+        with self.lock:
+            for (name, _, buckets) in metrics_definitions:
+                if values.get(name) is None:
+                    continue
+                h = self.histograms[name].get(labels)
+                if h is None:
+                    h = self.histograms[name][labels] = Histogram(buckets)
+                h.observe(values[name])
+            key = labels + (str(status),)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def add_perm_profile(self, profile):
+        with self.lock:
+            for (key, (count, duration)) in profile['checks'].items():
+                entry = self.perm_checks.setdefault(key, [0, 0.0])
+                entry[0] += count
+                entry[1] += duration
+            self.perm_cache['hit'] += profile['cache_hits']
+            self.perm_cache['miss'] += profile['cache_misses']
+
+    def add_slow_request(self, info):
+        with self.lock:
+            self.slow_requests.append(info)
+
+    def get_slow_requests(self):
+        with self.lock:
+            return list(self.slow_requests)
+
+    def render(self):
+        """
+        Return the metrics in Prometheus text format.
+        """
+        lines = []
+        with self.lock:
+            lines.append("# HELP bars_requests_total Number of requests")
+            lines.append("# TYPE bars_requests_total counter")
+            for ((view, method, status), n) in sorted(self.requests.items()):
+                lines.append('bars_requests_total{view="%s",method="%s",status="%s"} %d' % (_escape(view), method, status, n))
+
+            lines.append("# HELP bars_perm_checks_total Number of permission evaluations")
+            lines.append("# TYPE bars_perm_checks_total counter")
+            for ((logic, perm), (n, _)) in sorted(self.perm_checks.items()):
+                lines.append('bars_perm_checks_total{logic="%s",perm="%s"} %d' % (logic, _escape(perm), n))
+            lines.append("# HELP bars_perm_checks_seconds_total Time spent in permission evaluations (including nested ones)")
+            lines.append("# TYPE bars_perm_checks_seconds_total counter")
+            for ((logic, perm), (_, t)) in sorted(self.perm_checks.items()):
+                lines.append('bars_perm_checks_seconds_total{logic="%s",perm="%s"} %r' % (logic, _escape(perm), t))
+            lines.append("# HELP bars_perm_cache_total Lookups of users' permission index")
+            lines.append("# TYPE bars_perm_cache_total counter")
+            for (result, n) in sorted(self.perm_cache.items()):
+                lines.append('bars_perm_cache_total{result="%s"} %d' % (result, n))
+
+            for (name, help, _) in metrics_definitions:
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s histogram" % name)
+                for ((view, method), h) in sorted(self.histograms[name].items()):
+                    labels = 'view="%s",method="%s"' % (_escape(view), method)
+                    total = 0
+                    for (b, n) in zip(h.buckets + ('+Inf',), h.counts):
+                        total += n
+                        lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, b, total))
+                    lines.append('%s_sum{%s} %r' % (name, labels, h.sum))
+                    lines.append('%s_count{%s} %d' % (name, labels, h.count))
+        return "\n".join(lines) + "\n"
+
+collector = MetricsCollector()
+
+
+
+_local = threading.local()
+
+class _CountingCursorMixin(object):
+    # Count the queries and their time in the current request, if any, without keeping their SQL
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return super(_CountingCursorMixin, self).execute(sql, params)
+        finally:
+            _count_query(time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return super(_CountingCursorMixin, self).executemany(sql, param_list)
+        finally:
+            _count_query(time.time() - start)
+
+class CountingCursorWrapper(_CountingCursorMixin, CursorWrapper):
+    pass
+
+class CountingCursorDebugWrapper(_CountingCursorMixin, CursorDebugWrapper):
+    pass
+
+def _count_query(duration):
+    db = getattr(_local, 'db', None)
+    if db is not None:
+        db[0] += 1
+        db[1] += duration
+
+def _instrument_connection(conn):
+    """
+    Make the connection (of the current thread) return counting cursors.
+    """
+    if getattr(conn, '_metrics_instrumented', False):
+        return
+    conn.make_cursor = lambda cursor: CountingCursorWrapper(cursor, conn)
+    conn.make_debug_cursor = lambda cursor: CountingCursorDebugWrapper(cursor, conn)
+    conn._metrics_instrumented = True
+
+
+_timed_serializer_classes = {}
+
+def _timed_serializer_class(cls):
+    """
+    Return a subclass of a serializer class whose `.data` is timed into the current request's metrics.
+    """
+    timed = _timed_serializer_classes.get(cls)
+    if timed is None:
+        def data(self):
+            start = time.time()
+            try:
+                return super(timed, self).data
+            finally:
+                if getattr(_local, 'serializer_time', None) is not None:
+                    _local.serializer_time += time.time() - start
+        timed = type(cls)(cls.__name__, (cls,), {'data': property(data), '__module__': cls.__module__})
+        _timed_serializer_classes[cls] = timed
+    return timed
+
+def _instrument_serializers():
+    """
+    Make generic views' get_serializer return timed serializers while a request is measured. Other serializers,
+    and nested ones (which don't go through `.data`), are not affected.
+    """
+    base_get_serializer = generics.GenericAPIView.get_serializer
+    if getattr(base_get_serializer, 'instrumented', False):
+        return
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = base_get_serializer(self, *args, **kwargs)
+        if getattr(_local, 'serializer_time', None) is not None:
+            serializer.__class__ = _timed_serializer_class(serializer.__class__)
+        return serializer
+    get_serializer.instrumented = True
+    generics.GenericAPIView.get_serializer = get_serializer
+
+
+def format_perm_profile(profile):
+    """
+    Return a one-line JSON summary of a permission profile, for the X-Perm-Profile debug header.
+    """
+    return json.dumps({
+        'checks': sum(n for (n, _) in profile['checks'].values()),
+        'time_ms': round(profile['time'] * 1000, 3),
+        'cache_hits': profile['cache_hits'],
+        'cache_misses': profile['cache_misses'],
+        'by_logic': dict(("%s %s" % key, [n, round(t * 1000, 3)]) for (key, (n, t)) in profile['checks'].items()),
+    }, sort_keys=True)
+
+
+class MetricsMiddleware(object):
+    """
+    Define a Django middleware that records performance metrics of every request into the collector.
+    It should come first in MIDDLEWARE_CLASSES, to measure the other middlewares too.
+    """
+    def __init__(self):
+        _instrument_serializers()
+
+    def process_request(self, request):
+        request._metrics_start = time.time()
+        request._metrics_view = None
+        _instrument_connection(connections[DEFAULT_DB_ALIAS])
+        _local.db = [0, 0.0]
+        _local.serializer_time = 0.0
+        # The SQL is only captured for sampled requests, to be kept if they turn out to be slow
+        request._metrics_capture_sql = random.random() < settings.METRICS_SLOW_REQUESTS_SAMPLE_RATE
+        if request._metrics_capture_sql:
+            request._metrics_debug_cursor = connection.force_debug_cursor
+            request._metrics_queries_start = len(connection.queries_log)
+            connection.force_debug_cursor = True
+        start_perm_profile()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = getattr(request, 'resolver_match', None)
+        request._metrics_view = (match and match.url_name) or getattr(view_func, '__name__', 'unknown')
+
+    def process_response(self, request, response):
+        start = getattr(request, '_metrics_start', None)
+        if start is None:
+            return response
+        duration = time.time() - start
+
+        (n_queries, db_time), _local.db = _local.db, None
+        serializer_time, _local.serializer_time = _local.serializer_time, None
+        if request._metrics_capture_sql:
+            connection.force_debug_cursor = request._metrics_debug_cursor
+            queries = list(islice(connection.queries_log, request._metrics_queries_start, None))
+        perm_profile = stop_perm_profile()
+
+        view = request._metrics_view or 'unresolved'
+        collector.observe((view, request.method), {
+            'bars_request_duration_seconds': duration,
+            'bars_request_db_duration_seconds': db_time,
+            'bars_request_db_queries': n_queries,
+            'bars_request_serializer_duration_seconds': serializer_time,
+            'bars_response_size_bytes': None if response.streaming else len(response.content),
+            'bars_request_perm_checks': sum(n for (n, _) in perm_profile['checks'].values()),
+            'bars_request_perm_duration_seconds': perm_profile['time'],
+        }, response.status_code)
+        collector.add_perm_profile(perm_profile)
+        if settings.METRICS_PERM_PROFILE_HEADER:
+            response['X-Perm-Profile'] = format_perm_profile(perm_profile)
+
+        if request._metrics_capture_sql and duration >= settings.METRICS_SLOW_REQUESTS_THRESHOLD:
+            collector.add_slow_request({
+                'timestamp': start,
+                'method': request.method,
+                'path': request.get_full_path(),
+                'view': view,
+                'status': response.status_code,
+                'duration': duration,
+                'db_time': db_time,
+                'queries': queries,
+            })
+
+        return response
+
+
+
+class MetricsView(APIView):
+    """
+    Expose the collected metrics in Prometheus text format, to the addresses of METRICS_ALLOWED_IPS
+    (the direct peer, proxies are not trusted) or with an "Authorization: Bearer <METRICS_TOKEN>" header.
+    """
+    permission_classes = (permissions.AllowAny,)
+    authentication_classes = ()
+
+    def get(self, request, format=None):
+        token = settings.METRICS_TOKEN
+        if not (request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS or
+                (token and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer %s' % token))):
+            raise exceptions.PermissionDenied()
+        return HttpResponse(collector.render(), content_type='text/plain; version=0.0.4')
+
+
+class SlowRequestsView(APIView):
+    """
+    Return the sampled slowest requests, with their SQL queries. Restricted to root bar admins.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, format=None):
+        if not request.user.has_perm('bars_core.change_bar', get_root_bar()):
+            raise exceptions.PermissionDenied()
+        return Response(collector.get_slow_requests(), 200)
@@ -0,0 +1,27 @@
+from .common import *
+
+# Settings for the benchmark commands (generate_load_data, benchmark_api).
+# Uses SQLite by default; set BENCH_DB=mysql (and BENCH_DB_NAME, BENCH_DB_HOST, BENCH_DB_USER, BENCH_DB_PASSWORD)
+# to run against MySQL.
+
+ALLOWED_HOSTS = ['testserver', 'localhost']
+
+if os.environ.get('BENCH_DB') == 'mysql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.mysql',
+            'NAME': os.environ.get('BENCH_DB_NAME', 'chocapix_bench'),
+            'HOST': os.environ.get('BENCH_DB_HOST', 'localhost'),
+            'USER': os.environ.get('BENCH_DB_USER', 'root'),
+            'PASSWORD': os.environ.get('BENCH_DB_PASSWORD', ''),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('BENCH_DB_NAME', 'db_bench.sqlite3'),
+        }
+    }
+
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
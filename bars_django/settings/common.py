@@ -75,6 +75,7 @@ INSTALLED_APPS = (
 
 
 MIDDLEWARE_CLASSES = (
+    'bars_django.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -129,7 +130,7 @@ REST_FRAMEWORK = {
         # 'rest_framework.permissions.DjangoModelPermissionsOrAnonReadOnly',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_jwt.authentication.JSONWebTokenAuthentication',
+        'bars_core.authentication.CachedJSONWebTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',  # TODO: remove
         'rest_framework.authentication.BasicAuthentication',  # TODO: remove
     ),
@@ -148,6 +149,19 @@ import datetime
 JWT_AUTH = {
     'JWT_EXPIRATION_DELTA': datetime.timedelta(hours=7 * 24),  # Todo: temporary
 }
+# In-process caches of decoded tokens and authenticated users (see bars_core.authentication)
+JWT_CACHE_SIZE = 1000
+JWT_CACHE_TTL = 60  # seconds
+# Login attempts and timestamps are written in batches (see bars_core.auth.LoginBuffer)
+LOGIN_BUFFER_SIZE = 20
+LOGIN_BUFFER_MAX_AGE = 10  # seconds
+# Failed login attempts allowed in a sliding window, checked before hashing passwords (see bars_core.auth.LoginThrottle)
+LOGIN_THROTTLE_WINDOW = 300  # seconds
+LOGIN_THROTTLE_MAX_PER_IP = 50
+LOGIN_THROTTLE_MAX_PER_USERNAME = 10
+LOGIN_THROTTLE_SYNC_INTERVAL = 60  # seconds
+# Addresses of the reverse proxies whose X-Forwarded-For header is trusted to give the client's IP (see get_client_ip)
+TRUSTED_PROXIES = ()
 
 # Permissions
 
@@ -172,6 +186,22 @@ PROXIES = {}
 # IRC hook for BugReport
 IRC_HOOK = False
 
+# In-process cache of Bar and BarSettings (see bars_django.utils.get_cached_bar)
+BAR_CACHE_TTL = 60  # seconds
+# In-process caches of BuyItems by barcode and of their prices (see bars_items.models.buyitem.get_buyitems_by_barcode)
+BARCODE_CACHE_SIZE = 10000
+BARCODE_CACHE_TTL = 300  # seconds
+# In-process search index of the item catalog (see bars_items.search)
+ITEM_SEARCH_INDEX_TTL = 600  # seconds
+
+# Performance metrics (see bars_django.metrics)
+METRICS_SLOW_REQUESTS_THRESHOLD = 1.0  # seconds
+METRICS_SLOW_REQUESTS_SAMPLE_RATE = 0.05  # Fraction of the requests whose SQL is captured, kept if they are slow
+METRICS_SLOW_REQUESTS_BUFFER_SIZE = 50
+METRICS_PERM_PROFILE_HEADER = False  # Add an X-Perm-Profile header to responses
+METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')  # Addresses allowed to read /metrics/
+METRICS_TOKEN = None  # Bearer token allowed to read /metrics/ from anywhere
+
 # Swagger
 SWAGGER_SETTINGS = {
     'enabled_methods': ['get', 'post', 'put', 'delete']
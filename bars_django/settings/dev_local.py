@@ -4,6 +4,8 @@ DEBUG = True
 
 TEMPLATE_DEBUG = True
 
+METRICS_PERM_PROFILE_HEADER = True
+
 INSTALLED_APPS = INSTALLED_APPS + (
     'debug_toolbar',
 )
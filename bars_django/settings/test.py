@@ -17,3 +17,10 @@ DATABASES = {
 
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+# Test transactions are rolled back without signals, so cached bars and users could outlive them
+BAR_CACHE_TTL = 0
+JWT_CACHE_TTL = 0
+BARCODE_CACHE_TTL = 0
+ITEM_SEARCH_INDEX_TTL = 0
+LOGIN_BUFFER_SIZE = 1
@@ -0,0 +1,146 @@
+import json
+
+from django.test.utils import override_settings
+from rest_framework.test import APITestCase
+
+from bars_django.utils import get_root_bar, LRUCache
+from bars_django.metrics import collector
+from bars_core.models.bar import Bar
+from bars_core.models.user import User
+from bars_core.models.role import Role
+
+
+def reload(obj):
+    return obj.__class__.objects.get(pk=obj.pk)
+
+class MetricsTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(MetricsTests, self).setUpTestData()
+        get_root_bar._cache = None  # Workaround
+        self.bar, _ = Bar.objects.get_or_create(id='barjone')
+
+        self.user, _ = User.objects.get_or_create(username='user')
+        self.user.role_set.all().delete()
+        self.user = reload(self.user)
+
+        self.admin, _ = User.objects.get_or_create(username='admin')
+        Role.objects.get_or_create(name='admin', bar=get_root_bar(), user=self.admin)
+        self.admin = reload(self.admin)
+
+    def setUp(self):
+        collector.reset()
+
+
+    def test_metrics(self):
+        self.client.get('/sellitem/?bar=barjone')
+        self.client.get('/sellitem/?bar=barjone')
+        self.client.get('/bar/barjone/')
+
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        lines = response.content.splitlines()
+        self.assertIn('bars_requests_total{view="sellitem-list",method="GET",status="200"} 2', lines)
+        self.assertIn('bars_request_duration_seconds_count{view="sellitem-list",method="GET"} 2', lines)
+        self.assertIn('bars_request_db_queries_bucket{view="bar-detail",method="GET",le="+Inf"} 1', lines)
+        self.assertIn('# TYPE bars_response_size_bytes histogram', lines)
+
+    def test_serializer_time(self):
+        import time
+        from mock import patch
+        from bars_core.models.bar import BarSerializer
+
+        to_representation = BarSerializer.to_representation
+        def slow_to_representation(self, instance):
+            time.sleep(0.01)
+            return to_representation(self, instance)
+
+        with patch.object(BarSerializer, 'to_representation', slow_to_representation):
+            response = self.client.get('/bar/barjone/')
+        self.assertEqual(response.data['id'], 'barjone')
+
+        lines = self.client.get('/metrics/').content.splitlines()
+        self.assertIn('bars_request_serializer_duration_seconds_count{view="bar-detail",method="GET"} 1', lines)
+        self.assertIn('bars_request_serializer_duration_seconds_bucket{view="bar-detail",method="GET",le="0.005"} 0', lines)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_access(self):
+        response = self.client.get('/metrics/', REMOTE_ADDR='10.1.2.3')
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get('/metrics/', REMOTE_ADDR='10.1.2.3', HTTP_X_FORWARDED_FOR='127.0.0.1')
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get('/metrics/', REMOTE_ADDR='10.1.2.3', HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get('/metrics/', REMOTE_ADDR='10.1.2.3', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_SLOW_REQUESTS_THRESHOLD=0, METRICS_SLOW_REQUESTS_SAMPLE_RATE=0)
+    def test_queries_counted_without_sql(self):
+        self.client.get('/bar/barjone/')
+        self.assertEqual(collector.get_slow_requests(), [])
+
+        # Same count as the captured SQL of a sampled request
+        with self.settings(METRICS_SLOW_REQUESTS_SAMPLE_RATE=1):
+            self.client.get('/bar/barjone/')
+        n_queries = len(collector.get_slow_requests()[0]['queries'])
+        self.assertGreater(n_queries, 0)
+        lines = self.client.get('/metrics/').content.splitlines()
+        self.assertIn('bars_request_db_queries_sum{view="bar-detail",method="GET"} %d' % (2 * n_queries), lines)
+
+    @override_settings(METRICS_SLOW_REQUESTS_THRESHOLD=0, METRICS_SLOW_REQUESTS_SAMPLE_RATE=1)
+    def test_slow_requests(self):
+        self.client.get('/bar/barjone/')
+
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get('/metrics/slow/')
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get('/metrics/slow/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[0]['view'], 'bar-detail')
+        self.assertGreater(len(response.data[0]['queries']), 0)
+
+    @override_settings(METRICS_PERM_PROFILE_HEADER=True)
+    def test_perm_profile(self):
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get('/metrics/slow/')
+        profile = json.loads(response['X-Perm-Profile'])
+        self.assertGreater(profile['checks'], 0)
+        self.assertEqual(profile['checks'], sum(n for (n, _) in profile['by_logic'].values()))
+
+        with self.settings(METRICS_PERM_PROFILE_HEADER=False):
+            response = self.client.get('/metrics/')
+        self.assertFalse(response.has_header('X-Perm-Profile'))
+        lines = response.content.splitlines()
+        self.assertIn('# TYPE bars_perm_checks_total counter', lines)
+        self.assertIn('# TYPE bars_request_perm_checks histogram', lines)
+        self.assertTrue(any(l.startswith('bars_perm_cache_total{result="miss"}') for l in lines))
+
+
+class LRUCacheTests(APITestCase):
+    def test_lru_cache(self):
+        import time
+        from mock import patch
+
+        cache = LRUCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # 'b' is the least recently used
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+        cache.delete('a')
+        self.assertEqual(cache.get('a', 'default'), 'default')
+
+        now = time.time()
+        with patch('time.time', return_value=now + 61):
+            self.assertIsNone(cache.get('c'))
+
+        cache.set('d', 4)
+        cache.clear()
+        self.assertIsNone(cache.get('d'))
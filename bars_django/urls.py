@@ -18,6 +18,7 @@ from bars_items.models.stockitem import StockItemViewSet
 from bars_items.models.itemdetails import ItemDetailsViewSet
 from bars_items.models.buyitem import BuyItemViewSet, BuyItemPriceViewSet
 from bars_items.models.suggesteditem import SuggestedItemViewSet
+from bars_items.search import ItemSearchView
 
 from bars_transactions.views import TransactionViewSet
 
@@ -27,6 +28,10 @@ from bars_bugtracker.models import BugReportViewSet
 
 from bars_menus.models import MenuViewSet
 
+from bars_stats.views import StatsBatchView
+
+from bars_django.metrics import MetricsView, SlowRequestsView
+
 router = routers.DefaultRouter()
 
 router.register('bar', BarViewSet)
@@ -59,6 +64,10 @@ urlpatterns = patterns(
     # url(r'^api-token-auth/', 'rest_framework_jwt.views.obtain_jwt_token'),
     url(r'^api-token-auth/', 'bars_core.auth.obtain_jwt_token'),
     url(r'^reset-password/$', ResetPasswordView.as_view()),
+    url(r'^item/search/$', ItemSearchView.as_view()),
+    url(r'^stats/batch/$', StatsBatchView.as_view()),
+    url(r'^metrics/$', MetricsView.as_view()),
+    url(r'^metrics/slow/$', SlowRequestsView.as_view()),
     url(r'^docs/', include('rest_framework_swagger.urls')),
     url(r'^', include(router.urls)),
 )
@@ -44,6 +44,39 @@ get_root_bar._cache = None
 
 
 
+import copy
+import time
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+def get_cached_bar(bar_id):
+    """
+    Return a Bar, with its settings loaded, from an in-process cache.
+    Entries are dropped when a Bar or BarSettings is saved or deleted in this process, and after BAR_CACHE_TTL seconds
+    (for changes made by other processes). A copy is returned, so that callers can't alter the cached instances.
+    Raise Bar.DoesNotExist if the bar doesn't exist.
+    """
+    entry = get_cached_bar._cache.get(bar_id)
+    if entry is None or time.time() - entry[0] > settings.BAR_CACHE_TTL:
+        from bars_core.models.bar import Bar
+        entry = (time.time(), Bar.objects.select_related('settings').get(pk=bar_id))
+        get_cached_bar._cache[bar_id] = entry
+
+    bar = copy.copy(entry[1])
+    try:
+        bar.settings = copy.copy(entry[1].settings)
+    except ObjectDoesNotExist:
+        pass
+    return bar
+get_cached_bar._cache = {}
+
+def invalidate_cached_bar(bar_id=None):
+    if bar_id is None:
+        get_cached_bar._cache.clear()
+    else:
+        get_cached_bar._cache.pop(bar_id, None)
+
+
+
 from django.http import Http404
 class BarMiddleware(object):
     """
@@ -56,7 +89,7 @@ class BarMiddleware(object):
             request.bar = None
         else:
             try:
-                request.bar = Bar.objects.get(pk=bar)
+                request.bar = get_cached_bar(bar)
             except Bar.DoesNotExist:
                 raise Http404("Unknown bar: %s" % bar)
         return None
@@ -92,10 +125,109 @@ class CurrentBarCreateOnlyDefault:
 def get_client_ip(request):
     """
     Return requesting person's IP.
+    X-Forwarded-For is only read for requests coming from TRUSTED_PROXIES, since clients can set it to anything:
+    the client is then the last address of the header that is not a trusted proxy.
     """
-    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-    if x_forwarded_for:
-        ip = x_forwarded_for.split(',')[0]
-    else:
-        ip = request.META.get('REMOTE_ADDR')
+    ip = request.META.get('REMOTE_ADDR')
+    if ip in settings.TRUSTED_PROXIES:
+        forwarded = [a.strip() for a in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if a.strip()]
+        for addr in reversed(forwarded):
+            ip = addr
+            if addr not in settings.TRUSTED_PROXIES:
+                break
     return ip
+
+def is_private_ip(ip):
+    """
+    Return whether an IP is a loopback, private or link-local address (eg. a reverse proxy on the same host or network).
+    """
+    ip = (ip or '').lower()
+    if ip.startswith('::ffff:'):
+        ip = ip[len('::ffff:'):]
+    if ':' in ip:
+        return ip == '::1' or ip.startswith(('fc', 'fd', 'fe80:'))
+    parts = ip.split('.')
+    return parts[0] in ('10', '127') or parts[:2] == ['192', '168'] or parts[:2] == ['169', '254'] or \
+        (parts[0] == '172' and len(parts) > 1 and parts[1].isdigit() and 16 <= int(parts[1]) <= 31)
+
+
+
+import json
+from rest_framework import renderers
+class CSVRenderer(renderers.BaseRenderer):
+    """
+    Define a renderer for views which stream CSV. It is only used for content negotiation (eg. "?format=csv"),
+    streamed responses are not rendered; error messages are rendered as plain text.
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data if isinstance(data, basestring) else json.dumps(data)
+
+class JSONLinesRenderer(CSVRenderer):
+    """
+    Same as CSVRenderer, for views which stream JSON lines (eg. "?format=jsonl").
+    """
+    media_type = 'application/x-jsonlines'
+    format = 'jsonl'
+
+
+
+import threading
+from collections import OrderedDict
+class LRUCache(object):
+    """
+    Thread-safe in-process LRU cache, whose entries also expire after `ttl` seconds.
+    """
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return default
+            self.data[key] = entry  # Move to the end
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (time.time(), value)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+
+import multiprocessing
+def map_bars(func, bar_ids, processes=1):
+    """
+    Return [func(bar_id) for bar_id in bar_ids], computed by a pool of `processes` worker processes if more than one.
+    `func` must be picklable (a module-level function, or a functools.partial of one). Database connections are
+    closed before forking, so that each worker opens its own. SQLite doesn't allow concurrent writers, so bars are
+    processed sequentially with it.
+    """
+    from django.db import connection, connections
+    bar_ids = list(bar_ids)
+    if processes <= 1 or len(bar_ids) <= 1 or connection.vendor == 'sqlite':
+        return [func(bar_id) for bar_id in bar_ids]
+
+    connections.close_all()
+    pool = multiprocessing.Pool(min(processes, len(bar_ids)))
+    try:
+        return pool.map(func, bar_ids, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -6,6 +6,7 @@ from django import forms
 
 from bars_items.models.buyitem import BuyItem, BuyItemPrice
 from bars_items.models.itemdetails import ItemDetails
+from bars_items.models.pricehistory import StockItemPriceHistory, BuyItemPriceHistory
 from bars_items.models.sellitem import SellItem
 from bars_items.models.stockitem import StockItem
 from bars_items.models.suggesteditem import SuggestedItem
@@ -23,3 +24,5 @@ admin.site.register(ItemDetails, ItemDetailsAdmin)
 admin.site.register(SellItem)
 admin.site.register(StockItem)
 admin.site.register(SuggestedItem)
+admin.site.register(StockItemPriceHistory)
+admin.site.register(BuyItemPriceHistory)
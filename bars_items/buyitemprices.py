@@ -0,0 +1,83 @@
+"""
+Reset of the bars' buy prices.
+
+A BuyItemPrice is reset to the price of its bar's StockItem of the same ItemDetails, times the BuyItem's quantity.
+Each bar is processed in one database transaction: one query joins its prices to its stockitems, and the prices
+that changed are written with batched UPDATEs. Bars can be processed in parallel (see map_bars).
+Prices whose ItemDetails have no StockItem in the bar (orphans) are left unchanged, and reported.
+"""
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Case, When, Value, FloatField
+from django.utils import timezone
+
+from bars_django.utils import map_bars
+from bars_core.models.bar import Bar
+from bars_items.models.buyitem import BuyItemPrice, buyitemprice_cache
+from bars_items.models.pricehistory import BuyItemPriceHistory
+
+BATCH_SIZE = 300  # Prices per UPDATE; SQLite allows 999 parameters per query
+
+
+def compute_buyitemprices(bar_id):
+    """
+    Return ([(buyitemprice id, buyitem id, new price)] for the prices to change, number of unchanged prices, orphans).
+    """
+    rows = BuyItemPrice.objects.filter(bar=bar_id, buyitem__details__stockitem__bar=bar_id).values_list(
+        'id', 'buyitem', 'price', 'buyitem__itemqty', 'buyitem__details__stockitem__price')
+    changes = []
+    unchanged = 0
+    for (bip_id, buyitem_id, price, itemqty, stockitem_price) in rows:
+        if price == stockitem_price * itemqty:
+            unchanged += 1
+        else:
+            changes.append((bip_id, buyitem_id, stockitem_price * itemqty))
+
+    orphans = BuyItemPrice.objects.filter(bar=bar_id).exclude(buyitem__details__stockitem__bar=bar_id).order_by('id').values_list(
+        'id', 'buyitem', 'buyitem__details', 'buyitem__details__name', 'price')
+    orphans = [{'buyitemprice': bip_id, 'buyitem': buyitem_id, 'details': details_id, 'name': name, 'price': price}
+               for (bip_id, buyitem_id, details_id, name, price) in orphans]
+    return changes, unchanged, orphans
+
+
+def write_buyitemprices(bar_id, changes):
+    now = timezone.now()
+    for i in range(0, len(changes), BATCH_SIZE):
+        batch = changes[i:i + BATCH_SIZE]
+        BuyItemPrice.objects.filter(pk__in=[bip_id for (bip_id, _, _) in batch]).update(
+            price=Case(*[When(pk=bip_id, then=Value(price)) for (bip_id, _, price) in batch], output_field=FloatField()),
+            last_modified=now)
+    # Queryset updates don't send signals: the price history and caches are updated here
+    BuyItemPriceHistory.record([(bip_id, price) for (bip_id, _, price) in changes], now)
+    for (_, buyitem_id, _) in changes:
+        buyitemprice_cache.delete((bar_id, buyitem_id))
+
+
+def reset_bar_buyitemprices(bar_id, dry_run=False):
+    """
+    Reset the buy prices of a bar, and return a report:
+    `{bar, updated: [{buyitemprice, price}], unchanged, orphans: [{buyitemprice, buyitem, details, name, price}]}`,
+    plus `error` if the bar failed. With `dry_run`, nothing is written.
+    """
+    report = {'bar': bar_id, 'updated': [], 'unchanged': 0, 'orphans': []}
+    try:
+        with transaction.atomic():
+            changes, report['unchanged'], report['orphans'] = compute_buyitemprices(bar_id)
+            if changes and not dry_run:
+                write_buyitemprices(bar_id, changes)
+    except Exception as e:
+        report['error'] = "%s: %s" % (e.__class__.__name__, e)
+        return report
+
+    report['updated'] = [{'buyitemprice': bip_id, 'price': price} for (bip_id, _, price) in changes]
+    return report
+
+
+def reset_buyitemprices(bar_ids=None, dry_run=False, processes=1):
+    """
+    Reset the buy prices in the given bars (default: all), in parallel if `processes` > 1, and return the bars' reports.
+    """
+    if bar_ids is None:
+        bar_ids = Bar.objects.values_list('id', flat=True)
+    return map_bars(partial(reset_bar_buyitemprices, dry_run=dry_run), bar_ids, processes)
@@ -0,0 +1,84 @@
+"""
+Snapshot of a bar's whole catalog, for clients that keep a local copy of it (see BarViewSet.catalog).
+
+The snapshot holds the bar's SellItems, StockItems and BuyItemPrices, and the ItemDetails and BuyItems it uses (those
+of the details of its stockitems, and those it has prices for), each as a list of fields and a list of rows of values. Its version is derived from the latest `last_modified`
+and the number of rows of each table, so that it also changes when rows are deleted.
+A delta holds only the rows modified since a given date, along with the ids of all the rows, to detect deletions;
+rows of the shared tables that became used since then (by new or modified stockitems and prices) are included too.
+"""
+import hashlib
+
+from django.db.models import Max, Count, Q
+
+from bars_items.models.sellitem import SellItem
+from bars_items.models.stockitem import StockItem
+from bars_items.models.itemdetails import ItemDetails
+from bars_items.models.buyitem import BuyItem, BuyItemPrice
+
+
+catalog_models = [
+    # (key, model, shared): the bar's own rows are filtered by bar, those of shared tables by _get_used_rows(shared),
+    # shared being (lookup of the row's details, field of BuyItemPrice referencing the row)
+    ('sellitems', SellItem, None),
+    ('stockitems', StockItem, None),
+    ('itemdetails', ItemDetails, ('pk', 'buyitem__details')),
+    ('buyitems', BuyItem, ('details', 'buyitem')),
+    ('buyitemprices', BuyItemPrice, None),
+]
+
+
+def _get_used_rows(shared, bar, since=None):
+    """
+    Return a Q selecting the rows of a shared table used by the bar's stockitems and prices (modified since `since`).
+    """
+    (details_lookup, price_field) = shared
+    stockitems = StockItem._base_manager.filter(bar=bar)
+    prices = BuyItemPrice._base_manager.filter(bar=bar)
+    if since is not None:
+        stockitems = stockitems.filter(last_modified__gte=since)
+        prices = prices.filter(last_modified__gte=since)
+    return Q(**{details_lookup + '__in': stockitems.values('details')}) | Q(pk__in=prices.values(price_field))
+
+
+def _get_queryset(model, shared, bar):
+    # Base managers, without the default select_related and prefetch_related
+    qs = model._base_manager.all()
+    if shared is None:
+        return qs.filter(bar=bar)
+    return qs.filter(_get_used_rows(shared, bar))
+
+
+def get_catalog_version(bar):
+    """
+    Return (version, last_modified) of the bar's catalog, last_modified being the latest modification date of its rows.
+    """
+    state = []
+    last_modified = None
+    for (key, model, shared) in catalog_models:
+        agg = _get_queryset(model, shared, bar).aggregate(last_modified=Max('last_modified'), count=Count('id'))
+        state.append((key, agg['last_modified'] and agg['last_modified'].isoformat(), agg['count']))
+        if agg['last_modified'] is not None and (last_modified is None or agg['last_modified'] > last_modified):
+            last_modified = agg['last_modified']
+    return hashlib.sha1(repr(state)).hexdigest()[:20], last_modified
+
+
+def get_catalog(bar, since=None):
+    """
+    Return {key: {'fields': [...], 'rows': [[...], ...]}} for the models of the catalog, with only the rows
+    modified since `since` if given; each entry then also has the 'ids' of all the rows.
+    """
+    catalog = {}
+    for (key, model, shared) in catalog_models:
+        fields = [f.name for f in model._meta.concrete_fields if f.name != 'bar']
+        qs = _get_queryset(model, shared, bar)
+        entry = {'fields': fields}
+        if since is not None:
+            entry['ids'] = list(qs.order_by('id').values_list('id', flat=True))
+            modified = Q(last_modified__gte=since)
+            if shared is not None:
+                modified |= _get_used_rows(shared, bar, since)
+            qs = qs.filter(modified)
+        entry['rows'] = [list(row) for row in qs.order_by('id').values_list(*fields)]
+        catalog[key] = entry
+    return catalog
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_fuzzy_values(apps, schema_editor):
+    # Same computation as SellItem.calc_qty and calc_price
+    SellItem = apps.get_model('bars_items', 'SellItem')
+    StockItem = apps.get_model('bars_items', 'StockItem')
+
+    stockitems = {}
+    for si in StockItem.objects.all():
+        stockitems.setdefault(si.sellitem_id, []).append(si)
+
+    for item in SellItem.objects.all():
+        sis = [(si.qty * si.unit_factor, si.price * (1 + item.tax) / si.unit_factor) for si in stockitems.get(item.id, [])]
+        positive_qty = sum(q for (q, _) in sis if q > 0)
+        negative_qty = sum(q for (q, _) in sis if q < 0)
+        if positive_qty > 0:
+            price = sum(p * q / positive_qty for (q, p) in sis if q > 0)
+        elif negative_qty < 0:
+            price = sum(p * q / negative_qty for (q, p) in sis if q < 0)
+        else:
+            price = sum(p / len(sis) for (_, p) in sis)
+        SellItem.objects.filter(pk=item.pk).update(fuzzy_qty=sum(q for (q, _) in sis), fuzzy_price=price)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bars_items', '0010_sellitem_sell_fraction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sellitem',
+            name='fuzzy_price',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='sellitem',
+            name='fuzzy_qty',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(set_fuzzy_values, migrations.RunPython.noop),
+    ]
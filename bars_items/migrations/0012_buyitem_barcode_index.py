@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bars_items', '0011_sellitem_fuzzy_values'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='buyitem',
+            name='barcode',
+            field=models.CharField(max_length=25, blank=True, db_index=True),
+        ),
+    ]
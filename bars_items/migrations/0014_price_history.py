@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils import timezone
+import django.utils.timezone
+
+
+def seed_price_history(apps, schema_editor):
+    # Earlier prices are lost: the current ones are the oldest known
+    now = timezone.now()
+    for (model_name, history_name) in [('StockItem', 'StockItemPriceHistory'), ('BuyItemPrice', 'BuyItemPriceHistory')]:
+        model = apps.get_model('bars_items', model_name)
+        history = apps.get_model('bars_items', history_name)
+        history.objects.bulk_create([history(target_id=target_id, price=price, timestamp=now)
+                                     for (target_id, price) in model.objects.values_list('id', 'price')], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bars_items', '0013_catalog_last_modified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuyItemPriceHistory',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('price', models.FloatField()),
+                ('target', models.ForeignKey(to='bars_items.BuyItemPrice')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockItemPriceHistory',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('price', models.FloatField()),
+                ('target', models.ForeignKey(to='bars_items.StockItem')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='stockitempricehistory',
+            index_together=set([('target', 'timestamp')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='buyitempricehistory',
+            index_together=set([('target', 'timestamp')]),
+        ),
+        migrations.RunPython(seed_price_history, migrations.RunPython.noop),
+    ]
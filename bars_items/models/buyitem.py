@@ -1,15 +1,21 @@
+import copy
+from collections import Counter
+from django.conf import settings
 from django.http import Http404
-from django.db import models
-from django.db.models import Prefetch
-from rest_framework import viewsets, serializers, permissions
+from django.db import models, transaction
+from django.db.models import Prefetch, Sum, Count, F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework import viewsets, serializers, permissions, decorators, exceptions
 from rest_framework.response import Response
 from rest_framework.serializers import ValidationError
 from rest_framework.fields import CreateOnlyDefault
 
-from bars_django.utils import VirtualField, permission_logic, CurrentBarCreateOnlyDefault
+from bars_django.utils import VirtualField, permission_logic, CurrentBarCreateOnlyDefault, LRUCache, get_root_bar
 from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLogic, RootBarRolePermissionLogic, RootBarPermissionsOrAnonReadOnly
 from bars_core.models.bar import Bar
-from bars_items.models.itemdetails import ItemDetails
+from bars_items.models.itemdetails import ItemDetails, ItemDetailsSerializer
 
 
 @permission_logic(BarRolePermissionLogic())
@@ -20,6 +26,14 @@ class BuyItemPrice(models.Model):
     bar = models.ForeignKey(Bar)
     buyitem = models.ForeignKey('BuyItem')
     price = models.FloatField(default=0)
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(BuyItemPrice, cls).from_db(db, field_names, values)
+        # To record price changes (see bars_items.models.pricehistory)
+        instance._loaded_price = instance.__dict__.get('price')
+        return instance
 
     def __unicode__(self):
         return "%s (%s)" % (unicode(self.buyitem), unicode(self.bar))
@@ -29,14 +43,86 @@ class BuyItemPrice(models.Model):
 class BuyItem(models.Model):
     class Meta:
         app_label = 'bars_items'
-    barcode = models.CharField(max_length=25, blank=True)
+    barcode = models.CharField(max_length=25, blank=True, db_index=True)
     details = models.ForeignKey(ItemDetails)
     itemqty = models.FloatField(default=1)
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     def __unicode__(self):
         return "%s * %f" % (unicode(self.details), self.itemqty)
 
 
+# barcode -> BuyItem with its details; unknown barcodes are not cached, since they may be registered by other processes
+barcode_cache = LRUCache(settings.BARCODE_CACHE_SIZE, settings.BARCODE_CACHE_TTL)
+# (bar id, buyitem id) -> BuyItemPrice; missing prices are not cached either
+buyitemprice_cache = LRUCache(settings.BARCODE_CACHE_SIZE, settings.BARCODE_CACHE_TTL)
+_missing = object()
+
+def get_buyitems_by_barcode(barcodes):
+    """
+    Return {barcode: BuyItem or None}, with the BuyItems' details loaded, from an in-process cache.
+    The barcodes missing from the cache are fetched in one query; if several BuyItems share a barcode, the oldest one is returned.
+    Unknown barcodes are fetched again on each call, so that a BuyItem registered by another process is seen at once.
+    Entries are dropped when a BuyItem or an ItemDetails is saved or deleted in this process, and after BARCODE_CACHE_TTL
+    seconds (for changes made by other processes). Copies are returned, so that callers can't alter the cached instances.
+    """
+    buyitems = {}
+    for barcode in set(b for b in barcodes if b):
+        buyitems[barcode] = barcode_cache.get(barcode, _missing)
+
+    missing = [b for (b, buyitem) in buyitems.items() if buyitem is _missing]
+    if missing:
+        fetched = dict((b, None) for b in missing)
+        for buyitem in BuyItem.objects.filter(barcode__in=missing).select_related('details').order_by('-id'):
+            fetched[buyitem.barcode] = buyitem
+        for (barcode, buyitem) in fetched.items():
+            if buyitem is not None:
+                barcode_cache.set(barcode, buyitem)
+        buyitems.update(fetched)
+
+    for (barcode, buyitem) in buyitems.items():
+        if buyitem is not None:
+            buyitems[barcode] = copy.copy(buyitem)
+            buyitems[barcode].details = copy.copy(buyitem.details)
+    return buyitems
+
+def get_buyitemprices(bar_id, buyitem_ids):
+    """
+    Return {buyitem id: BuyItemPrice or None} for a bar, from an in-process cache, fetching the missing ones in one query.
+    Entries are dropped when the BuyItemPrice is saved or deleted in this process, and after BARCODE_CACHE_TTL seconds;
+    missing prices are fetched again on each call.
+    """
+    prices = {}
+    for buyitem_id in set(buyitem_ids):
+        prices[buyitem_id] = buyitemprice_cache.get((bar_id, buyitem_id), _missing)
+
+    missing = [i for (i, bip) in prices.items() if bip is _missing]
+    if missing:
+        fetched = dict((i, None) for i in missing)
+        for bip in BuyItemPrice.objects.filter(bar_id=bar_id, buyitem_id__in=missing):
+            fetched[bip.buyitem_id] = bip
+        for (buyitem_id, bip) in fetched.items():
+            if bip is not None:
+                buyitemprice_cache.set((bar_id, buyitem_id), bip)
+        prices.update(fetched)
+
+    return dict((i, copy.copy(bip)) for (i, bip) in prices.items())
+
+
+@receiver(post_save, sender=BuyItem)
+@receiver(post_delete, sender=BuyItem)
+@receiver(post_save, sender=ItemDetails)
+@receiver(post_delete, sender=ItemDetails)
+def invalidate_barcode_cache(sender, instance, **kwargs):
+    # A BuyItem's previous barcode isn't known here: drop all the entries
+    barcode_cache.clear()
+
+@receiver(post_save, sender=BuyItemPrice)
+@receiver(post_delete, sender=BuyItemPrice)
+def invalidate_buyitemprice_cache(sender, instance, **kwargs):
+    buyitemprice_cache.delete((instance.bar_id, instance.buyitem_id))
+
+
 class BuyItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = BuyItem
@@ -68,6 +154,7 @@ class BuyItemViewSet(viewsets.ModelViewSet):
     serializer_class = BuyItemSerializer
     permission_classes = (RootBarPermissionsOrAnonReadOnly,)
     filter_fields = ['barcode', 'details']
+    max_barcodes = 200  # per by_barcode request
 
     def list(self, request):
         bar = request.query_params.get('bar', None)
@@ -96,6 +183,50 @@ class BuyItemViewSet(viewsets.ModelViewSet):
         serializer = BuyItemSerializer(instance, context={'request': request})
         return Response(serializer.data)
 
+    @decorators.list_route(methods=['get'])
+    def by_barcode(self, request):
+        """
+        Resolve many barcodes at once, for scanning: return {barcode: null or {buyitem, details, buyitemprice}},
+        buyitemprice being null if no bar is given or if the bar has no price for this item.
+        Barcodes are given as repeated or comma-separated `barcode` parameters.
+        ---
+        omit_serializer: true
+        parameters:
+            - name: barcode
+              required: true
+              type: string
+              paramType: query
+            - name: bar
+              required: false
+              type: string
+              paramType: query
+        """
+        barcodes = [b.strip() for param in request.query_params.getlist('barcode') for b in param.split(',')]
+        barcodes = [b for b in barcodes if b]
+        if not barcodes:
+            return Response("Specify at least one barcode", 400)
+        if len(barcodes) > self.max_barcodes:
+            return Response("Too many barcodes (max %d)" % self.max_barcodes, 400)
+
+        buyitems = get_buyitems_by_barcode(barcodes)
+        bar = getattr(request, 'bar', None)
+        if bar is not None:
+            prices = get_buyitemprices(bar.id, [bi.id for bi in buyitems.values() if bi is not None])
+
+        data = {}
+        for barcode in barcodes:
+            buyitem = buyitems[barcode]
+            if buyitem is None:
+                data[barcode] = None
+                continue
+            bip = prices[buyitem.id] if bar is not None else None
+            data[barcode] = {
+                'buyitem': BuyItemSerializer(buyitem).data,
+                'details': ItemDetailsSerializer(buyitem.details).data,
+                'buyitemprice': {'id': bip.id, 'price': bip.price} if bip is not None else None,
+            }
+        return Response(data)
+
 
 class BuyItemPriceSerializer(serializers.ModelSerializer):
     class Meta:
@@ -116,9 +247,8 @@ class BuyItemPriceSerializer(serializers.ModelSerializer):
     def validate(self, data):
         if data.get('barcode') is not None:
             if data.get('buyitem') is None:
-                try:
-                    data['buyitem'] = BuyItem.objects.get(barcode=data['barcode'])
-                except BuyItem.DoesNotExist:
+                data['buyitem'] = get_buyitems_by_barcode([data['barcode']]).get(data['barcode'])
+                if data['buyitem'] is None:
                     raise Http404('Barcode does not exist')
 
             if 'barcode' in data:
@@ -130,19 +260,43 @@ class BuyItemPriceSerializer(serializers.ModelSerializer):
         if data.get('buyitem') is None and data.get('barcode') is None:
                 raise ValidationError("Specify a barcode or a buyitem")
 
-        buyitemprice = super(BuyItemPriceSerializer, self).create(data)
-        bar = buyitemprice.bar
-        buyitem = buyitemprice.buyitem
-
+        buyitem = data['buyitem']
         if "price" not in data:
-            other_prices = BuyItemPrice.objects.filter(bar=bar, buyitem__details=buyitem.details).exclude(pk=buyitemprice.pk)
-            if other_prices.count() != 0:
-                price = sum([bip.price / bip.buyitem.itemqty for bip in other_prices.all()]) / other_prices.count()
+            # Inherit the average price per unit of the other packagings of the same product in the bar
+            total, count = get_unit_prices(data['bar'], [buyitem.details_id]).get(buyitem.details_id, (0, 0))
+            if count != 0:
+                data['price'] = total / count * buyitem.itemqty
+
+        return super(BuyItemPriceSerializer, self).create(data)
 
-                buyitemprice.price = price * buyitem.itemqty
-                buyitemprice.save()
 
-        return buyitemprice
+def get_unit_prices(bar, details_ids):
+    """
+    Return {details id: (sum, count)} of the bar's buy prices per unit (price / itemqty) of the given ItemDetails, in one query.
+    Packagings without a positive itemqty have no price per unit, and are left out.
+    """
+    rows = BuyItemPrice.objects.filter(bar=bar, buyitem__details__in=details_ids, buyitem__itemqty__gt=0).order_by().values('buyitem__details').\
+        annotate(total=Sum(F('price') / F('buyitem__itemqty')), count=Count('id'))
+    return dict((r['buyitem__details'], (r['total'], r['count'])) for r in rows)
+
+
+class BulkBuyItemPriceSerializer(serializers.Serializer):
+    # BuyItems and ItemDetails are given by id and resolved in batch by BuyItemPriceViewSet.bulk
+    buyitem = serializers.IntegerField(required=False)
+    barcode = serializers.CharField(required=False, max_length=25)
+    details = serializers.IntegerField(required=False)
+    itemqty = serializers.FloatField(default=1)
+    price = serializers.FloatField(required=False, min_value=0)
+
+    def validate_itemqty(self, value):
+        if value <= 0:
+            raise ValidationError("itemqty must be positive")
+        return value
+
+    def validate(self, data):
+        if data.get('buyitem') is None and not data.get('barcode'):
+            raise ValidationError("Specify a barcode or a buyitem")
+        return data
 
 
 class BuyItemPriceViewSet(viewsets.ModelViewSet):
@@ -150,3 +304,127 @@ class BuyItemPriceViewSet(viewsets.ModelViewSet):
     serializer_class = BuyItemPriceSerializer
     permission_classes = (PerBarPermissionsOrAnonReadOnly,)
     filter_fields = ['bar', 'buyitem']
+    max_bulk_items = 500
+
+    @decorators.detail_route()
+    def price_at(self, request, pk):
+        """
+        Return the price of the buyitem in the bar in effect at a date, from its price history.
+        Response format: `{buyitemprice: id, date: "*date*", price: (float)price}`
+        ---
+        omit_serializer: true
+        parameters:
+            - name: date
+              required: false
+              type: datetime
+              description: A datetime, or a date meaning the end of that day (default now)
+              paramType: query
+        """
+        from bars_items.models.pricehistory import BuyItemPriceHistory, parse_when
+        buyitemprice = self.get_object()
+        when = parse_when(request.query_params['date']) if 'date' in request.query_params else timezone.now()
+        if when is None:
+            return Response("Non-valid date format", 400)
+        price = BuyItemPriceHistory.price_at(buyitemprice.id, when)
+        return Response({'buyitemprice': buyitemprice.id, 'date': when, 'price': price if price is not None else buyitemprice.price}, 200)
+
+    @decorators.list_route(methods=['post'])
+    def bulk(self, request):
+        """
+        Register many buyitems in the bar at once, for instance when onboarding a supplier's catalog.
+        Each item is given by an existing buyitem id or a barcode; unknown barcodes create buyitems, whose details must be given.
+        Items without a price inherit the average price per unit of the bar's other packagings of the same details.
+        Buyitems that already have a price in the bar are skipped. Nothing is written if an item is wrong.
+        Response format: `{created: [buyitemprice, ...], skipped: [buyitemprice id, ...], created_buyitems: [buyitem id, ...]}`
+        ---
+        omit_serializer: true
+        parameters_strategy: replace
+        parameters:
+            - name: bar
+              required: true
+              type: string
+              paramType: query
+            - name: items
+              required: true
+              type: array
+              description: 'List of items, e.g. [{"barcode": "3017620422003", "details": 3, "itemqty": 6, "price": 12.5}, {"buyitem": 7}, ...]'
+              paramType: body
+        """
+        bar = request.bar
+        if bar is None:
+            return Response("Please give me a bar", 400)
+        if not isinstance(request.data, dict):
+            return Response("Expected an object with items", 400)
+        unsrz = BulkBuyItemPriceSerializer(data=request.data.get('items'), many=True)
+        unsrz.is_valid(raise_exception=True)
+        items = unsrz.validated_data
+        if not items:
+            return Response("Give me some items", 400)
+        if len(items) > self.max_bulk_items:
+            return Response("Too many items (max %d)" % self.max_bulk_items, 400)
+
+        # Resolve buyitems and details in batch
+        by_barcode = get_buyitems_by_barcode([i['barcode'] for i in items if i.get('buyitem') is None])
+        by_id = BuyItem.objects.in_bulk([i['buyitem'] for i in items if i.get('buyitem') is not None])
+        known_details = set(ItemDetails.objects.filter(pk__in=[i['details'] for i in items if 'details' in i]).values_list('id', flat=True))
+
+        errors = {}
+        buyitems = []
+        for (n, item) in enumerate(items):
+            if item.get('buyitem') is not None:
+                buyitem = by_id.get(item['buyitem'])
+                if buyitem is None:
+                    errors[n] = "Unknown buyitem"
+            else:
+                buyitem = by_barcode.get(item['barcode'])
+                if buyitem is None and item.get('details') not in known_details:
+                    errors[n] = "Unknown barcode: give existing details to create the buyitem"
+            buyitems.append(buyitem)
+        keys = [bi.id if bi is not None else item['barcode'] for (item, bi) in zip(items, buyitems)]
+        counts = Counter(keys)
+        for (n, key) in enumerate(keys):
+            if counts[key] > 1:
+                errors[n] = "Duplicated item"
+        if errors:
+            return Response(errors, 400)
+        if None in buyitems and not request.user.has_perm('bars_items.add_buyitem', get_root_bar()):
+            raise exceptions.PermissionDenied("You cannot create buyitems")
+
+        with transaction.atomic():
+            created_buyitems = []
+            for (n, item) in enumerate(items):
+                if buyitems[n] is None:
+                    buyitems[n] = BuyItem.objects.create(barcode=item['barcode'], details_id=item['details'], itemqty=item['itemqty'])
+                    created_buyitems.append(buyitems[n].id)
+
+            existing = dict(BuyItemPrice.objects.filter(bar=bar, buyitem__in=buyitems).values_list('buyitem', 'id'))
+            new = [(item, bi) for (item, bi) in zip(items, buyitems) if bi.id not in existing]
+
+            # Given prices count in the averages of the items without price
+            unit_prices = get_unit_prices(bar, set(bi.details_id for (_, bi) in new))
+            for (item, bi) in new:
+                if 'price' in item and bi.itemqty:
+                    total, count = unit_prices.get(bi.details_id, (0, 0))
+                    unit_prices[bi.details_id] = (total + item['price'] / bi.itemqty, count + 1)
+
+            bips = []
+            for (item, bi) in new:
+                price = item.get('price')
+                if price is None:
+                    total, count = unit_prices.get(bi.details_id, (0, 0))
+                    price = total / count * bi.itemqty if count else 0
+                bips.append(BuyItemPrice(bar=bar, buyitem=bi, price=price))
+            BuyItemPrice.objects.bulk_create(bips)
+
+            # bulk_create sends no signals
+            from bars_items.models.pricehistory import BuyItemPriceHistory
+            created = list(BuyItemPrice.objects.filter(bar=bar, buyitem__in=[bi for (_, bi) in new]).order_by('id'))
+            BuyItemPriceHistory.record([(bip.id, bip.price) for bip in created])
+            for bip in created:
+                buyitemprice_cache.delete((bar.id, bip.buyitem_id))
+
+        return Response({
+            'created': BuyItemPriceSerializer(created, many=True).data,
+            'skipped': sorted(existing.values()),
+            'created_buyitems': created_buyitems,
+        }, 201)
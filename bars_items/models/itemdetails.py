@@ -26,6 +26,8 @@ class ItemDetails(models.Model):
 
     keywords = models.CharField(max_length=200, blank=True)  # Todo: length
 
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
+
     def __unicode__(self):
         return self.name
 
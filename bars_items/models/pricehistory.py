@@ -0,0 +1,150 @@
+from datetime import datetime, time
+from django.db import models
+from django.db.models import Max, Min
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_date
+
+from bars_items.models.stockitem import StockItem
+from bars_items.models.buyitem import BuyItemPrice
+
+
+def latest_by(qs, key_field, date_field, fields, earliest=False):
+    """
+    Return {key: (values of fields)} for the row of qs with the latest (or earliest) date per key, ties being broken
+    by id. The dates are aggregated in SQL, and only the rows at these dates are read.
+    """
+    agg = Min if earliest else Max
+    dates = dict((row[key_field], row['date']) for row in qs.order_by().values(key_field).annotate(date=agg(date_field)))
+    if not dates:
+        return {}
+
+    rows = qs.filter(**{key_field + '__in': dates.keys(), date_field + '__in': set(dates.values())}).\
+        order_by('-id' if earliest else 'id').values_list(key_field, date_field, *fields)
+    result = {}
+    for row in rows:
+        if row[1] == dates[row[0]]:
+            result[row[0]] = row[2:]
+    return result
+
+
+class PriceHistory(models.Model):
+    """
+    Append-only history of the prices of a target, one row per change, indexed by (target, timestamp).
+    Rows are written when a target is saved with a new price (see price_changed), and explicitly by bulk updates.
+    """
+    class Meta:
+        abstract = True
+    timestamp = models.DateTimeField(default=timezone.now)
+    price = models.FloatField()
+
+    @classmethod
+    def record(cls, prices, timestamp=None):
+        """
+        Append the prices given as [(target id, price)].
+        """
+        timestamp = timestamp or timezone.now()
+        cls.objects.bulk_create([cls(target_id=target_id, price=price, timestamp=timestamp) for (target_id, price) in prices])
+
+    @classmethod
+    def price_at(cls, target_id, when):
+        """
+        Return the price of a target in effect at `when`, or its oldest known price if `when` is before its history
+        (None if it has no history).
+        """
+        rows = cls.objects.filter(target=target_id)
+        price = rows.filter(timestamp__lte=when).order_by('-timestamp', '-id').values_list('price', flat=True)[:1]
+        if not price:
+            price = rows.order_by('timestamp', 'id').values_list('price', flat=True)[:1]
+        return price[0] if price else None
+
+    @classmethod
+    def prices_at(cls, target_ids, when):
+        """
+        Return {target id: price in effect at `when`} for the given targets, as price_at.
+        """
+        rows = cls.objects.filter(target__in=target_ids)
+        prices = dict((target_id, price) for (target_id, (price,)) in
+                      latest_by(rows.filter(timestamp__lte=when), 'target', 'timestamp', ['price']).items())
+
+        missing = set(target_ids) - set(prices)
+        if missing:
+            oldest = latest_by(rows.filter(target__in=missing), 'target', 'timestamp', ['price'], earliest=True)
+            prices.update((target_id, price) for (target_id, (price,)) in oldest.items())
+        return prices
+
+
+class StockItemPriceHistory(PriceHistory):
+    class Meta:
+        app_label = 'bars_items'
+        index_together = [('target', 'timestamp')]
+    target = models.ForeignKey(StockItem)
+
+    def __unicode__(self):
+        return "%s: %f (%s)" % (unicode(self.target_id), self.price, self.timestamp)
+
+
+class BuyItemPriceHistory(PriceHistory):
+    class Meta:
+        app_label = 'bars_items'
+        index_together = [('target', 'timestamp')]
+    target = models.ForeignKey(BuyItemPrice)
+
+    def __unicode__(self):
+        return "%s: %f (%s)" % (unicode(self.target_id), self.price, self.timestamp)
+
+
+history_models = {StockItem: StockItemPriceHistory, BuyItemPrice: BuyItemPriceHistory}
+
+@receiver(post_save, sender=StockItem)
+@receiver(post_save, sender=BuyItemPrice)
+def price_changed(sender, instance, created, **kwargs):
+    # _loaded_price is set by from_db
+    if created or instance.price != getattr(instance, '_loaded_price', None):
+        history_models[sender].record([(instance.id, instance.price)])
+        instance._loaded_price = instance.price
+
+
+def parse_when(value):
+    """
+    Parse a datetime, or a date meaning the end of that day; return None if the format is wrong.
+    """
+    when = parse_datetime(value)
+    if when is None:
+        day = parse_date(value)
+        if day is None:
+            return None
+        when = datetime.combine(day, time.max)
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when, timezone.get_current_timezone())
+    return when
+
+
+def get_stock_valuation(bar, when=None):
+    """
+    Return the value of the bar's stock at `when` (default: now), as `{date, total, stockitems: [{stockitem, qty, price, value}]}`,
+    quantities and prices being in the stockitems' own unit. Deleted stockitems are left out. Past quantities are those
+    left by the last operation on each stockitem before `when` (its previous value if its transaction is canceled).
+    """
+    from bars_transactions.models import ItemOperation
+
+    if when is None:
+        when = timezone.now()
+        rows = StockItem.objects.filter(bar=bar, deleted=False).values_list('id', 'qty', 'price')
+        qties = dict((i, qty) for (i, qty, _) in rows)
+        prices = dict((i, price) for (i, _, price) in rows)
+    else:
+        ops = ItemOperation.objects.filter(target__bar=bar, target__deleted=False, transaction__timestamp__lte=when)
+        ops = latest_by(ops, 'target', 'transaction__timestamp', ['prev_value', 'next_value', 'transaction__canceled'])
+        qties = dict((stockitem_id, prev_value if canceled else next_value)
+                     for (stockitem_id, (prev_value, next_value, canceled)) in ops.items())
+        prices = StockItemPriceHistory.prices_at([i for (i, qty) in qties.items() if qty != 0], when)
+
+    stockitems = []
+    for (stockitem_id, qty) in sorted(qties.items()):
+        if qty == 0 or prices.get(stockitem_id) is None:
+            continue
+        price = prices[stockitem_id]
+        stockitems.append({'stockitem': stockitem_id, 'qty': qty, 'price': price, 'value': qty * price})
+    return {'date': when, 'total': sum(s['value'] for s in stockitems), 'stockitems': stockitems}
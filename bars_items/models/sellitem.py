@@ -1,9 +1,14 @@
 from django.http import Http404, HttpResponseBadRequest
-from django.db import models
-from django.db.models import Sum, F, Prefetch
+from django.db import models, transaction
+from django.db.models import Sum, F, Prefetch, Case, When, Value
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 import datetime
+import threading
+from contextlib import contextmanager
+from django.utils import timezone
 from django.utils.timezone import utc
-from rest_framework import viewsets, serializers, permissions, decorators, exceptions
+from rest_framework import viewsets, serializers, permissions, decorators, exceptions, filters
 from rest_framework.response import Response
 
 from bars_django.utils import VirtualField, permission_logic, CurrentBarCreateOnlyDefault
@@ -34,14 +39,26 @@ class SellItem(models.Model):
 
     deleted = models.BooleanField(default=False)
 
+    # Denormalized calc_qty() and calc_price(), kept up to date by refresh_fuzzy_values
+    fuzzy_qty = models.FloatField(default=0)
+    fuzzy_price = models.FloatField(default=0)
+
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
+
     objects = SellItemManager()
 
+    def save(self, *args, **kwargs):
+        # The tax may have changed
+        stockitems = list(StockItem.objects.filter(sellitem=self)) if self.pk else []
+        self.fuzzy_qty, self.fuzzy_price = self.compute_fuzzy_values(stockitems)
+        super(SellItem, self).save(*args, **kwargs)
+
     def calc_qty(self):
         if not hasattr(self, '_qty'):
             self._qty = sum(i.sell_qty for i in self.stockitems.all())
         return self._qty
 
-    def calc_price_qty_per_stockitem(self):
+    def calc_price_qty_per_stockitem(self, stockitems=None):
         # Calcule le prix unitaire du sellitem, ainsi que la composition d'une unite de ce sellitem
         # Renvoie donc une liste de paires (si, qty) avec :
         # - si = un stockitem composant l'unite de sellitem
@@ -51,7 +68,8 @@ class SellItem(models.Model):
         # - S'il reste des aliments en quantite positive, on ne compte que ceux-la
         # - S'il n'y a plus d'aliments en quantite positive, on ne compte que les aliments en quantite negative
         # - Si tous les aliments sont a zero, on repartit equitablement chaque quantite
-        stockitems = list(self.stockitems.all())
+        if stockitems is None:
+            stockitems = list(self.stockitems.all())
         positive_qty = sum(si.sell_qty for si in stockitems if si.sell_qty > 0)
         if positive_qty > 0:
             return [(si, si.sell_qty / positive_qty) for si in stockitems if si.sell_qty > 0]
@@ -66,6 +84,16 @@ class SellItem(models.Model):
     def calc_price(self):
         return sum(si.get_price('sell') * qty for (si, qty) in self.calc_price_qty_per_stockitem())
 
+    def compute_fuzzy_values(self, stockitems):
+        """
+        Return (calc_qty(), calc_price()) computed from the given stockitems of the sellitem.
+        """
+        for si in stockitems:
+            si.sellitem = self
+        qty = sum(si.sell_qty for si in stockitems)
+        price = sum(si.get_price('sell') * q for (si, q) in self.calc_price_qty_per_stockitem(stockitems))
+        return qty, price
+
     @property
     def unit_factor(self):
         return 1
@@ -74,7 +102,7 @@ class SellItem(models.Model):
     def unit_factor(self, factor):
         if factor != 1:
             # Update related StockItem.unit_factor
-            self.stockitems.all().update(unit_factor=F('unit_factor') * factor)
+            self.stockitems.all().update(unit_factor=F('unit_factor') * factor, last_modified=timezone.now())
             # Update related MenuSellItem.qty
             from bars_menus.models import MenuSellItem
             MenuSellItem.objects.filter(sellitem=self).update(qty=F('qty') * factor)
@@ -90,21 +118,79 @@ class SellItem(models.Model):
         return self.name
 
 
+_deferred_refresh = threading.local()
+
+@contextmanager
+def deferred_fuzzy_refresh():
+    """
+    Within this block, refresh_fuzzy_values only collects the sellitems, which are refreshed at once on exit
+    (eg. for the many operations of a basket).
+    """
+    if getattr(_deferred_refresh, 'ids', None) is not None:  # Nested
+        yield
+        return
+
+    _deferred_refresh.ids = set()
+    try:
+        yield
+        ids = _deferred_refresh.ids
+    finally:
+        _deferred_refresh.ids = None
+    refresh_fuzzy_values(ids)
+
+
+def refresh_fuzzy_values(sellitem_ids):
+    """
+    Recompute the fuzzy_qty and fuzzy_price columns of the given sellitems (ids), with one query and one update.
+    """
+    sellitem_ids = set(sellitem_ids) - set([None])
+    if not sellitem_ids:
+        return
+    deferred = getattr(_deferred_refresh, 'ids', None)
+    if deferred is not None:
+        deferred.update(sellitem_ids)
+        return
+
+    stockitems = {}
+    sellitems = {}
+    for si in StockItem.objects.filter(sellitem__in=sellitem_ids):
+        stockitems.setdefault(si.sellitem_id, []).append(si)
+        sellitems[si.sellitem_id] = si.sellitem
+    values = dict((id, sellitems[id].compute_fuzzy_values(stockitems[id]) if id in sellitems else (0, 0))
+                  for id in sellitem_ids)
+
+    SellItem.objects.filter(pk__in=sellitem_ids).update(
+        fuzzy_qty=Case(*[When(pk=id, then=Value(qty)) for (id, (qty, _)) in values.items()], output_field=models.FloatField()),
+        fuzzy_price=Case(*[When(pk=id, then=Value(price)) for (id, (_, price)) in values.items()], output_field=models.FloatField()),
+        last_modified=timezone.now())
+
+
+@receiver(post_save, sender=StockItem)
+@receiver(post_delete, sender=StockItem)
+def stockitem_changed(sender, instance, **kwargs):
+    # Price, unit_factor or qty may have changed, as well as the sellitem
+    refresh_fuzzy_values([instance.sellitem_id, getattr(instance, '_loaded_sellitem_id', None)])
+    instance._loaded_sellitem_id = instance.sellitem_id
+
+
 class SellItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = SellItem
-        read_only_fields = ("id", "bar")
+        read_only_fields = ("id", "bar", "fuzzy_qty", "fuzzy_price")
         extra_kwargs = {'stockitems': {'required': False},
                         'unit_factor': {'required': False}}
 
     _type = VirtualField("SellItem")
     bar = serializers.PrimaryKeyRelatedField(read_only=True, default=CurrentBarCreateOnlyDefault())
     stockitems = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
-    fuzzy_qty = serializers.FloatField(read_only=True, source='calc_qty')
-    fuzzy_price = serializers.FloatField(read_only=True, source='calc_price')
     unit_factor = serializers.FloatField(write_only=True, default=1)
     oldest_inventory = serializers.DateTimeField(read_only=True, source='calc_oldest_inventory')
 
+    def update(self, instance, validated_data):
+        # Changing unit_factor also updates stockitems and menus
+        with transaction.atomic():
+            return super(SellItemSerializer, self).update(instance, validated_data)
+
 
 class MergeSellItemSerializer(serializers.Serializer):
     sellitem = serializers.PrimaryKeyRelatedField(queryset=SellItem.objects.all())
@@ -124,7 +210,12 @@ class SellItemViewSet(viewsets.ModelViewSet):
     queryset = SellItem.objects.all()
     serializer_class = SellItemSerializer
     permission_classes = (PerBarPermissionsOrAnonReadOnly,)
-    filter_fields = ['bar']
+    filter_backends = (filters.DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter)
+    filter_fields = {
+        'bar': ['exact'],
+        'fuzzy_qty': ['lte', 'gte'],
+        'fuzzy_price': ['lte', 'gte']}
+    ordering_fields = ('name', 'fuzzy_qty', 'fuzzy_price')
 
     @decorators.detail_route(methods=['put'])
     def merge(self, request, pk=None):
@@ -133,24 +224,18 @@ class SellItemViewSet(viewsets.ModelViewSet):
         other = unsrz.validated_data['sellitem']
         unit_factor = unsrz.validated_data['unit_factor']
 
-        try:
-            this = SellItem.objects.get(pk=pk)
-        except SellItem.DoesNotExist:
-            raise Http404('SellItem (id=%d) does not exist' % pk)
-
-        if this.bar != request.bar or other.bar != this.bar or other.bar != request.bar:
-            raise exceptions.PermissionDenied('Cannot operate across bars')
+        this = self._get_sellitem(pk)
+        self._check_bars(request, this, other)
 
         if this.pk == other.pk:
             raise exceptions.PermissionDenied('Cannot merge a sellitem with itself')
 
-        for stockitem in other.stockitems.all():
-            stockitem.sellitem = this
-            stockitem.unit_factor *= unit_factor
-            stockitem.save()
-        other.delete()
+        with transaction.atomic():
+            StockItem.objects.filter(sellitem=other).update(sellitem=this, unit_factor=F('unit_factor') * unit_factor, last_modified=timezone.now())
+            other.delete()
+            refresh_fuzzy_values([this.id])
 
-        srz = SellItemSerializer(this)
+        srz = SellItemSerializer(self._get_sellitem(pk))
         return Response(srz.data, 200)
 
     @decorators.detail_route(methods=['put'])
@@ -160,23 +245,17 @@ class SellItemViewSet(viewsets.ModelViewSet):
         stockitem = unsrz.validated_data['stockitem']
         unit_factor = unsrz.validated_data['unit_factor']
 
-        try:
-            sellitem = SellItem.objects.get(pk=pk)
-        except SellItem.DoesNotExist:
-            raise Http404('SellItem (id=%d) does not exist' % pk)
+        sellitem = self._get_sellitem(pk)
+        self._check_bars(request, sellitem, stockitem)
 
-        if sellitem.bar != request.bar or stockitem.bar != sellitem.bar or stockitem.bar != request.bar:
-            raise exceptions.PermissionDenied('Cannot operate across bars')
-
-        old_sellitem = stockitem.sellitem
-        stockitem.sellitem = sellitem
-        stockitem.unit_factor *= unit_factor
-        stockitem.save()
-
-        if old_sellitem.stockitems.count() == 0:
-            old_sellitem.delete()
+        old_sellitem_id = stockitem.sellitem_id
+        with transaction.atomic():
+            StockItem.objects.filter(pk=stockitem.pk).update(sellitem=sellitem, unit_factor=F('unit_factor') * unit_factor, last_modified=timezone.now())
+            if old_sellitem_id != sellitem.id:
+                SellItem.objects.filter(pk=old_sellitem_id, stockitems=None).delete()
+            refresh_fuzzy_values([sellitem.id, old_sellitem_id])
 
-        srz = SellItemSerializer(sellitem)
+        srz = SellItemSerializer(self._get_sellitem(pk))
         return Response(srz.data, 200)
 
     @decorators.detail_route(methods=['put'])
@@ -185,33 +264,41 @@ class SellItemViewSet(viewsets.ModelViewSet):
         unsrz.is_valid(raise_exception=True)
         stockitem = unsrz.validated_data['stockitem']
 
-        try:
-            sellitem = SellItem.objects.get(pk=pk)
-        except SellItem.DoesNotExist:
-            raise Http404('SellItem (id=%d) does not exist' % pk)
-
-        if sellitem.bar != request.bar or stockitem.bar != sellitem.bar or stockitem.bar != request.bar:
-            raise exceptions.PermissionDenied('Cannot operate across bars')
+        sellitem = self._get_sellitem(pk)
+        self._check_bars(request, sellitem, stockitem)
 
-        if sellitem.stockitems.count() == 0:
+        if len(sellitem.stockitems.all()) <= 1:
             return Response('Sellitem has only one stockitem; cannot split', 403)
 
-        if stockitem.sellitem != sellitem:
+        if stockitem.sellitem_id != sellitem.id:
             return Response('Supplied stockitem does not belong to the sellitem', 403)
 
-        # Clone current sellitem
-        new_sellitem = SellItem.objects.get(pk=sellitem.pk)
-        new_sellitem.pk = None
-        new_sellitem.name = stockitem.details.name
-        new_sellitem.name_plural = stockitem.details.name_plural
-        new_sellitem.save()
+        with transaction.atomic():
+            # Clone current sellitem
+            fields = dict((f.attname, getattr(sellitem, f.attname)) for f in SellItem._meta.concrete_fields if not f.primary_key)
+            new_sellitem = SellItem(**fields)
+            new_sellitem.name = stockitem.details.name
+            new_sellitem.name_plural = stockitem.details.name_plural
+            new_sellitem.save()
 
-        stockitem.sellitem = new_sellitem
-        stockitem.save()
+            StockItem.objects.filter(pk=stockitem.pk).update(sellitem=new_sellitem, last_modified=timezone.now())
+            refresh_fuzzy_values([sellitem.id, new_sellitem.id])
 
-        srz = SellItemSerializer(new_sellitem)
+        srz = SellItemSerializer(self._get_sellitem(new_sellitem.pk))
         return Response(srz.data, 200)
 
+    @staticmethod
+    def _get_sellitem(pk):
+        try:
+            return SellItem.objects.get(pk=pk)
+        except SellItem.DoesNotExist:
+            raise Http404('SellItem (id=%s) does not exist' % pk)
+
+    @staticmethod
+    def _check_bars(request, *items):
+        if request.bar is None or any(item.bar_id != request.bar.id for item in items):
+            raise exceptions.PermissionDenied('Cannot operate across bars')
+
     @decorators.list_route(methods=['put'])
     def set_global_tax(self, request):
         bar = request.query_params.get('bar', None)
@@ -226,7 +313,8 @@ class SellItemViewSet(viewsets.ModelViewSet):
         if tax < 0 or tax > 1:
             return Response('Tax must be between 0 and 1', 400)
 
-        SellItem.objects.filter(bar=bar).update(tax=tax)
+        SellItem.objects.filter(bar=bar).update(tax=tax, last_modified=timezone.now())
+        refresh_fuzzy_values(SellItem.objects.filter(bar=bar).values_list('id', flat=True))
         return Response(status=204)
 
     @decorators.detail_route()
@@ -2,6 +2,7 @@ import datetime
 from django.db import models
 from django.db.models import Sum, F
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 from django.utils.timezone import utc
 from rest_framework import viewsets, serializers, permissions, decorators
 from rest_framework.response import Response
@@ -33,9 +34,19 @@ class StockItem(models.Model):
 
     last_inventory = models.DateTimeField(auto_now_add=True)
     deleted = models.BooleanField(default=False)
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     objects = StockItemManager()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(StockItem, cls).from_db(db, field_names, values)
+        # To refresh the previous sellitem's fuzzy values when the stockitem is moved
+        instance._loaded_sellitem_id = instance.sellitem_id
+        # To record price changes (see bars_items.models.pricehistory)
+        instance._loaded_price = instance.__dict__.get('price')
+        return instance
+
     def get_unit(self, unit=''):
         return {'':1., 'sell':self.unit_factor, 'buy':1.}[unit]
 
@@ -116,3 +127,53 @@ class StockItemViewSet(viewsets.ModelViewSet):
 
         stats = compute_transaction_stats(request, f, aggregate)
         return Response(stats, 200)
+
+    @decorators.detail_route()
+    def price_at(self, request, pk):
+        """
+        Return the price (per stock unit, without tax) of the stockitem in effect at a date, from its price history.
+        Response format: `{stockitem: id, date: "*date*", price: (float)price}`
+        ---
+        omit_serializer: true
+        parameters:
+            - name: date
+              required: false
+              type: datetime
+              description: A datetime, or a date meaning the end of that day (default now)
+              paramType: query
+        """
+        from bars_items.models.pricehistory import StockItemPriceHistory, parse_when
+        stockitem = self.get_object()
+        when = parse_when(request.query_params['date']) if 'date' in request.query_params else timezone.now()
+        if when is None:
+            return Response("Non-valid date format", 400)
+        price = StockItemPriceHistory.price_at(stockitem.id, when)
+        return Response({'stockitem': stockitem.id, 'date': when, 'price': price if price is not None else stockitem.price}, 200)
+
+    @decorators.list_route()
+    def valuation(self, request):
+        """
+        Return the value of the bar's stock at a date (quantities times the prices in effect then, without tax).
+        Response format: `{date: "*date*", total: (float)total, stockitems: [{stockitem: id, qty: (float)qty, price: (float)price, value: (float)value}, ...]}`
+        ---
+        omit_serializer: true
+        parameters:
+            - name: bar
+              required: true
+              type: string
+              paramType: query
+            - name: date
+              required: false
+              type: datetime
+              description: A datetime, or a date meaning the end of that day (default now)
+              paramType: query
+        """
+        from bars_items.models.pricehistory import get_stock_valuation, parse_when
+        if request.bar is None:
+            return Response("Please give me a bar", 400)
+        when = None
+        if 'date' in request.query_params:
+            when = parse_when(request.query_params['date'])
+            if when is None:
+                return Response("Non-valid date format", 400)
+        return Response(get_stock_valuation(request.bar, when), 200)
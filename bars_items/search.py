@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory search index over the item catalog, for autocompletion.
+
+ItemDetails (name, plural, brand, keywords), SellItems (name, plural, keywords) and BuyItems (their details' words
+and barcode) are indexed by normalized words: lowercased, without accents, so that "creme brulee" finds "Crème brûlée".
+Each query word must match a word of the item, by prefix or, for words of 3 letters or more, anywhere in the word.
+Candidates are found through postings of word prefixes (1 and 2 letters) and of trigrams, then checked and ranked:
+exact words of the name first, then prefixes of the name, prefixes of other words, and substrings.
+
+The index is per process: it is built at the first search, kept up to date by the save and delete signals of this
+process, and rebuilt after ITEM_SEARCH_INDEX_TTL seconds (for changes made by other processes).
+"""
+import re
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework import permissions
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from bars_items.models.itemdetails import ItemDetails
+from bars_items.models.sellitem import SellItem
+from bars_items.models.buyitem import BuyItem
+
+
+_ligatures = {u'œ': u'oe', u'Œ': u'oe', u'æ': u'ae', u'Æ': u'ae', u'ß': u'ss'}
+_word_re = re.compile(r'\w+', re.UNICODE)
+_type_order = {'SellItem': 0, 'ItemDetails': 1, 'BuyItem': 2}  # For equal scores and names
+
+def normalize(text):
+    """
+    Return the lowercased words of a text, without accents.
+    """
+    text = unicodedata.normalize('NFKD', unicode(text or '')).lower()
+    text = u''.join(_ligatures.get(c, c) for c in text if not unicodedata.combining(c))
+    return _word_re.findall(text)
+
+
+def _grams(word):
+    # Prefixes of 1 and 2 letters, and trigrams
+    grams = set(word[:n] for n in (1, 2) if len(word) >= n)
+    grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+class ItemSearchIndex(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.docs = {}  # (type, id) -> document
+            self.postings = {}  # gram -> set of (type, id)
+            self.buyitems_by_details = {}  # details id -> set of buyitem ids
+            self.built = None
+
+    # Documents
+
+    @staticmethod
+    def itemdetails_doc(details):
+        return {
+            '_type': 'ItemDetails', 'id': details.id, 'name': details.name, 'bar': None, 'details': details.id,
+            'name_words': normalize(details.name),
+            'other_words': normalize(u' '.join([details.name_plural, details.brand, details.keywords])),
+        }
+
+    @staticmethod
+    def sellitem_doc(sellitem):
+        return {
+            '_type': 'SellItem', 'id': sellitem.id, 'name': sellitem.name, 'bar': sellitem.bar_id, 'details': None,
+            'name_words': normalize(sellitem.name),
+            'other_words': normalize(u' '.join([sellitem.name_plural, sellitem.keywords])),
+        }
+
+    @staticmethod
+    def buyitem_doc(buyitem, details_doc):
+        return {
+            '_type': 'BuyItem', 'id': buyitem.id, 'name': details_doc['name'], 'bar': None, 'details': buyitem.details_id,
+            'name_words': details_doc['name_words'],
+            'other_words': details_doc['other_words'] + normalize(buyitem.barcode),
+            'barcode': buyitem.barcode,
+        }
+
+    def _add(self, doc):
+        key = (doc['_type'], doc['id'])
+        self._remove(key)
+        self.docs[key] = doc
+        for word in doc['name_words'] + doc['other_words']:
+            for gram in _grams(word):
+                self.postings.setdefault(gram, set()).add(key)
+        if doc['_type'] == 'BuyItem':
+            self.buyitems_by_details.setdefault(doc['details'], set()).add(doc['id'])
+
+    def _remove(self, key):
+        doc = self.docs.pop(key, None)
+        if doc is None:
+            return
+        for word in doc['name_words'] + doc['other_words']:
+            for gram in _grams(word):
+                keys = self.postings.get(gram)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.postings[gram]
+        if doc['_type'] == 'BuyItem':
+            self.buyitems_by_details.get(doc['details'], set()).discard(doc['id'])
+
+    # Building and incremental updates
+
+    def build(self):
+        docs = [self.itemdetails_doc(d) for d in ItemDetails.objects.all()]
+        details_docs = dict((d['id'], d) for d in docs)
+        docs += [self.sellitem_doc(s) for s in SellItem.objects.filter(deleted=False).only('id', 'bar', 'name', 'name_plural', 'keywords').prefetch_related(None)]
+        docs += [self.buyitem_doc(b, details_docs[b.details_id]) for b in BuyItem.objects.all() if b.details_id in details_docs]
+
+        with self.lock:
+            self.docs, self.postings, self.buyitems_by_details = {}, {}, {}
+            for doc in docs:
+                self._add(doc)
+            self.built = time.time()
+
+    def ensure_built(self):
+        if self.built is None or time.time() - self.built > settings.ITEM_SEARCH_INDEX_TTL:
+            self.build()
+
+    def update_itemdetails(self, details, deleted=False):
+        with self.lock:
+            if self.built is None:
+                return
+            if deleted:
+                self._remove(('ItemDetails', details.id))
+                return
+            doc = self.itemdetails_doc(details)
+            self._add(doc)
+            for buyitem_id in list(self.buyitems_by_details.get(details.id, ())):
+                barcode = self.docs[('BuyItem', buyitem_id)]['barcode']
+                self._add(self.buyitem_doc(BuyItem(id=buyitem_id, details_id=details.id, barcode=barcode), doc))
+
+    def update_sellitem(self, sellitem, deleted=False):
+        with self.lock:
+            if self.built is None:
+                return
+            if deleted or sellitem.deleted:
+                self._remove(('SellItem', sellitem.id))
+            else:
+                self._add(self.sellitem_doc(sellitem))
+
+    def update_buyitem(self, buyitem, deleted=False):
+        with self.lock:
+            if self.built is None:
+                return
+            details_doc = self.docs.get(('ItemDetails', buyitem.details_id))
+            if deleted or details_doc is None:
+                self._remove(('BuyItem', buyitem.id))
+            else:
+                self._add(self.buyitem_doc(buyitem, details_doc))
+
+    # Search
+
+    def search(self, q, bar_id=None, types=None, limit=20):
+        """
+        Return the best `limit` documents matching all the words of `q`, as dicts with _type, id, name, bar,
+        details and score. SellItems are only returned for the given bar.
+        """
+        words = normalize(q)
+        if not words:
+            return []
+        self.ensure_built()
+
+        with self.lock:
+            candidates = None
+            for word in sorted(set(words), key=len, reverse=True):
+                grams = [word] if len(word) < 3 else [word[i:i + 3] for i in range(len(word) - 2)]
+                for gram in sorted(grams, key=lambda g: len(self.postings.get(g, ()))):
+                    keys = self.postings.get(gram, set())
+                    candidates = set(keys) if candidates is None else candidates & keys
+                    if not candidates:
+                        return []
+            docs = [self.docs[key] for key in candidates]
+
+        results = []
+        query = u' '.join(words)
+        for doc in docs:
+            if doc['_type'] == 'SellItem' and doc['bar'] != bar_id:
+                continue
+            if types is not None and doc['_type'] not in types:
+                continue
+            score = self._score(doc, words)
+            if score is None:
+                continue
+            if u' '.join(doc['name_words']).startswith(query):
+                score += 2
+            results.append((score, doc))
+
+        results.sort(key=lambda r: (-r[0], len(r[1]['name']), r[1]['name'], _type_order[r[1]['_type']], r[1]['id']))
+        return [{'_type': doc['_type'], 'id': doc['id'], 'name': doc['name'], 'bar': doc['bar'], 'details': doc['details'], 'score': score}
+                for (score, doc) in results[:limit]]
+
+    @staticmethod
+    def _score(doc, words):
+        total = 0
+        for word in words:
+            if word in doc['name_words']:
+                score = 4
+            elif any(w.startswith(word) for w in doc['name_words']):
+                score = 3
+            elif any(w.startswith(word) for w in doc['other_words']):
+                score = 2
+            elif len(word) >= 3 and any(word in w for w in doc['name_words'] + doc['other_words']):
+                score = 1
+            else:
+                return None
+            total += score
+        return total
+
+index = ItemSearchIndex()
+
+
+@receiver(post_save, sender=ItemDetails)
+@receiver(post_delete, sender=ItemDetails)
+def itemdetails_changed(sender, instance, **kwargs):
+    index.update_itemdetails(instance, deleted='created' not in kwargs)
+
+@receiver(post_save, sender=SellItem)
+@receiver(post_delete, sender=SellItem)
+def sellitem_changed(sender, instance, **kwargs):
+    index.update_sellitem(instance, deleted='created' not in kwargs)
+
+@receiver(post_save, sender=BuyItem)
+@receiver(post_delete, sender=BuyItem)
+def buyitem_changed(sender, instance, **kwargs):
+    index.update_buyitem(instance, deleted='created' not in kwargs)
+
+
+
+class ItemSearchView(APIView):
+    permission_classes = (permissions.AllowAny,)
+    max_limit = 100
+
+    def get(self, request, format=None):
+        """
+        Search the item catalog by name and keywords, ignoring case and accents.
+        SellItems are only returned when a bar is given.
+        Response format: [{"_type": "ItemDetails", "id": 3, "name": "...", "bar": null, "details": 3, "score": 6}, ...], best matches first
+        ---
+        omit_serializer: true
+        parameters:
+            - name: q
+              required: true
+              type: string
+              paramType: query
+            - name: bar
+              required: false
+              type: string
+              paramType: query
+            - name: type
+              required: false
+              type: string
+              description: Comma-separated types to return, among ItemDetails, SellItem and BuyItem
+              paramType: query
+            - name: limit
+              required: false
+              type: integer
+              paramType: query
+        """
+        q = request.query_params.get('q', '')
+        types = request.query_params.get('type')
+        if types is not None:
+            types = set(types.split(','))
+        try:
+            limit = min(int(request.query_params.get('limit', 20)), self.max_limit)
+        except ValueError:
+            return Response("limit must be an integer", 400)
+        if limit < 1:
+            return Response("limit must be positive", 400)
+
+        bar_id = request.bar.id if request.bar is not None else None
+        return Response(index.search(q, bar_id=bar_id, types=types, limit=limit))
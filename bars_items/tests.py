@@ -1,4 +1,5 @@
 from mock import Mock
+from django.utils import timezone
 from rest_framework import exceptions, serializers
 from rest_framework.test import APITestCase
 from bars_django.utils import get_root_bar
@@ -8,11 +9,14 @@ from bars_core.models.user import User
 from bars_core.models.role import Role
 from bars_core.models.account import Account
 
-from bars_items.models.buyitem import BuyItem, BuyItemSerializer, BuyItemPrice, BuyItemPriceSerializer
+from bars_items.models.buyitem import BuyItem, BuyItemSerializer, BuyItemPrice, BuyItemPriceSerializer, barcode_cache, buyitemprice_cache
 from bars_items.models.itemdetails import ItemDetails, ItemDetailsSerializer
 from bars_items.models.sellitem import SellItem, SellItemSerializer
 from bars_items.models.stockitem import StockItem, StockItemSerializer
 from bars_items.models.suggesteditem import SuggestedItem, SuggestedItemSerializer
+from bars_items.search import index as search_index
+from bars_items.buyitemprices import reset_buyitemprices
+from bars_items.models.pricehistory import StockItemPriceHistory
 
 
 def reload(obj):
@@ -203,6 +207,72 @@ class SellItemTests(ItemTests, AutoTestBarMixin):
         self.assertEqual(response.status_code, 200)
         self.assertAlmostEqual(reload(self.stockitem).sell_to_buy, old_sell_to_buy / update_data['unit_factor'])
 
+    def test_fuzzy_values(self):
+        self.assertAlmostEqual(reload(self.sellitem).fuzzy_price, 1.2)
+
+        self.client.force_authenticate(user=self.staff_user)
+        self.client.put('/sellitem/set_global_tax/?bar=barjone', {'tax': 0.15})
+        self.assertAlmostEqual(reload(self.sellitem).fuzzy_price, 1.15)
+
+        from bars_transactions.models import Transaction
+        t = Transaction.objects.create(bar=self.bar, author=self.staff_user, type='appro')
+        reload(self.stockitem).create_operation(delta=4, transaction=t)
+        self.assertAlmostEqual(reload(self.sellitem).fuzzy_qty, 4)
+
+        stockitem = reload(self.stockitem)
+        stockitem.price = 2
+        stockitem.save()
+        self.assertAlmostEqual(reload(self.sellitem).fuzzy_price, 2.3)
+
+        stockitem.sellitem = self.sellitem2
+        stockitem.save()
+        self.assertEqual((reload(self.sellitem).fuzzy_qty, reload(self.sellitem).fuzzy_price), (0, 0))
+        self.assertAlmostEqual(reload(self.sellitem2).fuzzy_qty, 4)
+
+        response = self.client.get('/sellitem/?bar=barjone&ordering=-fuzzy_price')
+        self.assertEqual([x['id'] for x in response.data][0], self.sellitem2.id)
+        self.assertAlmostEqual(response.data[0]['fuzzy_price'], reload(self.sellitem2).calc_price())
+        response = self.client.get('/sellitem/?bar=barjone&fuzzy_qty__gte=1')
+        self.assertEqual([x['id'] for x in response.data], [self.sellitem2.id])
+
+    def test_merge_remove_add(self):
+        itemdetails, _ = ItemDetails.objects.get_or_create(name="Chocolat blanc")
+        stockitem = StockItem.objects.create(bar=self.bar, sellitem=self.sellitem2, details=itemdetails, price=2, qty=3)
+        self.client.force_authenticate(user=self.staff_user)
+
+        response = self.client.put('/sellitem/%d/merge/?bar=%s' % (self.sellitem.id, self.bar.id), {'sellitem': self.sellitem2.id, 'unit_factor': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(response.data['stockitems']), sorted([self.stockitem.id, stockitem.id]))
+        self.assertAlmostEqual(response.data['fuzzy_qty'], 6)
+        self.assertFalse(SellItem.objects.filter(pk=self.sellitem2.pk).exists())
+        self.assertEqual(reload(stockitem).unit_factor, 2)
+
+        response = self.client.put('/sellitem/%d/remove/?bar=%s' % (self.sellitem.id, self.bar.id), {'stockitem': stockitem.id})
+        self.assertEqual(response.status_code, 200)
+        new_sellitem = SellItem.objects.get(pk=response.data['id'])
+        self.assertEqual(new_sellitem.name, "Chocolat blanc")
+        self.assertEqual(new_sellitem.tax, self.sellitem.tax)
+        self.assertEqual(response.data['stockitems'], [stockitem.id])
+        self.assertEqual(reload(self.sellitem).fuzzy_qty, 0)
+
+        response = self.client.put('/sellitem/%d/remove/?bar=%s' % (self.sellitem.id, self.bar.id), {'stockitem': self.stockitem.id})
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.put('/sellitem/%d/add/?bar=%s' % (self.sellitem.id, self.bar.id), {'stockitem': stockitem.id, 'unit_factor': 0.5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['stockitems']), 2)
+        self.assertFalse(SellItem.objects.filter(pk=new_sellitem.pk).exists())
+        self.assertEqual(reload(stockitem).unit_factor, 1)
+
+        response = self.client.put('/sellitem/%d/merge/?bar=%s' % (self.sellitem.id, self.bar.id), {'sellitem': self.sellitem3.id})
+        self.assertEqual(response.status_code, 403)
+
+    def test_refresh_fuzzy_values(self):
+        from django.core.management import call_command
+        SellItem.objects.filter(pk=self.sellitem.pk).update(fuzzy_price=42)
+        call_command('refresh_fuzzy_values', stdout=open('/dev/null', 'w'))
+        self.assertAlmostEqual(reload(self.sellitem).fuzzy_price, 1.2)
+
 
 class ItemDetailsTests(ItemTests, AutoTestMixin):
     @classmethod
@@ -235,6 +305,80 @@ class BuyItemTests(ItemTests, AutoTestMixin):
         self.update_data = BuyItemSerializer(self.buyitem).data
         self.update_data['itemqty'] = 2
 
+    def test_by_barcode(self):
+        BuyItem.objects.filter(pk=self.buyitem2.pk).update(barcode='3017620422003')
+        response = self.client.get('/buyitem/by_barcode/?bar=%s&barcode=3017620422003,404&barcode=3017620422003' % self.bar.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data.keys()), {'3017620422003', '404'})
+        self.assertIsNone(response.data['404'])
+        entry = response.data['3017620422003']
+        self.assertEqual(entry['buyitem']['id'], self.buyitem2.id)
+        self.assertEqual(entry['details']['name'], "Pizza")
+        self.assertEqual(entry['buyitemprice'], {'id': self.buyitemprice2.id, 'price': 2})
+
+        response = self.client.get('/buyitem/by_barcode/?barcode=3017620422003')
+        self.assertIsNone(response.data['3017620422003']['buyitemprice'])
+        response = self.client.get('/buyitem/by_barcode/')
+        self.assertEqual(response.status_code, 400)
+
+    def test_by_barcode_cache(self):
+        url = '/buyitem/by_barcode/?bar=%s&barcode=42' % self.bar.id
+        barcode_cache.ttl = buyitemprice_cache.ttl = 60
+        try:
+            # Unknown barcodes are not cached: the bar (BAR_CACHE_TTL is 0 in tests) and the barcode are fetched
+            self.client.get(url)
+            with self.assertNumQueries(2):
+                response = self.client.get(url)
+            self.assertIsNone(response.data['42'])
+
+            # Saving a BuyItem or a BuyItemPrice drops the stale entries
+            self.buyitem2.barcode = '42'
+            self.buyitem2.save()
+            response = self.client.get(url)
+            self.assertEqual(response.data['42']['buyitemprice']['price'], 2)
+
+            self.buyitemprice2.price = 3
+            self.buyitemprice2.save()
+            with self.assertNumQueries(2):
+                response = self.client.get(url)
+            self.assertEqual(response.data['42']['buyitemprice']['price'], 3)
+
+            # Known barcodes are served from the cache
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertEqual(response.data['42']['buyitemprice']['price'], 3)
+        finally:
+            barcode_cache.ttl = buyitemprice_cache.ttl = 0
+            barcode_cache.clear()
+            buyitemprice_cache.clear()
+
+    def test_by_barcode_registered_elsewhere(self):
+        from django.db.models.signals import post_save
+        from bars_items.models.buyitem import invalidate_barcode_cache, invalidate_buyitemprice_cache
+        url = '/buyitem/by_barcode/?bar=%s&barcode=43' % self.bar.id
+        barcode_cache.ttl = buyitemprice_cache.ttl = 60
+        try:
+            response = self.client.get(url)
+            self.assertIsNone(response.data['43'])
+
+            # Registered by another process: this one's caches are not invalidated
+            post_save.disconnect(invalidate_barcode_cache, sender=BuyItem)
+            post_save.disconnect(invalidate_buyitemprice_cache, sender=BuyItemPrice)
+            try:
+                buyitem = BuyItem.objects.create(details=self.itemdetails, itemqty=1, barcode='43')
+                BuyItemPrice.objects.create(bar=self.bar, buyitem=buyitem, price=4)
+            finally:
+                post_save.connect(invalidate_barcode_cache, sender=BuyItem)
+                post_save.connect(invalidate_buyitemprice_cache, sender=BuyItemPrice)
+
+            response = self.client.get(url)
+            self.assertEqual(response.data['43']['buyitem']['id'], buyitem.id)
+            self.assertEqual(response.data['43']['buyitemprice']['price'], 4)
+        finally:
+            barcode_cache.ttl = buyitemprice_cache.ttl = 0
+            barcode_cache.clear()
+            buyitemprice_cache.clear()
+
 
 class StockItemTests(ItemTests, AutoTestBarMixin):
     @classmethod
@@ -253,6 +397,249 @@ class StockItemTests(ItemTests, AutoTestBarMixin):
         self.update_data['price'] = 4
 
 
+class ItemSearchTests(ItemTests):
+    @classmethod
+    def setUpTestData(self):
+        super(ItemSearchTests, self).setUpTestData()
+        self.creme, _ = ItemDetails.objects.get_or_create(name=u"Cr\xe8me br\xfbl\xe9e", brand="Bonne Maman", keywords="dessert")
+        self.chocolat_sellitem, _ = SellItem.objects.get_or_create(bar=self.bar, name=u"Chocolat chaud", keywords="boisson")
+
+    def search(self, **params):
+        response = self.client.get('/item/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return [(r['_type'], r['id']) for r in response.data]
+
+    def test_search(self):
+        # Accents are ignored, in both directions
+        self.assertEqual(self.search(q='creme bru', type='ItemDetails'), [('ItemDetails', self.creme.id)])
+        self.assertEqual(self.search(q=u'cr\xe8m', type='ItemDetails'), [('ItemDetails', self.creme.id)])
+        # Keywords, brands and substrings
+        self.assertEqual(self.search(q='dessert', type='ItemDetails'), [('ItemDetails', self.creme.id)])
+        self.assertEqual(self.search(q='maman', type='ItemDetails'), [('ItemDetails', self.creme.id)])
+        self.assertEqual(self.search(q='rul', type='ItemDetails'), [('ItemDetails', self.creme.id)])
+        self.assertEqual(self.search(q='creme pizza'), [])
+
+        # Exact names come first; sellitems are only returned for the given bar
+        self.assertEqual(self.search(q='chocolat', type='SellItem'), [])
+        self.assertEqual(self.search(q='chocolat', type='SellItem', bar=self.bar.id),
+            [('SellItem', self.sellitem.id), ('SellItem', self.chocolat_sellitem.id)])
+        self.assertEqual(self.search(q='boiss', bar=self.bar.id), [('SellItem', self.chocolat_sellitem.id)])
+        self.assertEqual(self.search(q='chocolat'), [('ItemDetails', self.itemdetails.id), ('BuyItem', self.buyitem.id)])
+        self.assertEqual(self.search(q='chocolat', limit=1), [('ItemDetails', self.itemdetails.id)])
+        for limit in ['0', '-5', 'ten']:
+            self.assertEqual(self.client.get('/item/search/', {'q': 'chocolat', 'limit': limit}).status_code, 400)
+
+    def test_search_incremental(self):
+        with self.settings(ITEM_SEARCH_INDEX_TTL=600):
+            try:
+                self.search(q='x')
+                with self.assertNumQueries(0):
+                    self.assertEqual(self.search(q='pizza', type='ItemDetails'), [('ItemDetails', self.itemdetails2.id)])
+
+                self.itemdetails2.name = u"Quiche"
+                self.itemdetails2.save()
+                self.buyitem2.barcode = "3017620422003"
+                self.buyitem2.save()
+                sellitem = SellItem.objects.create(bar=self.bar, name="Quiche lorraine")
+                with self.assertNumQueries(1):  # The bar
+                    self.assertEqual(self.search(q='quich', bar=self.bar.id),
+                        [('ItemDetails', self.itemdetails2.id), ('BuyItem', self.buyitem2.id), ('SellItem', sellitem.id)])
+                self.assertEqual(self.search(q='pizza'), [])
+                self.assertEqual(self.search(q='301762'), [('BuyItem', self.buyitem2.id)])
+
+                sellitem.delete()
+                self.assertEqual(self.search(q='lorraine', bar=self.bar.id), [])
+            finally:
+                search_index.reset()
+
+
+class CatalogTests(ItemTests):
+    def test_catalog(self):
+        url = '/bar/%s/catalog/' % self.bar.id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(etag, '"%s"' % response.data['version'])
+        sellitems = response.data['sellitems']
+        self.assertNotIn('bar', sellitems['fields'])
+        rows = [dict(zip(sellitems['fields'], row)) for row in sellitems['rows']]
+        self.assertEqual(set(r['id'] for r in rows), {self.sellitem.id, self.sellitem2.id})
+        self.assertEqual([r[0] for r in response.data['buyitemprices']['rows']], [self.buyitemprice2.id])
+        # Shared tables are limited to the rows used by the bar's stockitems and prices
+        self.assertEqual(sorted(r[0] for r in response.data['itemdetails']['rows']), [self.itemdetails.id, self.itemdetails2.id])
+        self.assertEqual(sorted(r[0] for r in response.data['buyitems']['rows']), [self.buyitem.id, self.buyitem2.id])
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # A modification changes the version; a delta only holds the modified rows
+        self.stockitem.qty = 3
+        self.stockitem.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        response = self.client.get(url, {'since': self.stockitem.last_modified.isoformat()})
+        self.assertEqual([r[0] for r in response.data['stockitems']['rows']], [self.stockitem.id])
+        self.assertEqual([r[0] for r in response.data['sellitems']['rows']], [self.sellitem.id])  # Its fuzzy values changed
+        self.assertEqual(response.data['buyitemprices']['rows'], [])
+        self.assertEqual(set(response.data['sellitems']['ids']), {self.sellitem.id, self.sellitem2.id})
+
+    def test_catalog_shared_rows(self):
+        url = '/bar/%s/catalog/' % self.bar.id
+        itemdetails3 = ItemDetails.objects.create(name="Unused")
+        buyitem3 = BuyItem.objects.create(details=itemdetails3, itemqty=1)
+        response = self.client.get(url)
+        self.assertNotIn(itemdetails3.id, [r[0] for r in response.data['itemdetails']['rows']])
+        self.assertNotIn(buyitem3.id, [r[0] for r in response.data['buyitems']['rows']])
+        etag = response['ETag']
+
+        # Rows that get used are in the next delta, although they weren't modified
+        since = timezone.now()
+        stockitem3 = StockItem.objects.create(bar=self.bar, sellitem=self.sellitem2, details=itemdetails3, price=1)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, {'since': since.isoformat()})
+        self.assertEqual([r[0] for r in response.data['stockitems']['rows']], [stockitem3.id])
+        self.assertEqual([r[0] for r in response.data['itemdetails']['rows']], [itemdetails3.id])
+        self.assertEqual([r[0] for r in response.data['buyitems']['rows']], [buyitem3.id])
+        self.assertIn(self.itemdetails.id, response.data['itemdetails']['ids'])
+
+    def test_catalog_gzip(self):
+        response = self.client.get('/bar/%s/catalog/' % self.bar.id, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        response = self.client.get('/bar/%s/catalog/' % self.bar.id, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_catalog_wrong_since(self):
+        response = self.client.get('/bar/%s/catalog/' % self.bar.id, {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+
+class BuyItemPriceTests(ItemTests):
+    def test_create_inherited_price(self):
+        buyitem = BuyItem.objects.create(details=self.itemdetails2, itemqty=6)
+        self.client.force_authenticate(user=self.staff_user)
+        response = self.client.post('/buyitemprice/?bar=%s' % self.bar.id, {'buyitem': buyitem.id})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['price'], 4)  # 2 for 3 units
+
+    def test_bulk(self):
+        url = '/buyitemprice/bulk/?bar=%s' % self.bar.id
+        items = [
+            {'buyitem': self.buyitem.id, 'price': 5},
+            {'barcode': '111', 'details': self.itemdetails.id, 'itemqty': 5},
+            {'buyitem': self.buyitem2.id},
+        ]
+        response = self.client.post(url, {'items': items}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+        self.client.force_authenticate(user=self.staff_user)
+        response = self.client.post(url, {'items': items + [{'barcode': '222'}, {'buyitem': self.buyitem.id}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(sorted(response.data.keys()), [0, 3, 4])
+        self.assertFalse(BuyItem.objects.filter(barcode='111').exists())
+
+        response = self.client.post(url, {'items': [{'barcode': '111', 'details': self.itemdetails.id, 'itemqty': 0}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, items, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(url, {'items': items}, format='json')
+        self.assertEqual(response.status_code, 201)
+        new_buyitem = BuyItem.objects.get(barcode='111')
+        self.assertEqual(response.data['created_buyitems'], [new_buyitem.id])
+        self.assertEqual(response.data['skipped'], [self.buyitemprice2.id])
+        prices = dict((bip['buyitem'], bip['price']) for bip in response.data['created'])
+        # The new packaging inherits the price per unit given in the same batch
+        self.assertEqual(prices, {self.buyitem.id: 5, new_buyitem.id: 10})
+        self.assertEqual(BuyItemPrice.objects.get(bar=self.bar, buyitem=new_buyitem).price, 10)
+
+
+class PriceHistoryTests(ItemTests):
+    def test_price_at(self):
+        before = timezone.now()
+        stockitem = reload(self.stockitem)
+        stockitem.price = 3
+        stockitem.save()
+        stockitem.save()  # Unchanged prices aren't recorded again
+        self.assertEqual(StockItemPriceHistory.objects.filter(target=stockitem).count(), 2)
+
+        url = '/stockitem/%d/price_at/' % self.stockitem.id
+        self.assertEqual(self.client.get(url, {'date': before.isoformat()}).data['price'], 1)
+        self.assertEqual(self.client.get(url).data['price'], 3)
+        # Dates before the history give the oldest known price
+        self.assertEqual(self.client.get(url, {'date': '2000-01-01'}).data['price'], 1)
+        self.assertEqual(self.client.get(url, {'date': 'yesterday'}).status_code, 400)
+
+        buyitemprice = reload(self.buyitemprice2)
+        buyitemprice.price = 4
+        buyitemprice.save()
+        url = '/buyitemprice/%d/price_at/' % self.buyitemprice2.id
+        self.assertEqual(self.client.get(url, {'date': before.isoformat()}).data['price'], 2)
+        self.assertEqual(self.client.get(url).data['price'], 4)
+
+    def test_prices_at(self):
+        from datetime import timedelta
+        t0 = timezone.now()
+        t1 = t0 + timedelta(seconds=1)
+        stockitem2 = StockItem.objects.create(bar=self.bar, sellitem=self.sellitem2, details=self.itemdetails2, price=7)
+        StockItemPriceHistory.record([(self.stockitem.id, 5), (stockitem2.id, 6)], timestamp=t1)
+        StockItemPriceHistory.record([(self.stockitem.id, 7)], timestamp=t1)  # Same date: the last one wins
+
+        with self.assertNumQueries(2):
+            prices = StockItemPriceHistory.prices_at([self.stockitem.id, stockitem2.id], t1)
+        self.assertEqual(prices, {self.stockitem.id: 7, stockitem2.id: 6})
+        prices = StockItemPriceHistory.prices_at([self.stockitem.id, stockitem2.id], t0)
+        self.assertEqual(prices, {self.stockitem.id: 1, stockitem2.id: 7})
+        # Dates before the history give the oldest known price
+        prices = StockItemPriceHistory.prices_at([self.stockitem.id], t0 - timedelta(days=1000))
+        self.assertEqual(prices, {self.stockitem.id: self.stockitem.price})
+        self.assertEqual(StockItemPriceHistory.price_at(self.stockitem.id, t1), 7)
+
+    def test_valuation(self):
+        stockitem = reload(self.stockitem)
+        stockitem.qty = 10
+        stockitem.save()
+        response = self.client.get('/stockitem/valuation/?bar=%s' % self.bar.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['stockitems'], [{'stockitem': self.stockitem.id, 'qty': 10, 'price': 1, 'value': 10}])
+        self.assertEqual(response.data['total'], 10)
+
+        response = self.client.get('/stockitem/valuation/')
+        self.assertEqual(response.status_code, 400)
+
+
+class ResetBuyItemPricesTests(ItemTests):
+    def test_reset(self):
+        bip = BuyItemPrice.objects.create(bar=self.bar, buyitem=self.buyitem, price=10)
+        BuyItemPrice.objects.create(bar=self.wrong_bar, buyitem=self.buyitem, price=10)
+
+        reports = reset_buyitemprices([self.bar.id], dry_run=True)
+        self.assertEqual(reports[0]['updated'], [{'buyitemprice': bip.id, 'price': 2.5}])
+        self.assertEqual(reload(bip).price, 10)
+
+        reports = reset_buyitemprices()
+        report = dict((r['bar'], r) for r in reports)[self.bar.id]
+        self.assertEqual(len(report['updated']), 1)
+        self.assertEqual(reload(bip).price, 2.5)  # stockitem.price * buyitem.itemqty
+        self.assertEqual([o['buyitemprice'] for o in report['orphans']], [self.buyitemprice2.id])
+        self.assertEqual(reload(self.buyitemprice2).price, 2)
+        # No stockitem for Chocolat in the other bar
+        self.assertEqual(len(dict((r['bar'], r) for r in reports)[self.wrong_bar.id]['orphans']), 1)
+
+        report = reset_buyitemprices([self.bar.id])[0]
+        self.assertEqual((report['updated'], report['unchanged']), ([], 1))
+
+    def test_command(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        out = StringIO()
+        call_command('reset_buyitemprices', bar=[self.bar.id], stdout=out)
+        self.assertIn("%s: 0 updated, 0 unchanged, 1 orphans" % self.bar.id, out.getvalue())
+
+
 class SuggestedItemTests(APITestCase):
     @classmethod
     def setUpTestData(self):
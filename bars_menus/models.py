@@ -1,11 +1,11 @@
 from django.db import models
 from django.http import Http404
 
-from rest_framework import serializers, viewsets
+from rest_framework import serializers, viewsets, filters
 from rest_framework.response import Response
 
 from bars_django.utils import VirtualField, permission_logic, CurrentBarCreateOnlyDefault, CurrentUserCreateOnlyDefault
-from bars_core.perms import BarRolePermissionLogic, PerBarPermissionsOrObjectPermissionsOrAnonReadOnly
+from bars_core.perms import BarRolePermissionLogic, PerBarPermissionsOrObjectPermissionsOrAnonReadOnly, PermissionFilterBackend
 from bars_core.models.bar import Bar
 from bars_core.models.user import User
 from bars_items.models.sellitem import SellItem
@@ -102,6 +102,7 @@ class MenuViewSet(viewsets.ModelViewSet):
     queryset = Menu.objects.all()
     serializer_class = MenuSerializer
     permission_classes = (PerBarPermissionsOrObjectPermissionsOrAnonReadOnly,)
+    filter_backends = (PermissionFilterBackend, filters.DjangoFilterBackend, filters.SearchFilter)
     filter_fields = {
         'bar': ['exact'],
         'user': ['exact']
@@ -8,3 +8,16 @@ class MenuOwnerPermissionLogic(AuthorPermissionLogic):
             return False
 
         return super(MenuOwnerPermissionLogic, self).has_perm(user, perm, obj)
+
+    def filter_queryset(self, user, perm, queryset):
+        """
+        Queryset form of has_perm: return the objects of queryset on which user has perm.
+        """
+        if not user.is_authenticated() or not user.is_active:
+            return queryset.none()
+
+        if self.any_permission \
+                or (self.change_permission and perm == self.get_full_permission_string('change')) \
+                or (self.delete_permission and perm == self.get_full_permission_string('delete')):
+            return queryset.filter(**{self.field_name: user})
+        return queryset.none()
@@ -108,3 +108,12 @@ class MenuTests(APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data["name"], 'Petit dejeuner')
         self.assertEqual(len(response.data["items"]), 2)
+
+    def test_filter_perm(self):
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.get('/menu/?perm=change')
+        self.assertEqual(len(response.data), 1)
+
+        self.client.force_authenticate(user=self.user2)
+        response = self.client.get('/menu/?perm=change')
+        self.assertEqual(len(response.data), 0)
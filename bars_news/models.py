@@ -4,7 +4,7 @@ from rest_framework import serializers, viewsets, filters
 from bars_django.utils import VirtualField, permission_logic, CurrentBarCreateOnlyDefault, CurrentUserCreateOnlyDefault
 from bars_core.models.bar import Bar
 from bars_core.models.user import User
-from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLogic
+from bars_core.perms import PerBarPermissionsOrAnonReadOnly, BarRolePermissionLogic, PermissionFilterBackend
 
 
 @permission_logic(BarRolePermissionLogic())
@@ -48,7 +48,7 @@ class NewsViewSet(viewsets.ModelViewSet):
     queryset = News.objects.all()
     serializer_class = NewsSerializer
     permission_classes = (PerBarPermissionsOrAnonReadOnly,)
-    filter_backends = (NewsFilterBackend, filters.DjangoFilterBackend, filters.SearchFilter)
+    filter_backends = (NewsFilterBackend, PermissionFilterBackend, filters.DjangoFilterBackend, filters.SearchFilter)
     filter_fields = {
         'timestamp': ['lte', 'gte'],
         'author': ['exact']}
@@ -29,6 +29,22 @@ class NewsTests(APITestCase):
         self.assertEqual(response.data[0]['name'], self.news.name)
 
 
+    def test_filter_perm(self):
+        News.objects.create(bar=self.bar2, author=self.user, name='other', text='')
+
+        self.client.force_authenticate(user=self.user2)
+        with self.assertNumQueries(1):
+            response = self.client.get('/news/?perm=change')
+        self.assertEqual([n['id'] for n in response.data], [self.news.id])
+
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get('/news/?perm=change')
+        self.assertEqual(len(response.data), 0)
+
+        response = self.client.get('/news/')
+        self.assertEqual(len(response.data), 2)
+
+
     def test_create_news(self):
         # Unauthenticated
         response = self.client.post('/news/?bar=natationjone', self.create_data)
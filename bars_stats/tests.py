@@ -0,0 +1,88 @@
+from rest_framework.test import APITestCase
+
+from bars_core.models.bar import Bar
+from bars_core.models.user import User
+from bars_core.models.account import Account
+from bars_transactions.models import Transaction
+
+
+class StatsBatchTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(StatsBatchTests, self).setUpTestData()
+        self.bar, _ = Bar.objects.get_or_create(id='natationjone')
+
+        self.user, _ = User.objects.get_or_create(username='nadrieril')
+        self.user2, _ = User.objects.get_or_create(username='ntag')
+        self.account, _ = Account.objects.get_or_create(owner=self.user, bar=self.bar)
+        self.account2, _ = Account.objects.get_or_create(owner=self.user2, bar=self.bar)
+
+        for (account, delta, type) in [(self.account, -2, 'buy'), (self.account, -3, 'meal'), (self.account2, 10, 'deposit')]:
+            t = Transaction.objects.create(bar=self.bar, author=self.user, type=type)
+            t.accountoperation_set.create(target=account, delta=delta)
+
+        self.url = '/stats/batch/?bar=%s' % self.bar.id
+        self.admin = User.objects.create_superuser('admin', 'admin')
+
+    def setUp(self):
+        self.client.force_authenticate(user=self.admin)
+
+    def test_batch_no_series(self):
+        response = self.client.post(self.url, {}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_wrong_series(self):
+        data = {'series': [{'entity': 'sellitem', 'id': 1, 'aggregate': 'total_spent'}]}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_wrong_dates(self):
+        series = [{'entity': 'account', 'id': self.account.id}]
+        for dates in [{'date_start': 12}, {'date_start': None}, {'date_start': '2015-01-01T00:00:00.000Z', 'date_end': None}, {'date_start': 'yesterday'}]:
+            dates['series'] = series
+            response = self.client.post(self.url, dates, format='json')
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(self.url, [series], format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_permissions(self):
+        data = {'series': [
+            {'entity': 'account', 'id': self.account.id},
+            {'entity': 'user', 'id': self.user.id},
+            {'entity': 'stockitem', 'id': 1},
+        ]}
+        self.client.force_authenticate(user=None)
+        response = self.client.post(self.url, data, format='json')
+        self.assertIn(response.status_code, (401, 403))
+
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        data['series'].append({'entity': 'account', 'id': self.account2.id, 'aggregate': 'total_spent'})
+        data['series'].append({'entity': 'user', 'id': self.user2.id})
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_batch_matches_single_routes(self):
+        data = {'series': [
+            {'entity': 'account', 'id': self.account.id},
+            {'entity': 'account', 'id': self.account2.id},
+            {'entity': 'account', 'id': self.account.id, 'aggregate': 'total_spent', 'types': ['buy']},
+            {'entity': 'user', 'id': self.user.id, 'interval': 'months'},
+        ]}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 4)
+
+        single = self.client.get('/account/%d/stats/?bar=%s' % (self.account.id, self.bar.id))
+        self.assertEqual([list(x) for x in response.data[0]], [list(x) for x in single.data])
+        self.assertAlmostEqual(sum(x[1] for x in response.data[1]), 10)
+
+        single = self.client.get('/account/%d/total_spent/?bar=%s&type=buy' % (self.account.id, self.bar.id))
+        self.assertAlmostEqual(response.data[2]['total_spent'], single.data['total_spent'])
+
+        self.client.force_authenticate(user=self.user)
+        single = self.client.get('/user/%d/stats/?bar=%s&interval=months' % (self.user.id, self.bar.id))
+        self.assertEqual([list(x) for x in response.data[3]], [list(x) for x in single.data])
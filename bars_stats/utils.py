@@ -82,6 +82,22 @@ def validate_date(d):
     except ValueError:
         return False
 
+def get_date_range(params):
+    """
+    Return the (date_start, date_end) range given in params, or None if no date_start was given.
+    """
+    date_start = params.get('date_start', None)
+    date_end = params.get('date_end', datetime.now())
+    if date_start is None:
+        return None
+
+    # Check that date_start and date_end are well-formatted
+    if not validate_date(date_start):
+        raise ValidationError('Non-valid date_start format')
+    if not (date_end.__class__ == datetime or validate_date(date_end)):
+        raise ValidationError('Non-valid date_end format')
+    return (date_start, date_end)
+
 def time_series(qs, date_field, aggregate=None, interval='days', engine=None):
     aggregate = aggregate or Count('id')
     engine = engine or _guess_engine(qs)
@@ -101,15 +117,9 @@ def compute_transaction_stats(request, filter=id, aggregate=None):
     if request.bar is not None:
         qs = qs.filter(bar=request.bar)
 
-    date_start = request.query_params.get('date_start', None)
-    date_end = request.query_params.get('date_end', datetime.now())
-    if date_start is not None:
-        # Check that date_start and date_end are well-formatted
-        if not validate_date(date_start):
-            raise ValidationError('Non-valid date_start format')
-        if not (date_end.__class__ == datetime or validate_date(date_end)):
-            raise ValidationError('Non-valid date_end format')
-        qs = qs.filter(timestamp__range=(date_start, date_end))
+    date_range = get_date_range(request.query_params)
+    if date_range is not None:
+        qs = qs.filter(timestamp__range=date_range)
 
     types = request.query_params.getlist("type")
     if len(types) != 0:
@@ -128,15 +138,9 @@ def compute_total_spent(request, filter=id, aggregate=None):
     if request.bar is not None:
         qs = qs.filter(bar=request.bar)
 
-    date_start = request.query_params.get('date_start', None)
-    date_end = request.query_params.get('date_end', datetime.now())
-    if date_start is not None:
-        # Check that date_start and date_end are well-formatted
-        if not validate_date(date_start):
-            raise ValidationError('Non-valid date_start format')
-        if not (date_end.__class__ == datetime or validate_date(date_end)):
-            raise ValidationError('Non-valid date_end format')
-        qs = qs.filter(timestamp__range=(date_start, date_end))
+    date_range = get_date_range(request.query_params)
+    if date_range is not None:
+        qs = qs.filter(timestamp__range=date_range)
 
     types = request.query_params.getlist("type")
     if len(types) != 0:
@@ -156,15 +160,9 @@ def compute_ranking(request, model=Account, t_path='accountoperation__transactio
 
     t_filter[t_path + 'canceled'] = False
 
-    date_start = request.query_params.get('date_start', None)
-    date_end = request.query_params.get('date_end', datetime.now())
-    if date_start is not None:
-        # Check that date_start and date_end are well-formatted
-        if not validate_date(date_start):
-            raise ValidationError('Non-valid date_start format')
-        if not (date_end.__class__ == datetime or validate_date(date_end)):
-            raise ValidationError('Non-valid date_end format')
-        t_filter[t_path + 'timestamp__range'] = (date_start, date_end)
+    date_range = get_date_range(request.query_params)
+    if date_range is not None:
+        t_filter[t_path + 'timestamp__range'] = date_range
 
     types = request.query_params.getlist("type")
     if len(types) != 0:
@@ -175,3 +173,72 @@ def compute_ranking(request, model=Account, t_path='accountoperation__transactio
     qs = model.objects.filter(**t_filter)
 
     return qs.values('id').annotate(val=annotate)
+
+
+batch_stats_entities = {
+    'account': ('accountoperation__target', lambda: Sum('accountoperation__delta')),
+    'user': ('accountoperation__target__owner', lambda: Sum('accountoperation__delta')),
+    'stockitem': ('itemoperation__target', lambda: Sum(F('itemoperation__delta') * F('itemoperation__target__unit_factor'))),
+    'sellitem': ('itemoperation__target__sellitem', lambda: Sum(F('itemoperation__delta') * F('itemoperation__target__unit_factor'))),
+}
+batch_stats_aggregates = ('stats', 'total_spent')
+batch_stats_intervals = ('minutes', 'hours', 'days', 'weeks', 'months', 'years', 'hours_of_day', 'days_of_week', 'months_of_year')
+
+def grouped_time_series(qs, key_field, date_field, aggregate, interval='days', engine=None):
+    """
+    Same as time_series, but computes one series per value of key_field in a single query.
+    Return a dict {key: [(date, value), ...]}.
+    """
+    engine = engine or _guess_engine(qs)
+
+    interval_sql = _get_interval_sql(date_field, interval, engine)
+    aggregate_data = qs.extra(select = {'agg_date': interval_sql}).\
+                            order_by().values(key_field, 'agg_date').\
+                            annotate(agg=aggregate)
+
+    series = {}
+    for x in aggregate_data:
+        series.setdefault(x[key_field], []).append((x['agg_date'], x['agg']))
+    return series
+
+def compute_batch_stats(bar, params, specs):
+    """
+    Compute several stats series at once, sharing bar and date filtering.
+    Each spec is a dict with keys 'entity', 'id', 'aggregate', 'types' and 'interval'.
+    Series which only differ by their 'id' are computed in a single grouped query.
+    Return the list of results, in the same order as specs.
+    """
+    qs = Transaction.objects.filter(canceled=False)
+
+    if bar is not None:
+        qs = qs.filter(bar=bar)
+
+    date_range = get_date_range(params)
+    if date_range is not None:
+        qs = qs.filter(timestamp__range=date_range)
+
+    groups = {}
+    for i, spec in enumerate(specs):
+        key = (spec['entity'], spec['aggregate'], tuple(sorted(set(spec['types']))), spec['interval'])
+        groups.setdefault(key, []).append(i)
+
+    results = [None] * len(specs)
+    for (entity, aggregate, types, interval), indices in groups.items():
+        key_field, make_aggregate = batch_stats_entities[entity]
+        ids = set(specs[i]['id'] for i in indices)
+
+        group_qs = qs.filter(**{key_field + '__in': ids})
+        if len(types) != 0:
+            group_qs = group_qs.filter(type__in=types)
+
+        if aggregate == 'stats':
+            series = grouped_time_series(group_qs, key_field, 'timestamp', make_aggregate(), interval)
+            for i in indices:
+                results[i] = sorted(series.get(specs[i]['id'], []))
+        else:
+            totals = group_qs.order_by().values(key_field).annotate(total_spent=Sum('accountoperation__delta'))
+            totals = dict((x[key_field], x['total_spent']) for x in totals)
+            for i in indices:
+                results[i] = {'total_spent': totals.get(specs[i]['id'])}
+
+    return results
@@ -0,0 +1,92 @@
+from rest_framework import serializers, permissions
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from bars_core.models.user import User
+from bars_core.models.account import Account
+from bars_stats.utils import compute_batch_stats, batch_stats_entities, batch_stats_aggregates, batch_stats_intervals, validate_date
+
+
+class StatsSeriesSerializer(serializers.Serializer):
+    entity = serializers.ChoiceField(choices=sorted(batch_stats_entities.keys()))
+    id = serializers.IntegerField()
+    aggregate = serializers.ChoiceField(choices=batch_stats_aggregates, default='stats')
+    types = serializers.ListField(child=serializers.CharField(max_length=25), default=[])
+    interval = serializers.ChoiceField(choices=batch_stats_intervals, default='days')
+
+    def validate(self, data):
+        if data['aggregate'] == 'total_spent' and data['entity'] not in ('account', 'user'):
+            raise serializers.ValidationError("total_spent can only be computed for accounts and users")
+        return data
+
+
+def get_forbidden_series(user, specs):
+    """
+    Return the indices of the series on users or accounts that user may not read: users can read their own
+    series and those of their accounts, managers those they can change.
+    """
+    if user.is_superuser:
+        return []
+    user_ids = set(s['id'] for s in specs if s['entity'] == 'user')
+    account_ids = set(s['id'] for s in specs if s['entity'] == 'account')
+    allowed = {
+        'user': set(u.id for u in User.objects.filter(id__in=user_ids)
+                    if u.id == user.id or user.has_perm('bars_core.change_user', u)),
+        'account': set(a.id for a in Account.objects.filter(id__in=account_ids).select_related('bar')
+                       if a.owner_id == user.id or user.has_perm('bars_core.change_account', a)),
+    }
+    return [i for (i, s) in enumerate(specs) if s['entity'] in allowed and s['id'] not in allowed[s['entity']]]
+
+
+class StatsBatchView(APIView):
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, format=None):
+        """
+        Compute several stats series at once.
+        Each series is described by an entity (account, user, stockitem or sellitem), the id of this entity,
+        an aggregate ('stats' for a time series, 'total_spent' for a total), the types of transactions to consider
+        and an interval.
+        Series on users and accounts are only allowed to their owner and to the managers of these users or accounts.
+        Response format: [[["*date*", value], ...] or {"total_spent": value}, ...], in the same order as the given series
+        ---
+        omit_serializer: true
+        parameters_strategy: replace
+        parameters:
+            - name: bar
+              required: false
+              type: string
+              paramType: query
+            - name: series
+              required: true
+              type: array
+              description: 'List of series, e.g. [{"entity": "account", "id": 3, "aggregate": "stats", "types": ["buy", "meal"], "interval": "days"}, ...]'
+              paramType: body
+            - name: date_start
+              required: false
+              type: datetime
+              paramType: body
+            - name: date_end
+              required: false
+              type: datetime
+              paramType: body
+        """
+        if not isinstance(request.data, dict):
+            return Response("Expected an object with series", 400)
+        series = request.data.get('series')
+        if not series:
+            return Response("Give me some series to compute", 400)
+        for key in ('date_start', 'date_end'):
+            value = request.data.get(key)
+            if key in request.data and not (isinstance(value, basestring) and validate_date(value)):
+                return Response("Non-valid %s format" % key, 400)
+
+        unsrz = StatsSeriesSerializer(data=series, many=True)
+        unsrz.is_valid(raise_exception=True)
+
+        forbidden = get_forbidden_series(request.user, unsrz.validated_data)
+        if forbidden:
+            return Response("You cannot read series %s" % ", ".join(str(i) for i in forbidden), 403)
+
+        stats = compute_batch_stats(request.bar, request.data, unsrz.validated_data)
+        return Response(stats, 200)
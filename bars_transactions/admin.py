@@ -1,6 +1,8 @@
 from django.contrib import admin
-from bars_transactions.models import Transaction, AccountOperation, ItemOperation
+from bars_transactions.models import Transaction, AccountOperation, ItemOperation, AgiosRun, AgiosCheckpoint
 
 admin.site.register(Transaction)
 admin.site.register(AccountOperation)
 admin.site.register(ItemOperation)
+admin.site.register(AgiosRun)
+admin.site.register(AgiosCheckpoint)
@@ -0,0 +1,151 @@
+"""
+Agios engine.
+
+Each bar is processed in one database transaction: the overdrawn accounts due for agios are locked and charged
+with one AgiosTransaction each, one bulk insert of AccountOperations and one UPDATE of the balances, and an
+AgiosCheckpoint records the bar and the charged accounts. Notification mails are sent afterwards, through a single
+connection. Bars can be processed in parallel (see map_bars).
+
+A run (AgiosRun) charges the agios of one day. It can be restarted safely: since a bar is committed at once with
+its checkpoint, a crashed run leaves each bar either fully charged or untouched, and the next run resumes the
+unfinished one, with its day, skipping the bars that have a checkpoint. The checkpoints being unique per bar and day,
+two concurrent runs cannot charge a bar twice either.
+"""
+import json
+import math
+from datetime import timedelta
+from functools import partial
+
+from django.core.mail import get_connection, EmailMessage
+from django.db import transaction
+from django.db.models import Case, When, Value, FloatField
+from django.utils import timezone
+
+from bars_django.utils import map_bars
+from bars_core.models.bar import Bar
+from bars_core.models.user import get_default_user
+from bars_core.models.account import Account
+from bars_transactions.models import Transaction, AccountOperation, AgiosRun, AgiosCheckpoint
+
+
+def compute_agios(bar, day):
+    """
+    Return [(account, amount)] for the accounts of the bar to charge on `day`.
+    Accounts are locked until the end of the database transaction.
+    """
+    settings = bar.settings
+    if not settings.agios_enabled:
+        return []
+
+    # overdrawn_since is a date: a threshold of 2.5 days means 3 full days
+    since = day - timedelta(math.ceil(settings.agios_threshold))
+    accounts = list(Account.objects.select_for_update()
+                    .filter(bar=bar, deleted=False, money__lt=0, overdrawn_since__lte=since)
+                    .select_related('owner'))
+    return [(a, abs(a.money) * settings.agios_factor) for a in accounts]
+
+
+def write_agios(bar, charges):
+    """
+    Create the AgiosTransactions and their AccountOperations, and update the balances.
+    """
+    author = get_default_user()
+    # Created one by one, to get their ids (bulk_create doesn't set them)
+    transactions = [Transaction.objects.create(bar=bar, author=author, type='agios', moneyflow=-amount)
+                    for (_, amount) in charges]
+
+    AccountOperation.objects.bulk_create([
+        AccountOperation(transaction=t, target=a, prev_value=a.money, delta=-amount, next_value=a.money - amount)
+        for (t, (a, amount)) in zip(transactions, charges)])
+
+    # Balances stay negative, so overdrawn_since doesn't change
+    Account.objects.filter(pk__in=[a.id for (a, _) in charges]).update(
+        money=Case(*[When(pk=a.id, then=Value(a.money - amount)) for (a, amount) in charges], output_field=FloatField()),
+        last_modified=timezone.now())
+
+
+def send_agios_mails(bar, charges):
+    from bars_transactions.serializers import agios_notification_mail
+    messages = []
+    for (account, amount) in charges:
+        if account.owner.email:
+            body = agios_notification_mail['message'].format(amount=amount, solde=account.money - amount, bar=bar.name)
+            messages.append(EmailMessage(agios_notification_mail['subject'], body,
+                                         "babe@binets.polytechnique.fr", [account.owner.email]))
+    if messages:
+        get_connection().send_messages(messages)
+
+
+def apply_bar_agios(bar_id, day, run_id=None, dry_run=False):
+    """
+    Charge the agios of `day` in a bar, as part of the given run, and return a report:
+    `{bar, day, charged: [{account, owner, money, amount}], total, skipped}`, plus `error` if the bar failed;
+    if the bar was already processed for `day`, `already_charged` is set and `skipped` is the number of accounts
+    charged then.
+    With `dry_run`, nothing is written.
+    """
+    report = {'bar': bar_id, 'day': day.isoformat(), 'charged': [], 'total': 0, 'skipped': 0}
+    try:
+        bar = Bar.objects.select_related('settings').get(pk=bar_id)
+        with transaction.atomic():
+            checkpoint = AgiosCheckpoint.objects.filter(bar=bar, day=day).first()
+            if checkpoint is not None:
+                report['already_charged'] = True
+                report['skipped'] = len(json.loads(checkpoint.accounts))
+                return report
+            charges = compute_agios(bar, day)
+            if not dry_run:
+                if charges:
+                    write_agios(bar, charges)
+                AgiosCheckpoint.objects.create(run_id=run_id, bar=bar, day=day, accounts=json.dumps([a.id for (a, _) in charges]))
+    except Exception as e:
+        report['error'] = "%s: %s" % (e.__class__.__name__, e)
+        return report
+
+    report['charged'] = [{'account': a.id, 'owner': a.owner.username, 'money': a.money, 'amount': amount}
+                         for (a, amount) in charges]
+    report['total'] = sum(amount for (_, amount) in charges)
+    if charges and not dry_run:
+        send_agios_mails(bar, charges)
+    return report
+
+
+def get_agios_run(day=None):
+    """
+    Return the oldest unfinished run to resume (for `day`, if given), or a new run for `day` (default: today).
+    """
+    runs = AgiosRun.objects.filter(finished__isnull=True)
+    if day is not None:
+        runs = runs.filter(day=day)
+    run = runs.order_by('started', 'id').first()
+    if run is None:
+        run = AgiosRun.objects.create(day=day or timezone.localtime(timezone.now()).date())
+    return run
+
+
+def apply_agios(bar_ids=None, dry_run=False, processes=1, day=None):
+    """
+    Charge agios in the given bars (default: all), in parallel if `processes` > 1, and return the bars' reports.
+    Unfinished runs are resumed first, then, unless `day` is given, today's agios are charged; a run is finished
+    when all its bars succeeded, and the bars' failures stop the following runs.
+    With `dry_run`, nothing is written, and the reports are those of the next run.
+    """
+    bar_ids = list(bar_ids if bar_ids is not None else Bar.objects.values_list('id', flat=True))
+    today = timezone.localtime(timezone.now()).date()
+
+    if dry_run:
+        run = AgiosRun.objects.filter(finished__isnull=True).order_by('started', 'id').first()
+        day = day or (run and run.day) or today
+        return map_bars(partial(apply_bar_agios, day=day, dry_run=True), bar_ids, processes)
+
+    reports = []
+    while True:
+        run = get_agios_run(day)
+        run_reports = map_bars(partial(apply_bar_agios, day=run.day, run_id=run.id), bar_ids, processes)
+        reports += run_reports
+        if any('error' in r for r in run_reports):
+            break
+        AgiosRun.objects.filter(pk=run.pk).update(finished=timezone.now())
+        if day is not None or run.day >= today:
+            break
+    return reports
\ No newline at end of file
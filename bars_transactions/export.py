@@ -0,0 +1,96 @@
+import csv
+import heapq
+import json
+
+from django.db.models import Q
+
+from bars_transactions.models import AccountOperation, ItemOperation
+
+
+EXPORT_CHUNK_SIZE = 2000
+
+export_columns = ['timestamp', 'transaction', 'type', 'author', 'canceled',
+                  'operation', 'target', 'delta', 'prev_value', 'next_value', 'running_total']
+
+_operation_fields = ('transaction__timestamp', 'transaction_id', 'transaction__type', 'transaction__author_id',
+                     'transaction__canceled', 'target_id', 'delta', 'prev_value', 'next_value', 'id')
+
+
+def iter_operations(model, bar, date_start=None, date_end=None):
+    """
+    Iterate over the operations of the given model in the bar, in chronological order (by transaction timestamp, then
+    transaction and operation ids, as propagate). Rows are fetched by chunks of EXPORT_CHUNK_SIZE (keyset pagination
+    on these three columns), so memory stays flat.
+    """
+    qs = model.objects.filter(transaction__bar=bar)
+    if date_start is not None:
+        qs = qs.filter(transaction__timestamp__gte=date_start)
+    if date_end is not None:
+        qs = qs.filter(transaction__timestamp__lte=date_end)
+    qs = qs.order_by('transaction__timestamp', 'transaction_id', 'id').values_list(*_operation_fields)
+
+    chunk = list(qs[:EXPORT_CHUNK_SIZE])
+    while True:
+        for row in chunk:
+            yield row
+        if len(chunk) < EXPORT_CHUNK_SIZE:
+            return
+        (timestamp, transaction, id) = (chunk[-1][0], chunk[-1][1], chunk[-1][-1])
+        chunk = list(qs.filter(Q(transaction__timestamp__gt=timestamp) |
+                               Q(transaction__timestamp=timestamp, transaction_id__gt=transaction) |
+                               Q(transaction__timestamp=timestamp, transaction_id=transaction, id__gt=id))[:EXPORT_CHUNK_SIZE])
+
+
+def _tag(rows, operation):
+    # heapq.merge has no key argument in python 2
+    for row in rows:
+        yield (row[0], row[1], operation, row[-1], row)
+
+
+def iter_ledger(bar, date_start=None, date_end=None):
+    """
+    Iterate over the account and item operations of the bar, in chronological order, merged by transaction.
+    Yield dicts with keys export_columns; running_total is the sum of the deltas of
+    non-canceled operations on the same target since date_start.
+    """
+    totals = {}
+    merged = heapq.merge(_tag(iter_operations(AccountOperation, bar, date_start, date_end), 'account'),
+                         _tag(iter_operations(ItemOperation, bar, date_start, date_end), 'item'))
+    for (_, _, operation, _, row) in merged:
+        (timestamp, transaction, t_type, author, canceled, target, delta, prev_value, next_value, _) = row
+        if not canceled:
+            totals[(operation, target)] = totals.get((operation, target), 0) + delta
+
+        yield {
+            'timestamp': timestamp.isoformat(),
+            'transaction': transaction,
+            'type': t_type,
+            'author': author,
+            'canceled': canceled,
+            'operation': operation,
+            'target': target,
+            'delta': delta,
+            'prev_value': prev_value,
+            'next_value': next_value,
+            'running_total': totals.get((operation, target), 0),
+        }
+
+
+class _Echo(object):
+    """
+    File-like object whose write method returns the written value, to stream a csv.writer.
+    """
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.DictWriter(_Echo(), fieldnames=export_columns)
+    yield writer.writerow(dict(zip(export_columns, export_columns)))
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_jsonl(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
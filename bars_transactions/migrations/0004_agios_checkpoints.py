@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bars_core', '0022_account_overdrawn_index'),
+        ('bars_transactions', '0003_transaction_moneyflow'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgiosRun',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('started', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished', models.DateTimeField(null=True, blank=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AgiosCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('run', models.ForeignKey(to='bars_transactions.AgiosRun')),
+                ('bar', models.ForeignKey(to='bars_core.Bar')),
+                ('day', models.DateField()),
+                ('accounts', models.TextField()),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='agioscheckpoint',
+            unique_together=set([('bar', 'day')]),
+        ),
+    ]
@@ -1,11 +1,16 @@
 # encoding: utf8
+from datetime import date
 from django.core.mail import send_mail
 from django.db import models
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from bars_django.utils import VirtualField, permission_logic
 from bars_core.perms import BarRolePermissionLogic
 from bars_core.models.bar import Bar
 from bars_core.models.user import User
 from bars_items.models.stockitem import StockItem
+from bars_items.models.sellitem import refresh_fuzzy_values
 from bars_core.models.account import Account
 from bars_transactions.perms import TransactionAuthorPermissionLogic
 
@@ -125,10 +130,21 @@ class BaseOperation(models.Model):
             self.next_value = self.prev_value + self.delta
 
         if not self.pk:
-            self.op_model.objects.filter(pk=self.target.id).update(**{self.op_model_field: self.next_value})
+            self.update_target(self.next_value)
 
         super(BaseOperation, self).save(*args, **kwargs)
 
+    def update_target(self, value):
+        self.op_model.objects.filter(pk=self.target.id).update(**self.get_target_update(value))
+        # So that further operations on the same instance start from the right value
+        setattr(self.target, self.op_model_field, value)
+
+    def get_target_update(self, value):
+        """
+        Return the fields to update on the target when its value becomes `value`.
+        """
+        return {self.op_model_field: value}
+
     def propagate(self):
         olders_or_self = (self.__class__.objects.select_related()
                           .filter(target=self.target)
@@ -146,7 +162,7 @@ class BaseOperation(models.Model):
             else:
                 next_prev = op.next_value
 
-        self.op_model.objects.filter(pk=self.target.id).update(**{self.op_model_field: next_prev})
+        self.update_target(next_prev)
 
 class ItemOperation(BaseOperation):
     class Meta:
@@ -157,6 +173,16 @@ class ItemOperation(BaseOperation):
     op_model = StockItem
     op_model_field = 'qty'
 
+    def update_target(self, value):
+        super(ItemOperation, self).update_target(value)
+        refresh_fuzzy_values([self.target.sellitem_id])
+
+    def get_target_update(self, value):
+        # Queryset updates bypass auto_now, which the catalog snapshot relies on (see bars_items.catalog)
+        update = super(ItemOperation, self).get_target_update(value)
+        update['last_modified'] = timezone.now()
+        return update
+
 
 switching_to_negative_notification_mail = {
     'subject': "[Chocapix] Notification de passage en négatif",
@@ -194,5 +220,47 @@ class AccountOperation(BaseOperation):
                 send_mail(**message)
         super(AccountOperation, self).save(*args, **kwargs)
 
+    def get_target_update(self, value):
+        # Keep track of the overdraft start, so that agios only need to look at overdrawn accounts
+        update = super(AccountOperation, self).get_target_update(value)
+        if value < 0:
+            update['overdrawn_since'] = Coalesce('overdrawn_since', Value(date.today()))
+        else:
+            update['overdrawn_since'] = None
+        return update
+
     op_model = Account
     op_model_field = 'money'
+
+
+class AgiosRun(models.Model):
+    """
+    A run of the agios engine, charging the agios of `day` (see bars_transactions.agios).
+    A run that did not finish is resumed by the next one, with the same day.
+    """
+    class Meta:
+        app_label = 'bars_transactions'
+    day = models.DateField()
+    started = models.DateTimeField(default=timezone.now)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return "%s (%s)" % (self.day, "finished" if self.finished else "unfinished")
+
+
+class AgiosCheckpoint(models.Model):
+    """
+    Record that the agios of `day` were charged in a bar, to the accounts listed in `accounts` (JSON list of ids).
+    It is written in the same database transaction as the charges.
+    """
+    class Meta:
+        app_label = 'bars_transactions'
+        unique_together = (('bar', 'day'),)
+    run = models.ForeignKey(AgiosRun)
+    bar = models.ForeignKey(Bar)
+    day = models.DateField()
+    accounts = models.TextField()
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    def __unicode__(self):
+        return "%s: %s" % (self.bar_id, self.day)
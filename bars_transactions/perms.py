@@ -1,6 +1,7 @@
 from datetime import timedelta
 from django.utils import timezone
 from permission.logics import AuthorPermissionLogic
+from bars_django.utils import get_cached_bar
 from bars_core.perms import debug_perm, BarRolePermissionLogic
 
 class TransactionAuthorPermissionLogic(AuthorPermissionLogic):
@@ -19,7 +20,7 @@ class TransactionAuthorPermissionLogic(AuthorPermissionLogic):
             if bar_role_perm:
                 return True
             # Otherwise, general rule for transaction update
-            threshold = obj.bar.settings.transaction_cancel_threshold
+            threshold = get_cached_bar(obj.bar_id).settings.transaction_cancel_threshold
             if timezone.now() - obj.timestamp > timedelta(hours=threshold):
                 return False
 
@@ -2,6 +2,7 @@
 import math
 
 from django.core.mail import send_mail
+from django.db.models import Q
 from django.utils import timezone
 
 from django.http import Http404
@@ -13,7 +14,7 @@ from bars_core.models.user import get_default_user
 from bars_core.models.account import Account, get_default_account
 from bars_items.models.buyitem import BuyItem, BuyItemPrice
 from bars_items.models.stockitem import StockItem
-from bars_items.models.sellitem import SellItem
+from bars_items.models.sellitem import SellItem, deferred_fuzzy_refresh
 from bars_transactions.models import Transaction
 
 ERROR_MESSAGES = {
@@ -72,6 +73,45 @@ class BaseTransactionSerializer(serializers.ModelSerializer):
 
 
 
+class SellItemCompositions(object):
+    """
+    Request-scoped cache of the compositions of sellitems (see SellItem.calc_price_qty_per_stockitem), for the lines
+    of a basket. Lines share the same StockItem instances, whose qty is updated in memory by the operations; a
+    composition is recomputed only after one of its stockitems changed, so results match line-by-line computations.
+    """
+    def __init__(self):
+        self.stockitems = {}  # id -> StockItem
+        self.sellitem_stockitems = {}  # sellitem id -> [StockItem]
+        self.compositions = {}  # sellitem id -> [(stockitem, qty, sell price)]
+
+    def get_stockitem(self, stockitem):
+        return self.stockitems.setdefault(stockitem.id, stockitem)
+
+    def set_stockitems(self, sellitem, stockitems):
+        """
+        Give the stockitems of a sellitem, instead of letting get_composition use sellitem.stockitems.all().
+        """
+        self.sellitem_stockitems[sellitem.id] = [self.get_stockitem(si) for si in stockitems]
+
+    def get_composition(self, sellitem):
+        composition = self.compositions.get(sellitem.id)
+        if composition is None:
+            stockitems = self.sellitem_stockitems.get(sellitem.id)
+            if stockitems is None:
+                stockitems = self.sellitem_stockitems[sellitem.id] = [self.get_stockitem(si) for si in sellitem.stockitems.all()]
+            for si in stockitems:
+                si.sellitem = sellitem  # Avoids going through another relation for the tax
+            composition = [(si, qty, si.get_price(unit='sell')) for (si, qty) in sellitem.calc_price_qty_per_stockitem(stockitems)]
+            self.compositions[sellitem.id] = composition
+        return composition
+
+    def stockitem_changed(self, stockitem):
+        self.compositions.pop(stockitem.sellitem_id, None)
+
+    def sellitem_changed(self, sellitem):
+        self.compositions.pop(sellitem.id, None)
+
+
 class ItemQtySerializer(serializers.Serializer):
     stockitem = serializers.PrimaryKeyRelatedField(queryset=StockItem.objects.all(), required=False)
     sellitem = serializers.PrimaryKeyRelatedField(queryset=SellItem.objects.all(), required=False)
@@ -112,11 +152,13 @@ class ItemQtySerializer(serializers.Serializer):
 
     def create(self, data):
         t = self.context['transaction']
+        compositions = self.context['compositions']
         qty = data['qty']
 
         if "stockitem" in data:
-            stockitem = data['stockitem']
+            stockitem = compositions.get_stockitem(data['stockitem'])
             stockitem.create_operation(delta=-qty, unit='sell', transaction=t)
+            compositions.stockitem_changed(stockitem)
 
             return qty * stockitem.get_price(unit='sell')
 
@@ -126,11 +168,11 @@ class ItemQtySerializer(serializers.Serializer):
                 qty = math.ceil(qty)
 
             total_price = 0
-            for (si, si_qty) in sellitem.calc_price_qty_per_stockitem():
-                print("si " + str(si) + " " + str(qty))
+            for (si, si_qty, si_price) in compositions.get_composition(sellitem):
                 delta = si_qty * qty
                 si.create_operation(delta=-delta, unit='sell', transaction=t, fuzzy=True)
-                total_price += delta * si.get_price(unit='sell')
+                total_price += delta * si_price
+            compositions.sellitem_changed(sellitem)
 
             return total_price
 
@@ -152,6 +194,135 @@ class ItemQtySerializer(serializers.Serializer):
         return stockitems + list(sellitem_map.values())
 
 
+class QuoteItemSerializer(serializers.Serializer):
+    stockitem = serializers.IntegerField(required=False)
+    sellitem = serializers.IntegerField(required=False)
+    qty = serializers.FloatField()
+
+    def validate_qty(self, value):
+        if value < 0:
+            raise ValidationError(ERROR_MESSAGES['negative'] % {'field':"Quantity"})
+        return value
+
+    def validate(self, data):
+        if "stockitem" in data and "sellitem" in data:
+            raise ValidationError("Two items were given")
+        if "stockitem" not in data and "sellitem" not in data:
+            raise ValidationError("No items were given")
+        return data
+
+
+class QuoteAccountSerializer(serializers.Serializer):
+    account = serializers.IntegerField()
+    ratio = serializers.FloatField(default=1)
+
+    def validate_ratio(self, value):
+        if value <= 0:
+            raise ValidationError("Ratio must be positive")
+        return value
+
+
+class QuoteSerializer(serializers.Serializer):
+    """
+    Price a basket without writing anything, with the same computations as buy and meal transactions.
+    Takes the payload of a meal (items, accounts) or of a buy (stockitem or sellitem, qty).
+    The accounts of a meal are not checked, they are only used to split the total; a buy is paid by the author's account.
+    """
+    items = QuoteItemSerializer(many=True, required=False)
+    accounts = QuoteAccountSerializer(many=True, required=False)
+    stockitem = serializers.IntegerField(required=False)
+    sellitem = serializers.IntegerField(required=False)
+    qty = serializers.FloatField(required=False)
+
+    def validate(self, data):
+        if not data.get("items"):
+            item = QuoteItemSerializer(data=dict((k, data[k]) for k in ('stockitem', 'sellitem', 'qty') if k in data))
+            if not item.is_valid():
+                raise ValidationError(item.errors)
+            data["items"] = [item.validated_data]
+            data["buy"] = True
+        return data
+
+    def get_items(self, bar, items):
+        """
+        Fetch the items of the basket, and the stockitems of its sellitems, in two queries.
+        """
+        sellitem_ids = set(i['sellitem'] for i in items if 'sellitem' in i)
+        stockitem_ids = set(i['stockitem'] for i in items if 'stockitem' in i)
+        sellitems = dict((x.id, x) for x in SellItem.objects.filter(pk__in=sellitem_ids).prefetch_related(None)) if sellitem_ids else {}
+        stockitems = list(StockItem.objects.filter(Q(pk__in=stockitem_ids) | Q(sellitem__in=sellitem_ids)).order_by('last_inventory'))
+
+        for (model, ids, objects) in [('SellItem', sellitem_ids, sellitems), ('StockItem', stockitem_ids, dict((x.id, x) for x in stockitems))]:
+            for id in ids:
+                err_params = {'model': model, 'id': id}
+                if id not in objects:
+                    raise ValidationError("%(model)s (id=%(id)d) does not exist" % err_params)
+                if objects[id].deleted:
+                    raise ValidationError(ERROR_MESSAGES['deleted'] % err_params)
+                if objects[id].bar_id != bar.id:
+                    raise ValidationError(ERROR_MESSAGES['wrong_bar'] % err_params)
+
+        compositions = SellItemCompositions()
+        for sellitem in sellitems.values():
+            compositions.set_stockitems(sellitem, [si for si in stockitems if si.sellitem_id == sellitem.id])
+        for si in stockitems:
+            compositions.get_stockitem(si)
+        return sellitems, compositions
+
+    def quote(self, bar, author):
+        """
+        Return `{total, items: [{stockitem or sellitem, qty, price, stockitems: [{stockitem, qty, price}]}],
+        accounts: [{account, ratio, amount}]}`, where quantities are in sell units and amounts are debited.
+        """
+        data = self.validated_data
+        if data.get("buy"):
+            account = Account.objects.filter(owner=author, bar=bar).values_list('id', flat=True)
+            if not account:
+                raise ValidationError("You have no account in this bar")
+            data["accounts"] = [{'account': account[0], 'ratio': 1}]
+        sellitems, compositions = self.get_items(bar, data["items"])
+
+        def apply(si, qty, price, details):
+            # Same effect on the stockitem as the operation the transaction would create
+            si.qty -= qty / si.get_unit('sell')
+            compositions.stockitem_changed(si)
+            details.append({'stockitem': si.id, 'qty': qty, 'price': price})
+
+        total = 0
+        lines = []
+        for i in data["items"]:
+            qty = i['qty']
+            details = []
+            if 'stockitem' in i:
+                si = compositions.stockitems[i['stockitem']]
+                price = qty * si.get_price(unit='sell')
+                apply(si, qty, price, details)
+                line = {'stockitem': si.id}
+            else:
+                sellitem = sellitems[i['sellitem']]
+                if not sellitem.sell_fraction:
+                    qty = math.ceil(qty)
+                price = 0
+                for (si, si_qty, si_price) in compositions.get_composition(sellitem):
+                    delta = si_qty * qty
+                    price += delta * si_price
+                    apply(si, delta, delta * si_price, details)
+                compositions.sellitem_changed(sellitem)
+                line = {'sellitem': sellitem.id}
+            line.update({'qty': qty, 'price': price, 'stockitems': details})
+            lines.append(line)
+            total += price
+
+        accounts = data.get("accounts") or []
+        total_ratio = sum(a['ratio'] for a in accounts)
+        return {
+            'total': total,
+            'items': lines,
+            'accounts': [{'account': a['account'], 'ratio': a['ratio'], 'amount': total * a['ratio'] / total_ratio}
+                         for a in accounts]
+        }
+
+
 class BuyItemQtyPriceSerializer(serializers.Serializer):
     buyitem = serializers.PrimaryKeyRelatedField(queryset=BuyItem.objects.all())
     qty = serializers.FloatField()
@@ -209,7 +380,9 @@ class BuyTransactionSerializer(BaseTransactionSerializer, ItemQtySerializer):
         t = super(BuyTransactionSerializer, self).create(data)
 
         self.context["transaction"] = t
-        money_delta = ItemQtySerializer.create(self, data)
+        self.context["compositions"] = SellItemCompositions()
+        with deferred_fuzzy_refresh():
+            money_delta = ItemQtySerializer.create(self, data)
 
         t.accountoperation_set.create(
             target=Account.objects.get(owner=t.author, bar=t.bar),
@@ -578,10 +751,12 @@ class MealTransactionSerializer(BaseTransactionSerializer):
 
         s = ItemQtySerializer()
         s.context["transaction"] = t
+        s.context["compositions"] = SellItemCompositions()
 
         total_price = 0
-        for i in data["items"]:
-            total_price += ItemQtySerializer.create(s, i)
+        with deferred_fuzzy_refresh():
+            for i in data["items"]:
+                total_price += ItemQtySerializer.create(s, i)
 
         total_ratio = 0
         for a in data["accounts"]:
@@ -631,40 +806,41 @@ class ApproTransactionSerializer(BaseTransactionSerializer):
     def create(self, data):
         t = super(ApproTransactionSerializer, self).create(data)
 
-        stockitem_map = {}
-        total = 0
-        for i in data["items"]:
-            buyitem = i["buyitem"]
-            qty = i["qty"]
-
-            priceobj, _ = BuyItemPrice.objects.get_or_create(bar=t.bar, buyitem=buyitem)
-            if "price" in i:
-                if not i["occasional"]:
-                    priceobj.price = i["price"] / qty
-                    priceobj.save()
-                total += i["price"]
-            else:
-                total += priceobj.price * qty
-
-            try:
-                stockitem = StockItem.objects.get(bar=t.bar, details=buyitem.details)
-                if stockitem.id not in stockitem_map:
-                    stockitem_map[stockitem.id] = {'stockitem': stockitem, 'delta': 0}
-                stockitem_map[stockitem.id]['delta'] += qty * buyitem.itemqty
+        with deferred_fuzzy_refresh():
+            stockitem_map = {}
+            total = 0
+            for i in data["items"]:
+                buyitem = i["buyitem"]
+                qty = i["qty"]
 
+                priceobj, _ = BuyItemPrice.objects.get_or_create(bar=t.bar, buyitem=buyitem)
                 if "price" in i:
-                    if stockitem.qty <= 0:
-                        stockitem.price = i["price"] / (qty*buyitem.itemqty)
-                    else:
-                        stockitem.price = (stockitem.qty * stockitem.price + i["price"]) / (stockitem.qty + qty*buyitem.itemqty)
-                    stockitem.save()
-            except:
-                t.delete()
-                raise Http404("Stockitem does not exist")
-
-
-        for x in stockitem_map.values():
-            x['stockitem'].create_operation(delta=x['delta'], unit='buy', transaction=t)
+                    if not i["occasional"]:
+                        priceobj.price = i["price"] / qty
+                        priceobj.save()
+                    total += i["price"]
+                else:
+                    total += priceobj.price * qty
+
+                try:
+                    stockitem = StockItem.objects.get(bar=t.bar, details=buyitem.details)
+                    if stockitem.id not in stockitem_map:
+                        stockitem_map[stockitem.id] = {'stockitem': stockitem, 'delta': 0}
+                    stockitem_map[stockitem.id]['delta'] += qty * buyitem.itemqty
+
+                    if "price" in i:
+                        if stockitem.qty <= 0:
+                            stockitem.price = i["price"] / (qty*buyitem.itemqty)
+                        else:
+                            stockitem.price = (stockitem.qty * stockitem.price + i["price"]) / (stockitem.qty + qty*buyitem.itemqty)
+                        stockitem.save()
+                except:
+                    t.delete()
+                    raise Http404("Stockitem does not exist")
+
+
+            for x in stockitem_map.values():
+                x['stockitem'].create_operation(delta=x['delta'], unit='buy', transaction=t)
 
         t.accountoperation_set.create(
             target=get_default_account(t.bar),
@@ -699,12 +875,12 @@ class InventoryTransactionSerializer(BaseTransactionSerializer):
         t = super(InventoryTransactionSerializer, self).create(data)
 
         total_price = 0
-
-        for i in data["items"]:
-            i["stockitem"].last_inventory = timezone.now()
-            i["stockitem"].save()
-            iop = i["stockitem"].create_operation(next_value=i["qty"], unit='sell', transaction=t, fixed=True)
-            total_price += iop.delta * iop.target.get_price()
+        with deferred_fuzzy_refresh():
+            for i in data["items"]:
+                i["stockitem"].last_inventory = timezone.now()
+                i["stockitem"].save()
+                iop = i["stockitem"].create_operation(next_value=i["qty"], unit='sell', transaction=t, fixed=True)
+                total_price += iop.delta * iop.target.get_price()
 
         t.moneyflow = total_price
         t.save()
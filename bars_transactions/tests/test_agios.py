@@ -0,0 +1,90 @@
+from datetime import date, timedelta
+from django.core import mail
+from django.core.management import call_command
+from rest_framework.test import APITestCase
+
+from bars_core.models.bar import Bar, BarSettings
+from bars_core.models.user import User
+from bars_core.models.account import Account
+
+from bars_transactions.models import Transaction, AgiosRun, AgiosCheckpoint
+from bars_transactions.agios import apply_agios
+
+
+def reload(obj):
+    return obj.__class__.objects.get(pk=obj.pk)
+
+class AgiosTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(AgiosTests, self).setUpTestData()
+        self.bar, _ = Bar.objects.get_or_create(id='barjone')
+        BarSettings.objects.filter(bar=self.bar).update(agios_enabled=True, agios_threshold=2, agios_factor=0.05)
+        self.disabled_bar, _ = Bar.objects.get_or_create(id='barrouje')
+        BarSettings.objects.filter(bar=self.disabled_bar).update(agios_enabled=False)
+
+        self.accounts = {}
+        for (name, bar, money, days) in [('debtor', self.bar, -100, 3), ('recent', self.bar, -10, 1),
+                                         ('rich', self.bar, 20, None), ('disabled', self.disabled_bar, -100, 3)]:
+            user, _ = User.objects.get_or_create(username=name, email=name + '@example.com')
+            account, _ = Account.objects.get_or_create(bar=bar, owner=user)
+            Account.objects.filter(pk=account.pk).update(
+                money=money, overdrawn_since=date.today() - timedelta(days) if days is not None else None)
+            self.accounts[name] = reload(account)
+
+
+    def test_agios_dry_run(self):
+        reports = apply_agios([self.bar.id, self.disabled_bar.id], dry_run=True)
+        self.assertEqual(reports[0]['charged'], [{'account': self.accounts['debtor'].id, 'owner': 'debtor', 'money': -100, 'amount': 5}])
+        self.assertEqual(reports[1]['charged'], [])
+        self.assertEqual(reload(self.accounts['debtor']).money, -100)
+        self.assertFalse(Transaction.objects.filter(type='agios').exists())
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_agios(self):
+        reports = apply_agios()
+        self.assertEqual(sum(r['total'] for r in reports), 5)
+        self.assertEqual(reload(self.accounts['debtor']).money, -105)
+        self.assertEqual(reload(self.accounts['recent']).money, -10)
+        self.assertEqual(reload(self.accounts['disabled']).money, -100)
+
+        t = Transaction.objects.get(type='agios')
+        self.assertEqual(t.moneyflow, -5)
+        aop = t.accountoperation_set.get()
+        self.assertEqual((aop.target_id, aop.prev_value, aop.delta, aop.next_value), (self.accounts['debtor'].id, -100, -5, -105))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['debtor@example.com'])
+
+        # Running again the same day charges nobody
+        reports = apply_agios([self.bar.id])
+        self.assertEqual(reports[0]['charged'], [])
+        self.assertEqual(reports[0]['skipped'], 1)
+        self.assertEqual(reload(self.accounts['debtor']).money, -105)
+        self.assertFalse(AgiosRun.objects.filter(finished__isnull=True).exists())
+
+    def test_agios_resume(self):
+        from mock import patch
+        yesterday = date.today() - timedelta(1)
+
+        # A run of yesterday crashed in the disabled bar, after charging the other one
+        with patch('bars_transactions.agios.compute_agios', side_effect=[[(self.accounts['debtor'], 5)], Exception("crash")]):
+            reports = apply_agios([self.bar.id, self.disabled_bar.id], day=yesterday)
+        self.assertIn('error', reports[1])
+        run = AgiosRun.objects.get()
+        self.assertEqual((run.day, run.finished), (yesterday, None))
+        self.assertEqual(AgiosCheckpoint.objects.get().bar_id, self.bar.id)
+        self.assertEqual(reload(self.accounts['debtor']).money, -105)
+
+        # Restarted today: yesterday's run is resumed, then today's agios are charged
+        reports = apply_agios([self.bar.id, self.disabled_bar.id])
+        self.assertEqual([(r['day'], r['bar'], r['skipped'], len(r['charged'])) for r in reports], [
+            (yesterday.isoformat(), self.bar.id, 1, 0), (yesterday.isoformat(), self.disabled_bar.id, 0, 0),
+            (date.today().isoformat(), self.bar.id, 0, 1), (date.today().isoformat(), self.disabled_bar.id, 0, 0)])
+        self.assertEqual(Transaction.objects.filter(type='agios').count(), 2)
+        self.assertFalse(AgiosRun.objects.filter(finished__isnull=True).exists())
+
+    def test_agios_command(self):
+        call_command('agios', bars=[self.bar.id], dry_run=True, stdout=open('/dev/null', 'w'))
+        self.assertEqual(reload(self.accounts['debtor']).money, -100)
+        call_command('agios', bars=[self.bar.id], stdout=open('/dev/null', 'w'))
+        self.assertEqual(reload(self.accounts['debtor']).money, -105)
@@ -0,0 +1,97 @@
+import csv
+import json
+from rest_framework.test import APITestCase
+
+from bars_core.models.bar import Bar
+from bars_core.models.user import User
+from bars_core.models.role import Role
+from bars_core.models.account import Account
+
+from bars_transactions.models import Transaction
+from bars_transactions import export
+
+
+def reload(obj):
+    return obj.__class__.objects.get(pk=obj.pk)
+
+class ExportTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        super(ExportTests, self).setUpTestData()
+        self.bar, _ = Bar.objects.get_or_create(id='barjone')
+        self.wrong_bar, _ = Bar.objects.get_or_create(id='barrouje')
+
+        self.user, _ = User.objects.get_or_create(username='user')
+        self.user.role_set.all().delete()
+        self.user = reload(self.user)
+        self.account, _ = Account.objects.get_or_create(bar=self.bar, owner=self.user)
+
+        self.treasurer, _ = User.objects.get_or_create(username='treasurer')
+        Role.objects.get_or_create(name='treasurer', bar=self.bar, user=self.treasurer)
+        self.treasurer = reload(self.treasurer)
+
+        for (delta, canceled) in [(10, False), (-2, False), (-3, True), (-1, False)]:
+            t = Transaction.objects.create(bar=self.bar, author=self.treasurer, type='deposit', canceled=canceled)
+            t.accountoperation_set.create(target=self.account, delta=delta)
+        t = Transaction.objects.create(bar=self.wrong_bar, author=self.treasurer, type='deposit')
+
+        self.url = '/bar/%s/export/' % self.bar.id
+
+
+    def test_export_no_perms(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+
+    def test_export_wrong_date(self):
+        self.client.force_authenticate(user=self.treasurer)
+        response = self.client.get(self.url + '?from=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_csv(self):
+        self.client.force_authenticate(user=self.treasurer)
+        response = self.client.get(self.url + '?format=csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+
+        rows = list(csv.DictReader(''.join(response.streaming_content).splitlines()))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual([float(r['running_total']) for r in rows], [10, 8, 8, 7])
+
+    def test_export_jsonl(self):
+        self.client.force_authenticate(user=self.treasurer)
+        response = self.client.get(self.url + '?format=jsonl')
+        self.assertEqual(response.status_code, 200)
+
+        rows = [json.loads(l) for l in ''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[-1]['running_total'], 7)
+        self.assertEqual(rows[2]['canceled'], True)
+
+    def test_export_chunks(self):
+        chunk_size = export.EXPORT_CHUNK_SIZE
+        export.EXPORT_CHUNK_SIZE = 3
+        try:
+            rows = list(export.iter_ledger(self.bar))
+        finally:
+            export.EXPORT_CHUNK_SIZE = chunk_size
+        self.assertEqual(len(rows), 4)
+        self.assertEqual([r['delta'] for r in rows], [10, -2, -3, -1])
+
+    def test_export_chronological(self):
+        from datetime import timedelta
+        # Backdated: its id comes last, its timestamp first
+        first = Transaction.objects.filter(bar=self.bar).order_by('timestamp')[0]
+        t = Transaction.objects.create(bar=self.bar, author=self.treasurer, type='deposit')
+        t.accountoperation_set.create(target=self.account, delta=5)
+        t.accountoperation_set.create(target=self.account, delta=1)
+        Transaction.objects.filter(pk=t.pk).update(timestamp=first.timestamp - timedelta(days=1))
+
+        chunk_size = export.EXPORT_CHUNK_SIZE
+        export.EXPORT_CHUNK_SIZE = 1
+        try:
+            rows = list(export.iter_ledger(self.bar))
+        finally:
+            export.EXPORT_CHUNK_SIZE = chunk_size
+        self.assertEqual([r['delta'] for r in rows], [5, 1, 10, -2, -3, -1])
+        self.assertEqual([r['running_total'] for r in rows], [5, 6, 16, 14, 14, 13])
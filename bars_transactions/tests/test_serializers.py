@@ -1,5 +1,6 @@
 from mock import Mock
 from django.http import Http404
+from django.utils import timezone
 from rest_framework import exceptions, serializers
 from rest_framework.test import APITestCase
 
@@ -13,6 +14,7 @@ from bars_items.models.buyitem import BuyItem, BuyItemPrice
 from bars_items.models.itemdetails import ItemDetails
 from bars_items.models.sellitem import SellItem
 from bars_items.models.stockitem import StockItem
+from bars_items.models.pricehistory import StockItemPriceHistory, BuyItemPriceHistory, get_stock_valuation
 
 from ..serializers import (BaseTransactionSerializer, BuyTransactionSerializer, GiveTransactionSerializer,
                            ThrowTransactionSerializer, DepositTransactionSerializer, PunishTransactionSerializer,
@@ -391,6 +393,30 @@ class MealSerializerTests(SerializerTests):
         self.assertAlmostEqual(reload(self.account2).money, end_money2)
         self.assertAlmostEqual(tct.moneyflow, total_money)
 
+    def test_meal_same_stockitem(self):
+        data = {'type':'meal', 'name':'',
+                'items': [
+                    {'sellitem':self.sellitem2.id, 'qty':3},
+                    {'stockitem':self.stockitem2.id, 'qty':2},
+                    {'sellitem':self.sellitem2.id, 'qty':4}
+                ], 'accounts': [
+                    {'account':self.account.id, 'ratio':1.0}
+                ]
+                }
+
+        s = MealTransactionSerializer(data=data, context=self.context)
+        self.assertTrue(s.is_valid())
+        tct = s.save()
+
+        self.assertAlmostEqual(reload(self.stockitem2).sell_qty, self.stockitem2.sell_qty - 9)
+        self.assertAlmostEqual(tct.moneyflow, 9 * self.stockitem2.sell_price)
+        self.assertAlmostEqual(reload(self.sellitem2).fuzzy_qty, self.stockitem2.sell_qty - 9)
+
+        iops = list(tct.itemoperation_set.order_by('pk'))
+        self.assertEqual(iops[0].prev_value, self.stockitem2.qty)
+        for (a, b) in zip(iops, iops[1:]):
+            self.assertAlmostEqual(b.prev_value, a.next_value)
+
 
 class ApproSerializerTests(SerializerTests):
     @classmethod
@@ -430,6 +456,42 @@ class ApproSerializerTests(SerializerTests):
 
         self.assertAlmostEqual(reload(self.bar_account).money, end_money)
 
+    def test_appro_price_history(self):
+        self.context = {'request': Mock(user=self.staff_user, bar=self.bar)}
+        data = {'type': 'appro', 'items': [{'buyitem': self.buyitem.id, 'qty': 10, 'price': 250, 'occasional': False}]}
+        start = timezone.now()
+        s = ApproTransactionSerializer(data=data, context=self.context)
+        self.assertTrue(s.is_valid())
+        s.save()
+        middle = timezone.now()
+        stockitem = reload(self.stockitem)
+        first_price, first_qty = stockitem.price, stockitem.qty
+
+        data['items'][0]['price'] = 500
+        s = ApproTransactionSerializer(data=data, context=self.context)
+        self.assertTrue(s.is_valid())
+        s.save()
+
+        # Prices in effect at any date
+        self.assertAlmostEqual(StockItemPriceHistory.price_at(self.stockitem.id, start), self.stockitem.price)
+        self.assertAlmostEqual(StockItemPriceHistory.price_at(self.stockitem.id, middle), first_price)
+        self.assertAlmostEqual(StockItemPriceHistory.price_at(self.stockitem.id, timezone.now()), reload(self.stockitem).price)
+        self.assertAlmostEqual(BuyItemPriceHistory.price_at(self.buyitemprice.id, middle), 25)
+        self.assertAlmostEqual(BuyItemPriceHistory.price_at(self.buyitemprice.id, timezone.now()), 50)
+
+        # Stock valuation at the end of the first appro
+        valuation = get_stock_valuation(self.bar, middle)
+        values = dict((v['stockitem'], v) for v in valuation['stockitems'])
+        self.assertAlmostEqual(values[self.stockitem.id]['qty'], first_qty)
+        self.assertAlmostEqual(values[self.stockitem.id]['value'], first_qty * first_price)
+        self.assertAlmostEqual(valuation['total'], sum(v['value'] for v in valuation['stockitems']))
+
+        # Deleted stockitems are left out at any date
+        StockItem.objects.filter(pk=self.stockitem.pk).update(deleted=True)
+        for when in [middle, None]:
+            valuation = get_stock_valuation(self.bar, when)
+            self.assertNotIn(self.stockitem.id, [v['stockitem'] for v in valuation['stockitems']])
+
     def test_appro_no_staff(self):
         data = {'type':'appro',
                 'items': [
@@ -470,6 +532,23 @@ class InventorySerializerTests(SerializerTests):
         self.assertAlmostEqual(reload(self.stockitem).sell_qty, data['items'][0]['qty'])
         self.assertAlmostEqual(reload(self.stockitem2).sell_qty, data['items'][1]['qty'])
 
+    def test_inventory_fuzzy_refresh(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        self.context = {'request': Mock(user=self.staff_user, bar=self.bar)}
+        data = {'type': 'inventory', 'items': [{'stockitem': self.stockitem.id, 'qty': 3}, {'stockitem': self.stockitem2.id, 'qty': 5}]}
+
+        s = InventoryTransactionSerializer(data=data, context=self.context)
+        self.assertTrue(s.is_valid())
+        with CaptureQueriesContext(connection) as queries:
+            s.save()
+
+        # The sellitems of all the operations are refreshed at once
+        updates = [q['sql'] for q in queries if 'UPDATE "bars_items_sellitem"' in q['sql']]
+        self.assertEqual(len(updates), 1)
+        self.assertAlmostEqual(reload(self.sellitem).fuzzy_qty, 3)
+        self.assertAlmostEqual(reload(self.sellitem2).fuzzy_qty, 5)
+
     def test_inventory_no_staff(self):
         self.context = {'request': Mock(user=self.user, bar=self.bar)}
         data = {'type':'inventory',
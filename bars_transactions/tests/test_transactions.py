@@ -97,3 +97,67 @@ class TransactionTests(APITestCase):
         response = self.client.put('/transaction/%d/cancel/' % transaction.id, {})
         self.assertEqual(response.status_code, 403)
         self.assertFalse(reload(transaction).canceled)
+
+
+    def test_quote(self):
+        itemdetails, _ = ItemDetails.objects.get_or_create(name="Chocolat noir")
+        stockitem, _ = StockItem.objects.get_or_create(bar=self.bar, sellitem=self.sellitem, details=itemdetails, price=3)
+        stockitem.qty = 2
+        stockitem.save()
+        data = {'type': 'meal', 'name': '',
+                'items': [{'sellitem': self.sellitem.id, 'qty': 4}, {'stockitem': self.stockitem.id, 'qty': 2},
+                          {'sellitem': self.sellitem.id, 'qty': 3}],
+                'accounts': [{'account': self.account.id, 'ratio': 1}, {'account': self.staff_account.id, 'ratio': 3}]}
+
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post('/transaction/quote/?bar=%s' % self.bar.id, data, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(reload(self.stockitem).qty, self.stockitem.qty)
+        quote = response.data
+        self.assertAlmostEqual(sum(l['price'] for l in quote['items']), quote['total'])
+        self.assertAlmostEqual(quote['items'][1]['price'], 2 * self.stockitem.sell_price)
+        self.assertEqual([a['amount'] for a in quote['accounts']], [quote['total'] / 4, quote['total'] * 3 / 4])
+
+        # Same amounts as the transaction
+        self.client.force_authenticate(user=self.staff_user)
+        response = self.client.post('/transaction/?bar=%s' % self.bar.id, data, format='json')
+        self.assertEqual(response.status_code, 201)
+        t = Transaction.objects.get(pk=response.data['id'])
+        self.assertAlmostEqual(t.moneyflow, quote['total'])
+        self.assertAlmostEqual(reload(self.account).money, self.account.money - quote['accounts'][0]['amount'])
+
+    def test_quote_buy(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post('/transaction/quote/?bar=%s' % self.bar.id, {'type': 'buy', 'sellitem': self.sellitem.id, 'qty': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertAlmostEqual(response.data['total'], 2 * self.stockitem.sell_price)
+        self.assertEqual(response.data['accounts'], [{'account': self.account.id, 'ratio': 1, 'amount': response.data['total']}])
+
+        # Same amount as the transaction
+        quote = response.data
+        response = self.client.post('/transaction/?bar=%s' % self.bar.id, {'type': 'buy', 'sellitem': self.sellitem.id, 'qty': 2})
+        self.assertEqual(response.status_code, 201)
+        self.assertAlmostEqual(reload(self.account).money, self.account.money - quote['accounts'][0]['amount'])
+
+        response = self.client.post('/transaction/quote/?bar=%s' % self.wrong_bar.id, {'type': 'buy', 'sellitem': self.sellitem.id, 'qty': 2})
+        self.assertEqual(response.status_code, 403)
+        self.client.force_authenticate(user=self.wrong_user)
+        response = self.client.post('/transaction/quote/?bar=%s' % self.wrong_bar.id, {'type': 'buy', 'sellitem': self.sellitem.id, 'qty': 2})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/transaction/quote/?bar=%s' % self.wrong_bar.id, {'type': 'buy', 'qty': 2})
+        self.assertEqual(response.status_code, 400)
+
+        # The author must have an account in the bar
+        user = User.objects.create(username='no_account')
+        Role.objects.create(name='customer', bar=self.bar, user=user)
+        self.client.force_authenticate(user=reload(user))
+        response = self.client.post('/transaction/quote/?bar=%s' % self.bar.id, {'type': 'buy', 'sellitem': self.sellitem.id, 'qty': 2})
+        self.assertEqual(response.status_code, 400)
+
+    def test_quote_queries(self):
+        from bars_transactions.serializers import QuoteSerializer
+        s = QuoteSerializer(data={'items': [{'sellitem': self.sellitem.id, 'qty': 4}, {'stockitem': self.stockitem.id, 'qty': 2}]})
+        self.assertTrue(s.is_valid())
+        with self.assertNumQueries(2):
+            s.quote(self.bar, self.user)
@@ -1,4 +1,4 @@
-from datetime import timedelta
+from datetime import date, timedelta
 from django.utils import timezone
 from rest_framework.test import APITestCase
 
@@ -141,4 +141,26 @@ class TransactionOperationTests(APITestCase):
         self.client.force_authenticate(user=self.staff_user)
         response = self.client.put('/transaction/%d/cancel/' % transaction.id, {})
         self.assertEqual(response.status_code, 200)
-        self.assertTrue(reload(transaction).canceled)
\ No newline at end of file
+        self.assertTrue(reload(transaction).canceled)
+
+    def test_overdrawn_since(self):
+        self.assertIsNone(reload(self.account).overdrawn_since)
+        data = {'type': 'punish', 'amount': 150, 'motive': 'Amende', 'account': self.account.id}
+
+        self.client.force_authenticate(user=self.policeman_user)
+        response = self.client.post('/transaction/?bar=%s' % self.bar.id, data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(reload(self.account).overdrawn_since, date.today())
+        self.assertIn(self.account, Account.objects.filter(deleted=False, overdrawn_since__isnull=False))
+
+        # Still overdrawn: the date is kept
+        Account.objects.filter(pk=self.account.pk).update(overdrawn_since=date.today() - timedelta(3))
+        response = self.client.post('/transaction/?bar=%s' % self.bar.id, dict(data, amount=1))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(reload(self.account).overdrawn_since, date.today() - timedelta(3))
+
+        transaction_id = response.data['id']
+        response = self.client.put('/transaction/%d/cancel/' % (transaction_id - 1), {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(reload(self.account).money, 99)
+        self.assertIsNone(reload(self.account).overdrawn_since)
@@ -8,8 +8,9 @@ from bars_core.perms import PerBarPermissionsOrObjectPermissionsOrAnonReadOnly
 from bars_core.models.bar import Bar
 from bars_core.models.user import User
 from bars_core.models.account import Account
+from bars_items.models.sellitem import deferred_fuzzy_refresh
 from bars_transactions.models import Transaction
-from bars_transactions.serializers import serializers_class_map
+from bars_transactions.serializers import serializers_class_map, QuoteSerializer
 
 
 class TransactionFilterBackend(filters.BaseFilterBackend):
@@ -69,6 +70,23 @@ class TransactionViewSet(viewsets.ModelViewSet):
             return serializers_class_map[""]
 
 
+    @decorators.list_route(methods=['post'])
+    def quote(self, request):
+        """
+        Price a basket, as a buy or meal transaction would, without creating anything.
+        Takes the payload of a meal (`items`, `accounts`) or of a buy (`stockitem` or `sellitem`, `qty`), which is
+        paid by the requesting user's account.
+        Response format: `{total, items: [{stockitem or sellitem, qty, price, stockitems: [{stockitem, qty, price}]}],
+        accounts: [{account, ratio, amount}]}`
+        ---
+        omit_serializer: true
+        """
+        if request.bar is None:
+            raise Http404()
+        serializer = QuoteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.quote(request.bar, request.user), 200)
+
     @decorators.detail_route(methods=['put'])
     def cancel(self, request, pk=None):
         try:
@@ -83,8 +101,9 @@ class TransactionViewSet(viewsets.ModelViewSet):
             for aop in transaction.accountoperation_set.all():
                 aop.propagate()
 
-            for iop in transaction.itemoperation_set.all():
-                iop.propagate()
+            with deferred_fuzzy_refresh():
+                for iop in transaction.itemoperation_set.all():
+                    iop.propagate()
 
             serializer = self.get_serializer_class()(transaction)
             return Response(serializer.data)
@@ -106,8 +125,9 @@ class TransactionViewSet(viewsets.ModelViewSet):
             for aop in transaction.accountoperation_set.all():
                 aop.propagate()
 
-            for iop in transaction.itemoperation_set.all():
-                iop.propagate()
+            with deferred_fuzzy_refresh():
+                for iop in transaction.itemoperation_set.all():
+                    iop.propagate()
 
             serializer = self.get_serializer_class()(transaction)
             return Response(serializer.data)
@@ -5,4 +5,4 @@ LOGFILE=../cron.log
 . venv/bin/activate
 
 date >> $LOGFILE
-python manage.py runscript agios >> $LOGFILE 2>&1
+python manage.py agios --processes 4 >> $LOGFILE 2>&1
@@ -1,7 +1,6 @@
-from bars_core.models.account import Account
+# Kept for compatibility; prefer `python manage.py agios`.
+from bars_transactions.agios import apply_agios
 
 def run():
-    sum = 0
-    for a in Account.objects.filter(deleted=False).select_related('bar'):
-        sum += a.bar.apply_agios(a)
-    print("Done (took %f euros)" % sum)
+    reports = apply_agios()
+    print("Done (took %f euros)" % sum(r['total'] for r in reports))
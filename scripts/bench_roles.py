@@ -0,0 +1,28 @@
+# Microbenchmark of role permissions lookups.
+# Usage: python manage.py runscript bench_roles
+import timeit
+
+from bars_core.roles import roles_map, roles_perms, perm_bits
+
+
+def run():
+    perm = 'bars_transactions.change_transaction'
+    n = 100000
+
+    def old_get_permissions():
+        return sorted(set(roles_map['admin']))
+
+    def new_get_permissions():
+        return roles_perms['admin'][0]
+
+    def old_has_perm():
+        return perm in sorted(set(roles_map['admin']))
+
+    def new_has_perm():
+        return bool(roles_perms['admin'][1] & perm_bits.get(perm, 0))
+
+    for (name, old, new) in [('get_permissions', old_get_permissions, new_get_permissions),
+                             ('has_perm', old_has_perm, new_has_perm)]:
+        t_old = timeit.timeit(old, number=n)
+        t_new = timeit.timeit(new, number=n)
+        print("%-16s old: %.3f us  new: %.3f us  (x%.1f)" % (name, t_old / n * 1e6, t_new / n * 1e6, t_old / t_new))